@@ -17,18 +17,23 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from functools import partial
 from tkinter import FLAT, HORIZONTAL, VERTICAL, Frame, StringVar, Tk, ttk
 import logging
+import threading
+from functools import partial
 
+# Imported first: the startup timeline begins with it
+from .startup_timeline import mark, timed
 from .assets.icons import (BLUE_DOT, BRIGHTNESS_ICON, COLOR_ICON,
                            CONTRAST_ICON, GREEN_DOT, INFO_FPS, INFO_RES,
                            INFO_TEMP, LIGHT_ICON, RED_DOT, WHITE_DOT, icon)
 from .assets.theme import configure_style
-from .image_browser import ImageBrowser
-from .microscope import Microscope
-from .settings import Settings
-from .timelapse import Timelapse
+from .io_throttle import ExportThrottle
+from .ui_dispatcher import install, post
+from .utils import create_popup, resolution_str
+
+# Modules depending on PIL, picamera or neopixel are imported when first needed,
+# so that the window is shown before they are loaded
 
 WIN_X = 800
 WIN_Y = 480
@@ -56,17 +61,22 @@ class App(Frame):
         self.camera_frame.grid_propagate(True)
         self.camera_frame.grid(column=0, row=0, sticky="nswe")
 
+        # Show the window before initialising the hardware
+        self.update()
+        mark('window')
+
         # Create Microscope Object
+        from .microscope import Microscope  # pylint: disable=import-outside-toplevel
         self.microscope = Microscope(master, self.camera_frame)
+        mark('hardware')
 
-        # Setup Settings Frame and Init Settings Panel
-        self.settings = Settings(self.microscope, self)
+        # Settings panel, Timelapse tab and image browser are built on first use
         self.settings_frame = Frame(self, bg='white', padx=10, pady=10, relief=FLAT)
-        self.settings.init_panel(self.settings_frame)
-
-        # Setup Timelapse Tab
-        self.timelapse = Timelapse(self.microscope, self)
-        self.timelapse.init_timelapse_tab(self.tab3)
+        self._settings = None
+        self.timelapse = None
+        self.image_browser = None
+        self.tabs.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+        self.cam_res = StringVar(value=resolution_str(self.microscope.camera.camera.resolution))
 
         # Display Informations
         info_frame = Frame(self.main_frame, bg='white', padx=10, pady=10)
@@ -86,15 +96,14 @@ class App(Frame):
         # - Screen Size
         ttk.Separator(info_frame, orient=VERTICAL).grid(row=1, column=6, sticky="ns", padx=15, pady=5)
         icon(INFO_RES, info_frame).grid(row=1, column=7, sticky='e')
-        ttk.Label(info_frame, textvar=self.settings.cam_res).grid(row=1, column=8)
+        ttk.Label(info_frame, textvar=self.cam_res).grid(row=1, column=8)
         info_frame.grid_columnconfigure(20, weight=1)
 
         # Browse Pictures Button
-        start_img_browser = ImageBrowser(path=self.microscope.camera.get_image_path()).start
         browse_btn = ttk.Button(info_frame,
                                 text="Browse Pictures",
                                 style='config.TButton',
-                                command=start_img_browser)
+                                command=self.browse_pictures)
         browse_btn.grid(row=1, column=20, sticky='nse', padx=15)
 
         # Settings Button
@@ -110,9 +119,56 @@ class App(Frame):
         camera_setup = Frame(self.tab2, relief=FLAT, bg='white')
         camera_setup.pack(fill='both')
         self.init_camera_settings(camera_setup)
+        mark('controls')
 
         self.master.wm_title("OpenMicroView")
         self.master.wm_protocol("WM_DELETE_WINDOW", self.close)
+        # Sample the system once the window is up
+        self.after_idle(self.microscope.start_telemetry)
+
+    @property
+    def settings(self):
+        ''' Settings panel, built on first use '''
+        if self._settings is None:
+            from .settings import Settings  # pylint: disable=import-outside-toplevel
+            with timed('Settings panel'):
+                self._settings = Settings(self.microscope, self)
+                self._settings.init_panel(self.settings_frame)
+        return self._settings
+
+    def on_tab_changed(self, _event=None):
+        if self.timelapse is None and self.tabs.select() == str(self.tab3):
+            self.init_timelapse()
+
+    def init_timelapse(self):
+        ''' Setup Timelapse Tab '''
+        from .timelapse import Timelapse  # pylint: disable=import-outside-toplevel
+        with timed('Timelapse tab'):
+            self.timelapse = Timelapse(self.microscope, self)
+            self.timelapse.init_timelapse_tab(self.tab3)
+
+    def capture_schedule(self) -> tuple:
+        ''' Timelapse captures schedule, used to throttle exports '''
+        if self.timelapse is None:
+            return None
+        return self.timelapse.capture_schedule()
+
+    def running_timelapse(self) -> str:
+        ''' Directory of the timelapse being captured, None if none '''
+        if self.timelapse is None:
+            return None
+        return self.timelapse.path
+
+    def browse_pictures(self):
+        ''' Open the image browser, created on first use '''
+        if self.image_browser is None:
+            from .image_browser import ImageBrowser  # pylint: disable=import-outside-toplevel
+            with timed('Image browser'):
+                self.image_browser = ImageBrowser(path=self.microscope.camera.get_image_path(),
+                                                  catalog=self.microscope.catalog,
+                                                  throttle=ExportThrottle(self.capture_schedule),
+                                                  running=self.running_timelapse)
+        self.image_browser.start()
 
     def initialize_tab_list(self):
         """ Initialize tabs Light, Camera and Timelapse """
@@ -165,7 +221,7 @@ class App(Frame):
             sc = ttk.Scale(tab, from_=0, to=255,
                            variable=self.microscope.light.color[c],
                            orient=HORIZONTAL,
-                           command=partial(self.microscope.light.set_color, c))
+                           command=self.microscope.parameters.setter(f'light.{c}'))
             sc.set(self.microscope.light.get_color(c))
             sc.grid(row=4 + i, column=1, sticky='we', padx=10, pady=10)
             icon(icons[i], tab).grid(row=i + 4, column=0, sticky='e')
@@ -187,12 +243,13 @@ class App(Frame):
         icon(CONTRAST_ICON, tab).grid(row=5, column=0, sticky='e')
         icon(BRIGHTNESS_ICON, tab).grid(row=4, column=0, sticky='e')
 
+        parameters = self.microscope.parameters
         br = ttk.Scale(tab, from_=10, to=90, orient=HORIZONTAL,
-                       command=self.microscope.camera.brightness)
+                       command=parameters.setter('camera.brightness'))
         co = ttk.Scale(tab, from_=-50, to=100, orient=HORIZONTAL,
-                       command=self.microscope.camera.contrast)
+                       command=parameters.setter('camera.contrast'))
         sa = ttk.Scale(tab, from_=-100, to=100, orient=HORIZONTAL,
-                       command=self.microscope.camera.saturation)
+                       command=parameters.setter('camera.saturation'))
 
         br.set(self.microscope.camera.brightness())
         co.set(self.microscope.camera.contrast())
@@ -202,6 +259,40 @@ class App(Frame):
         co.grid(row=5, column=1, sticky='we', padx=10, pady=10)
         sa.grid(row=7, column=1, sticky='we', padx=10, pady=10)
 
+        # Multi-illumination: one picture per LED pattern
+        from .illumination import SEQUENCES  # pylint: disable=import-outside-toplevel
+        ttk.Separator(tab, orient=HORIZONTAL).grid(row=8, columnspan=2, sticky="ew", padx=15, pady=2)
+        self.sequence = StringVar(value=list(SEQUENCES)[0])
+        ttk.Combobox(tab, textvariable=self.sequence, values=list(SEQUENCES),
+                     state='readonly').grid(row=9, columnspan=2, sticky='we', padx=10, pady=5)
+        self.sequence_btn = ttk.Button(tab, text="Capture Sequence", command=self.start_sequence)
+        self.sequence_btn.grid(row=10, columnspan=2, pady=5, padx=10, sticky='news')
+
+    def start_sequence(self):
+        if not self.microscope.light.get_brightness():
+            create_popup(text='Switch the light on to capture a sequence.', close_btn='Ok')
+            return
+        self.sequence_btn.state(['disabled'])
+        threading.Thread(name='sequenceThread', target=self.capture_sequence,
+                         args=(self.sequence.get(),)).start()
+
+    def capture_sequence(self, sequence:str):
+        ''' @Threaded - Capture the pictures of a multi-illumination sequence '''
+        # pylint: disable=import-outside-toplevel
+        from picamera.exc import PiCameraError
+
+        from .illumination import capture_sequence
+        try:
+            files = capture_sequence(self.microscope.light, self.microscope.camera, sequence)
+            post(partial(create_popup, text=f'Sequence captured: {len(files)} pictures saved.',
+                         close_btn='Ok'))
+        except (PiCameraError, OSError) as e:
+            logging.error("Impossible to capture sequence '%s'", sequence, exc_info=True)
+            post(partial(create_popup, text=f'Error: impossible to capture the sequence.\n{e}',
+                         close_btn='Ok'))
+        finally:
+            post(self.sequence_btn.state, ['!disabled'])
+
     def show_fullframe(self, pack:Frame, unpack:Frame=None):
         """ Pack a frame
 
@@ -239,8 +330,9 @@ class App(Frame):
         self.button_settings.state(['!disabled'])
 
     # Update Button Light
-    def update_text_brightness(self):
-        br = self.microscope.light.get_brightness()
+    def update_text_brightness(self, br:float=None):
+        if br is None:
+            br = self.microscope.light.get_brightness()
         self.toggler.set(f"Switch {'OFF' if br > 0 else 'ON'}")
 
     # Toggle Light ON/OFF
@@ -250,8 +342,9 @@ class App(Frame):
         self.br.set(int(self.microscope.light.get_brightness() * 100))
 
     def set_brightness(self, n):
-        self.microscope.light.set_brightness(n)
-        self.update_text_brightness()
+        self.microscope.parameters.post('light.brightness', n)
+        # Applied later by the parameter bus: the slider value is the new brightness
+        self.update_text_brightness(float(n))
 
     def close(self):
         self.microscope.close()
@@ -259,7 +352,10 @@ class App(Frame):
 
 
 def start():
+    mark('imports')
     root = Tk()
+    # Worker threads update the UI through the dispatcher
+    install(root)
     root.attributes("-fullscreen", True)
     root.config(cursor="circle")
     try:
@@ -0,0 +1,270 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import hashlib
+import json as Json
+import logging
+import os
+import tarfile
+import threading
+import time
+from datetime import datetime
+
+from .io_throttle import ExportThrottle
+from .media_catalog import MediaCatalog, entry_datetime
+from .observable import int_var, str_var
+from .ui_dispatcher import post
+from .utils import GB, MB, B_to_readable
+
+ARCHIVE_PREFIX = 'OpenMicroView_Archive'
+JOURNAL_FILE = f'.{ARCHIVE_PREFIX}.journal.json'
+# FAT32 cannot store files of 4 GiB or more
+FAT32_MAX_VOLUME = 4 * GB - 1
+WRITE_BUFFER_SIZE = 1 * MB
+# Save the restart position at least every x seconds
+JOURNAL_SAVE_INTERVAL = 5
+# Minimum delay between two refresh of the Tk progress variables
+PROGRESS_INTERVAL = 0.1
+# Space reserved at the end of a volume for the tar end-of-archive records
+TAR_END_RESERVED = 2 * tarfile.RECORDSIZE
+
+
+def parse_date(text:str, end:bool=False) -> datetime:
+    ''' Date (YYYY-MM-DD, optionally followed by a time) of a selection, None if empty.
+    A date alone ends at midnight when end is set '''
+    text = (text or '').strip()
+    if not text:
+        return None
+    date = datetime.fromisoformat(text)
+    if end and len(text) <= len('YYYY-MM-DD'):
+        date = datetime.combine(date.date(), datetime.max.time())
+    return date
+
+
+def select_entries(catalog:MediaCatalog, start:datetime=None, end:datetime=None,
+                   timelapses:list=None) -> list:
+    ''' Return the catalog entries to archive.
+
+    Without any filter, every entry is selected. start/end select the entries
+    captured in [start, end], timelapses selects timelapses by name.
+    '''
+    entries = catalog.entries()
+    if timelapses is not None:
+        entries = [e for e in entries if e.is_timelapse
+                   and (e.name in timelapses or e.basename in timelapses)]
+    if start is not None:
+        entries = [e for e in entries if entry_datetime(e) >= start]
+    if end is not None:
+        entries = [e for e in entries if entry_datetime(e) <= end]
+    return entries
+
+
+class _CountingReader:
+    """ File wrapper calling callback(n) for every n bytes read """
+    def __init__(self, fileobj, callback):
+        self.fileobj = fileobj
+        self.callback = callback
+
+    def read(self, size=-1):
+        buf = self.fileobj.read(size)
+        self.callback(len(buf))
+        return buf
+
+
+class ArchiveExporter():
+    """ Export a selection of the media catalog as sequential tar volumes.
+
+    Writing a few large files is much faster than thousands of small ones on
+    USB sticks (FAT32 in particular). Volumes are split to stay below
+    `volume_size`, and a journal keeps the restart position so an interrupted
+    export resumes from the last saved member instead of starting over.
+    """
+    def __init__(self, catalog:MediaCatalog, volume_size:int=FAT32_MAX_VOLUME,
+                 throttle:ExportThrottle=None):
+        self.catalog = catalog
+        self.throttle:ExportThrottle = throttle
+        self.volume_size = volume_size
+        self.dest:str = None
+        self.entries:list = None
+        # Selection used when entries is None, see select_entries
+        self.start:datetime = None
+        self.end:datetime = None
+        self.timelapses:list = None
+        self.percent = int_var()
+        self.progress_value = int_var()
+        self.transfered_size_str = str_var()
+
+        self.running = threading.Event()
+        self.stop_event = threading.Event()
+        self.source_size:int = 0
+        self.transfered_size:int = 0
+        self.transfered_files:int = 0
+        self.volumes:list = []
+        self._last_progress:float = 0
+
+    def isrunning(self) -> bool:
+        return self.running.is_set()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def journal_path(self) -> str:
+        return os.path.join(self.dest, JOURNAL_FILE)
+
+    def volume_path(self, base:str, volume:int) -> str:
+        if volume == 0:
+            return os.path.join(self.dest, f'{base}.tar')
+        return os.path.join(self.dest, f'{base}_part{volume + 1}.tar')
+
+    def load_journal(self, selection_id:str) -> dict:
+        ''' Return the restart position of a previous export of the same selection '''
+        try:
+            with open(self.journal_path(), 'r') as f:
+                journal = Json.load(f)
+            if journal.get('selection') == selection_id:
+                return journal
+            logging.info('Journal found for another selection, starting a new archive.')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logging.error('Invalid archive journal, starting a new archive.', exc_info=True)
+        return None
+
+    def save_journal(self, journal:dict):
+        tmp = self.journal_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            Json.dump(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path())
+
+    def execute(self) -> bool:
+        if self.isrunning():
+            logging.warning("The archive export is already on going.")
+            return False
+        self.running.set()
+        self.stop_event.clear()
+        try:
+            return self._execute()
+        finally:
+            self.running.clear()
+
+    def _execute(self) -> bool:
+        if self.throttle is not None:
+            self.throttle.stop_event = self.stop_event
+            self.throttle.lower_priority()
+        self.catalog.refresh()
+        entries = self.entries
+        if entries is None:
+            entries = select_entries(self.catalog, self.start, self.end, self.timelapses)
+        files = sorted(self.catalog.files(entries))
+        selection_id = hashlib.sha1('\n'.join(f[0] for f in files).encode()).hexdigest()
+        os.makedirs(self.dest, exist_ok=True)
+
+        journal = self.load_journal(selection_id)
+        if journal is None:
+            base = f"{ARCHIVE_PREFIX}_{datetime.now().strftime(r'%Y-%m-%d_%H-%M-%S')}"
+            journal = {'selection': selection_id, 'base': base, 'members': 0,
+                       'volume': 0, 'offset': 0, 'bytes': 0}
+        else:
+            logging.info('Resuming archive %s at member %d/%d',
+                         journal['base'], journal['members'], len(files))
+        self.source_size = sum(f[1] for f in files)
+        self.transfered_size = journal['bytes']
+        self.transfered_files = journal['members']
+        self.volumes = [self.volume_path(journal['base'], v) for v in range(journal['volume'] + 1)]
+        self.update_status(force=True)
+        logging.info('Archiving %d files (%s) to %s', len(files),
+                     B_to_readable(self.source_size), self.dest)
+
+        completed = self._write_volumes(files, journal)
+        if completed:
+            os.remove(self.journal_path())
+        logging.info("Archive ended: %d files, %s in %d volume(s).", self.transfered_files,
+                     B_to_readable(self.transfered_size), len(self.volumes))
+        return completed
+
+    def _open_volume(self, journal:dict):
+        ''' Open the current volume, positioned at the journal offset '''
+        path = self.volume_path(journal['base'], journal['volume'])
+        mode = 'r+b' if journal['offset'] and os.path.exists(path) else 'wb'
+        fileobj = open(path, mode, buffering=WRITE_BUFFER_SIZE)
+        if mode == 'r+b':
+            # Drop what was written after the last saved position
+            fileobj.truncate(journal['offset'])
+            fileobj.seek(journal['offset'])
+        else:
+            journal['offset'] = 0
+        # tarfile in write mode starts writing at the current position
+        return fileobj, tarfile.open(fileobj=fileobj, mode='w', format=tarfile.GNU_FORMAT)
+
+    def _checkpoint(self, fileobj, journal:dict):
+        ''' Save the journal once everything up to its offset is on the device '''
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+        self.save_journal(journal)
+
+    def _write_volumes(self, files:list, journal:dict) -> bool:
+        fileobj, tar = self._open_volume(journal)
+        last_save = time.monotonic()
+        try:
+            for rel, _, _ in files[journal['members']:]:
+                if self.stop_event.is_set():
+                    logging.warning('Archive export cancelled.')
+                    self._checkpoint(fileobj, journal)
+                    fileobj.close()
+                    return False
+                if self.throttle is not None:
+                    self.throttle.throttle(files=1)
+                tarinfo = tar.gettarinfo(os.path.join(self.catalog.path, rel), arcname=rel)
+                header_size = len(tarinfo.tobuf(tar.format, tar.encoding, tar.errors))
+                member_size = header_size + tarfile.BLOCKSIZE * -(-tarinfo.size // tarfile.BLOCKSIZE)
+                if tar.offset > 0 and tar.offset + member_size + TAR_END_RESERVED > self.volume_size:
+                    # Close this volume and continue in a new one
+                    tar.close()
+                    fileobj.close()
+                    journal['volume'] += 1
+                    journal['offset'] = 0
+                    self.volumes.append(self.volume_path(journal['base'], journal['volume']))
+                    fileobj, tar = self._open_volume(journal)
+                with open(os.path.join(self.catalog.path, rel), 'rb') as f:
+                    tar.addfile(tarinfo, _CountingReader(f, self._add_progress))
+                # Do not keep every TarInfo in memory
+                tar.members.clear()
+                # Member complete: this is a valid restart position
+                journal['members'] += 1
+                journal['offset'] = tar.offset
+                journal['bytes'] = self.transfered_size
+                self.transfered_files += 1
+                if time.monotonic() - last_save > JOURNAL_SAVE_INTERVAL:
+                    self._checkpoint(fileobj, journal)
+                    last_save = time.monotonic()
+            tar.close()
+            fileobj.close()
+            return True
+        except BaseException:
+            # Keep the journal consistent with what is really on the device
+            if not fileobj.closed:
+                self._checkpoint(fileobj, journal)
+                fileobj.close()
+            raise
+        finally:
+            self.update_status(force=True)
+
+    def _add_progress(self, n:int):
+        ''' Called after each read of a source file, before writing it '''
+        if self.throttle is not None:
+            self.throttle.throttle(nbytes=n)
+        self.transfered_size += n
+        self.update_status()
+
+    def update_status(self, force:bool=False):
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return None
+        self._last_progress = now
+        prct = 100 * (self.transfered_size / self.source_size) if self.source_size else 100
+        post(self.percent, int(prct))
+        post(self.transfered_size_str, B_to_readable(self.transfered_size))
+        post(self.progress_value, self.transfered_size)
+        return None
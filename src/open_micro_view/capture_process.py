@@ -0,0 +1,316 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import multiprocessing
+import struct
+import threading
+import time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8: the camera stays in the application process
+    shared_memory = None
+
+# Frames kept in the ring: the reader has RING_SLOTS - 1 frames of time to use one
+RING_SLOTS = 4
+# Seconds given to the capture process to open the camera
+START_TIMEOUT = 10.0
+# Seconds between two checks of the ring by the readers
+POLL_INTERVAL = 0.01
+# Methods of the camera called through the command channel (other names are attributes)
+CAMERA_METHODS = ('capture',)
+
+# Sequence number of the last frame written
+_RING_HEADER = struct.Struct('<Q')
+# Sequence number (0 while being written), width, height
+_SLOT_HEADER = struct.Struct('<QII')
+
+
+def grab_array(camera, fmt:str='rgb'):
+    ''' Full resolution still as a (height, width, 3) array, fmt: 'rgb' or 'yuv' '''
+    # pylint: disable=import-outside-toplevel
+    from picamera.array import PiRGBArray, PiYUVArray
+    stream = (PiYUVArray if fmt == 'yuv' else PiRGBArray)(camera)
+    camera.capture(stream, fmt)
+    return stream.array
+
+
+def available() -> bool:
+    ''' True if the camera can be moved to a capture process (Python >= 3.8) '''
+    return shared_memory is not None
+
+
+class FrameRing:
+    """ RGB frames shared between processes, written in turn in RING_SLOTS slots.
+
+    Each frame gets a sequence number. The slot number is zeroed while the
+    frame is written, so that readers using a frame in place (without copy)
+    can check with valid() that it was not overwritten in the meantime.
+    """
+    def __init__(self, frame_size:int, slots:int=RING_SLOTS, name:str=None):
+        self.frame_size = frame_size
+        self.slots = slots
+        self.slot_size = _SLOT_HEADER.size + frame_size
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=_RING_HEADER.size + slots * self.slot_size)
+        else:
+            # Capture process: the resource tracker is shared with the owner, which unlinks it
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def _offset(self, seq:int) -> int:
+        return _RING_HEADER.size + (seq % self.slots) * self.slot_size
+
+    def write(self, data, width:int, height:int) -> int:
+        ''' Write a frame (bytes-like, width * height * 3), return its sequence number '''
+        seq = self.latest() + 1
+        offset = self._offset(seq)
+        start = offset + _SLOT_HEADER.size
+        _SLOT_HEADER.pack_into(self.buf, offset, 0, width, height)
+        self.buf[start:start + len(data)] = data
+        _SLOT_HEADER.pack_into(self.buf, offset, seq, width, height)
+        _RING_HEADER.pack_into(self.buf, 0, seq)
+        return seq
+
+    def latest(self) -> int:
+        return _RING_HEADER.unpack_from(self.buf, 0)[0]
+
+    def read(self, seq:int) -> tuple:
+        ''' Return (width, height, memoryview) of frame seq, None if already overwritten '''
+        offset = self._offset(seq)
+        slot_seq, width, height = _SLOT_HEADER.unpack_from(self.buf, offset)
+        if slot_seq != seq:
+            return None
+        start = offset + _SLOT_HEADER.size
+        return width, height, self.buf[start:start + width * height * 3]
+
+    def valid(self, seq:int) -> bool:
+        ''' True if frame seq is still in the ring, unchanged '''
+        return _SLOT_HEADER.unpack_from(self.buf, self._offset(seq))[0] == seq
+
+    def close(self):
+        self.buf.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class CameraProxy:
+    """ Stand-in for the PiCamera owned by the capture process.
+
+    Attributes are read and written, and CAMERA_METHODS called, through the
+    command channel of the process (e.g. proxy.resolution = (1920, 1080)).
+    """
+    def __init__(self, process):
+        object.__setattr__(self, '_process', process)
+
+    def __getattr__(self, name:str):
+        if name in CAMERA_METHODS:
+            return lambda *args, **kwargs: self._process.request('call', name, args, kwargs)
+        return self._process.request('get', name)
+
+    def __setattr__(self, name:str, value):
+        self._process.request('set', name, value)
+
+    def capture_sequence(self, outputs, format:str='jpeg', **kwargs):  # pylint: disable=redefined-builtin
+        ''' capture_sequence of the process (e.g. burst=True), the outputs (file names) being
+        produced here one at a time (e.g. by a generator switching the light before each one) '''
+        return self._process.request_sequence(outputs, format, kwargs)
+
+    def capture_array(self, fmt:str='rgb'):
+        ''' Raw still captured by the process (see grab_array) '''
+        return self._process.request('array', fmt)
+
+
+class CaptureProcess:
+    """ Camera owned by a dedicated process, immune to the load of the application.
+
+    The process streams the live preview into a FrameRing in shared memory
+    and serves the requests of the command channel (camera settings, still
+    captures, preview settings) between two frames. Requests are sent by the
+    CameraProxy, from any thread of the application.
+    """
+    def __init__(self, frame_size:int):
+        self.ring = FrameRing(frame_size)
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(name='captureProcess', target=run_capture,
+                                       args=(child_conn, self.ring.name, frame_size), daemon=True)
+        self.lock = threading.Lock()
+        self.proxy = CameraProxy(self)
+
+    def start(self):
+        self.process.start()
+        if not self.conn.poll(START_TIMEOUT):
+            self.close()
+            raise RuntimeError('The capture process did not start.')
+        status, result = self.conn.recv()
+        if status == 'error':
+            self.close()
+            raise result
+        logging.info('Capture process started (pid %d).', self.process.pid)
+
+    def request(self, command:str, *args):
+        ''' Send a command, wait for its result (exceptions of the process are raised here) '''
+        with self.lock:
+            try:
+                self.conn.send((command, args))
+                status, result = self.conn.recv()
+            except (EOFError, OSError) as e:
+                raise RuntimeError('The capture process ended.') from e
+        if status == 'error':
+            raise result
+        return result
+
+    def request_sequence(self, outputs, fmt:str, kwargs:dict):
+        ''' Run capture_sequence in the process: before each frame, the process asks for
+        its output, so the next item of outputs is produced right before its capture '''
+        outputs = iter(outputs)
+        error = None
+        with self.lock:
+            try:
+                self.conn.send(('sequence', (fmt, kwargs)))
+                while True:
+                    status, result = self.conn.recv()
+                    if status != 'next':
+                        break
+                    output = None
+                    if error is None:
+                        try:
+                            output = next(outputs, None)
+                        except Exception as e:  # pylint: disable=broad-except
+                            # Ends the sequence, raised once the process is done
+                            error = e
+                    self.conn.send(output)
+            except (EOFError, OSError) as e:
+                raise RuntimeError('The capture process ended.') from e
+        if error is not None:
+            raise error
+        if status == 'error':
+            raise result
+        return result
+
+    def set_preview(self, active:bool, width:int=None, fps:float=None, paused:bool=False):
+        self.request('preview', active, width, fps, paused)
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.request('stop')
+            except RuntimeError:
+                pass
+            self.process.join(timeout=2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.conn.close()
+        self.ring.close()
+
+
+class _CaptureServer:
+    """ Capture process side: the camera, the ring and the command channel """
+    def __init__(self, camera, ring:FrameRing, conn):
+        self.camera = camera
+        self.ring = ring
+        self.conn = conn
+        self.running = True
+        self.preview = False
+        self.width:int = None
+        self.fps:float = None
+        self.paused = False
+
+    def run(self):
+        while self.running:
+            if self.preview and not self.paused:
+                self.stream_preview()
+            else:
+                self.conn.poll(1.0)
+            while self.running and self.conn.poll():
+                self.serve(*self.conn.recv())
+
+    def stream_preview(self):
+        ''' Fill the ring until a request is received '''
+        from picamera.array import PiRGBArray  # pylint: disable=import-outside-toplevel
+        res = self.camera.resolution
+        w = self.width
+        h = round(w * res[1] / res[0])
+        if w * h * 3 > self.ring.frame_size:
+            logging.error('Preview %dx%d too large for the frame ring.', w, h)
+            self.preview = False
+            return
+        stream = PiRGBArray(self.camera, size=(w, h))
+        for frame in self.camera.capture_continuous(stream, format='rgb', use_video_port=True,
+                                                    resize=(w, h)):
+            frame_start = time.monotonic()
+            stream.truncate()
+            stream.seek(0)
+            array = frame.array
+            self.ring.write(memoryview(array).cast('B'), array.shape[1], array.shape[0])
+            delay = 1 / self.fps - (time.monotonic() - frame_start) if self.fps else 0
+            if self.conn.poll(max(0, delay)):
+                return
+
+    def serve(self, command:str, args:tuple):
+        try:
+            if command == 'get':
+                result = getattr(self.camera, args[0])
+            elif command == 'set':
+                result = setattr(self.camera, args[0], args[1])
+            elif command == 'call':
+                name, call_args, kwargs = args
+                if name not in CAMERA_METHODS:
+                    raise AttributeError(name)
+                result = getattr(self.camera, name)(*call_args, **kwargs)
+            elif command == 'array':
+                result = grab_array(self.camera, args[0])
+            elif command == 'sequence':
+                fmt, kwargs = args
+                result = self.camera.capture_sequence(self.sequence_outputs(), fmt, **kwargs)
+            elif command == 'preview':
+                self.preview, width, self.fps, self.paused = args
+                self.width = width or self.width
+                result = None
+            elif command == 'stop':
+                self.running = False
+                result = None
+            else:
+                raise ValueError(f'Unknown command {command!r}')
+        except Exception as e:  # pylint: disable=broad-except
+            # Sent back to the application
+            self.conn.send(('error', e))
+            return
+        self.conn.send(('ok', result))
+
+    def sequence_outputs(self):
+        ''' Outputs of a sequence, asked to the application right before each frame '''
+        while True:
+            self.conn.send(('next', None))
+            output = self.conn.recv()
+            if output is None:
+                return
+            yield output
+
+
+def run_capture(conn, ring_name:str, frame_size:int):
+    ''' Entry point of the capture process '''
+    # pylint: disable=import-outside-toplevel
+    from picamera import PiCamera
+    ring = FrameRing(frame_size, name=ring_name)
+    try:
+        camera = PiCamera()
+    except Exception as e:  # pylint: disable=broad-except
+        conn.send(('error', e))
+        ring.close()
+        return
+    conn.send(('ok', None))
+    try:
+        _CaptureServer(camera, ring, conn).run()
+    finally:
+        camera.close()
+        ring.close()
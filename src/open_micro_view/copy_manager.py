@@ -1,87 +1,395 @@
 # OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
 # Copyright (C) 2023 V. Salvadori
 
+import json as Json
 import logging
 import os
-from subprocess import PIPE, STDOUT, Popen
-from time import sleep
-from tkinter import IntVar, StringVar
+import threading
+import time
+import zlib
+from queue import Full, Queue
 
-from .utils import B_to_readable, dir_size_bytes
+from .io_throttle import ExportThrottle
+from .media_catalog import MediaCatalog, unsharded
+from .observable import int_var, str_var
+from .tracing import span
+from .ui_dispatcher import post
+from .utils import MB, B_to_readable
+
+# Manifest of the files already exported, stored on the device itself
+MANIFEST_FILE = '.openmicroview_manifest.json'
+MANIFEST_VERSION = 1
+COPY_BUFFER_SIZE = 1 * MB
+# Save the manifest at least every x seconds during an export
+MANIFEST_SAVE_INTERVAL = 10
+# Minimum delay between two refresh of the Tk progress variables
+PROGRESS_INTERVAL = 0.1
+# Journal of the files verified on the device and not yet deleted locally (move mode)
+MOVE_JOURNAL_FILE = '.openmicroview_move.journal'
+# Maximum number of copied files waiting for verification
+VERIFY_QUEUE_SIZE = 64
 
 
 class CopyManager():
-    """ Manage copy between source and dest """
-    def __init__(self):
+    """ Incremental export of the media catalog to a destination directory.
+
+    A manifest of the exported files (size and modification time) is kept in
+    the destination, so that next exports to the same device only copy the
+    new or modified files, without scanning the device.
+
+    In move mode, each copied file is read back from the device and compared
+    to the source in a second thread, then deleted locally. Verified files are
+    written to a journal before being deleted, so an interrupted move resumes
+    without copying or verifying them again.
+    """
+    def __init__(self, catalog:MediaCatalog=None, throttle:ExportThrottle=None):
+        self.catalog:MediaCatalog = catalog
+        self.throttle:ExportThrottle = throttle
         self.source:str = None
         self.dest:str = None
-        self.percent = IntVar()
-        self.progress_value = IntVar()
-        self.transfered_size_str = StringVar()
+        self.percent = int_var()
+        self.progress_value = int_var()
+        self.transfered_size_str = str_var()
 
-        self.process:Popen = None
-        self.pid:int = None
-        self.size_before_copy:int = 0
+        self.running = threading.Event()
+        self.stop_event = threading.Event()
+        self.manifest:dict = {}
+        self.manifest_lock = threading.Lock()
+        self.move:bool = False
+        # Entries (relative names) left in place in move mode, e.g. the timelapse being captured
+        self.skip:list = []
+        self.verify_queue:Queue = None
+        self.verify_thread:threading.Thread = None
+        self.verified_files:int = 0
+        self.freed_size:int = 0
+        self.failed_files:list = []
+        self._remaining:dict = {}
         self.source_size:int = 0
         self.transfered_size:int = 0
-        self.transfered_files:list = []
+        self.transfered_files:int = 0
+        self._last_progress:float = 0
 
     def isrunning(self) -> bool:
-        if self.process:
-            return self.process.poll() is None
-        return False
+        return self.running.is_set()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def manifest_path(self) -> str:
+        return os.path.join(self.dest, MANIFEST_FILE)
+
+    def load_manifest(self) -> dict:
+        ''' Return the files exported to dest so far: {relative path: [size, mtime_ns]} '''
+        try:
+            with open(self.manifest_path(), 'r') as f:
+                manifest = Json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest['files']
+            logging.warning('Unknown manifest version, exporting everything.')
+        except FileNotFoundError:
+            logging.info('No manifest found on device, exporting everything.')
+        except (OSError, ValueError, KeyError):
+            logging.error('Invalid manifest, exporting everything.', exc_info=True)
+        return {}
+
+    def save_manifest(self):
+        tmp = self.manifest_path() + '.tmp'
+        with self.manifest_lock, open(tmp, 'w') as f:
+            Json.dump({'version': MANIFEST_VERSION, 'files': self.manifest}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path())
 
-    def execute(self) -> bool:
+    def delta(self) -> tuple:
+        ''' Return the (relative path, size, mtime_ns) of the files not exported yet,
+        and of the files already exported '''
+        if self.catalog is None:
+            self.catalog = MediaCatalog(self.source)
+        self.catalog.refresh()
+        todo = []
+        exported = []
+        for rel, size, mtime_ns in self.catalog.files():
+            if self.move and self.skipped(rel):
+                continue
+            if self.manifest.get(rel) == [size, mtime_ns] or self.relocate(rel, size, mtime_ns):
+                exported.append((rel, size, mtime_ns))
+            else:
+                todo.append((rel, size, mtime_ns))
+        return todo, exported
+
+    def skipped(self, rel:str) -> bool:
+        ''' True if rel belongs to an entry of skip '''
+        return any(rel == s or rel.startswith(s + '/') for s in self.skip)
+
+    def relocate(self, rel:str, size:int, mtime_ns:int) -> bool:
+        ''' File moved to a date directory since its export: move its copy as well.
+        Return True if the copy is now at rel on the device '''
+        legacy = unsharded(rel)
+        if legacy is None or self.manifest.get(legacy) != [size, mtime_ns]:
+            return False
+        try:
+            os.renames(os.path.join(self.dest, legacy), os.path.join(self.dest, rel))
+        except OSError:
+            logging.warning('Impossible to move %s to %s on the device', legacy, rel, exc_info=True)
+            return False
+        with self.manifest_lock:
+            del self.manifest[legacy]
+            self.manifest[rel] = [size, mtime_ns]
+        return True
+
+    def execute(self, full:bool=False, move:bool=False) -> bool:
+        ''' Export new files to dest. full=True ignores the manifest and copies everything,
+        move=True deletes the local files once their copy is verified '''
         if self.isrunning():
             logging.warning("The copy is already on going.")
             return False
-        self.transfered_files = []
+        self.running.set()
+        self.stop_event.clear()
+        self.move = move
+        try:
+            with span('copy', full=full, move=move):
+                return self._execute(full)
+        finally:
+            self.running.clear()
+
+    def _execute(self, full:bool) -> bool:
+        self.transfered_files = 0
         self.transfered_size = 0
-        self.source_size = dir_size_bytes(self.source)
-        self.percent.set(int(0))
-        self.transfered_size_str.set(B_to_readable(0))
-        self.progress_value.set(0)
+        self.verified_files = 0
+        self.freed_size = 0
+        self.failed_files = []
+        post(self.percent, int(0))
+        post(self.transfered_size_str, B_to_readable(0))
+        post(self.progress_value, 0)
         logging.info('Starting copy...')
-        if self.dest[-1] != os.path.sep:
-            self.dest = self.dest + os.path.sep
-        if self.source[-1] != os.path.sep:
-            self.source = self.source + os.path.sep
-        if not os.path.isdir(self.dest):
-            os.mkdir(self.dest)
-        self.size_before_copy = dir_size_bytes(self.dest)
-        logging.info('   | size before copy: %.2f MB', self.size_before_copy / 1024)
-        cmd = ['/usr/bin/rsync', '-a',r"--out-format=%l$%f$",
-               '--no-o', '--no-g', '--no-p', self.source, self.dest]
-        with Popen(cmd, stdin=None, stdout=PIPE, stderr=STDOUT) as ps:
-            logging.info('   | processing...')
-            self.process = ps
-            sleep(0.5)
-            for line in ps.stdout:
-                line = line.decode('utf8')
-                self.update_status(line)
-            logging.warning('! nothing to read')
-        logging.warning("\nProcess ended")
+        if self.throttle is not None:
+            self.throttle.stop_event = self.stop_event
+            self.throttle.lower_priority()
+        os.makedirs(self.dest, exist_ok=True)
+        self.manifest = {} if full else self.load_manifest()
+        if self.move:
+            self.resume_move()
+        todo, exported = self.delta()
+        self.source_size = sum(f[1] for f in todo)
+        logging.info('   | %d new files (%s) to export', len(todo), B_to_readable(self.source_size))
+        created_dirs = set()
+        last_save = time.monotonic()
+        try:
+            if self.move:
+                self.start_verifier(todo + exported)
+                # Already on the device: only verify and delete them
+                for rel, size, _ in exported:
+                    if self.stop_event.is_set():
+                        break
+                    if not self.queue_verification((rel, size, None)):
+                        self.failed_files.append(rel)
+            for rel, size, mtime_ns in todo:
+                if self.stop_event.is_set():
+                    logging.warning('Copy cancelled.')
+                    break
+                if self.throttle is not None:
+                    self.throttle.throttle(files=1)
+                parent = os.path.dirname(rel)
+                if parent and parent not in created_dirs:
+                    os.makedirs(os.path.join(self.dest, parent), exist_ok=True)
+                    created_dirs.add(parent)
+                with span('copy file', file=rel, size=size):
+                    crc = self.copy_file(rel, mtime_ns)
+                with self.manifest_lock:
+                    self.manifest[rel] = [size, mtime_ns]
+                self.transfered_files += 1
+                if self.move and not self.queue_verification((rel, size, crc)):
+                    self.failed_files.append(rel)
+                if time.monotonic() - last_save > MANIFEST_SAVE_INTERVAL:
+                    self.save_manifest()
+                    last_save = time.monotonic()
+        finally:
+            if self.move:
+                self.stop_verifier()
+            self.save_manifest()
+            self.update_status(force=True)
+        logging.info("Process ended: %d files, %s copied.", self.transfered_files,
+                     B_to_readable(self.transfered_size))
+        if self.move:
+            logging.info("   | %d files verified and deleted, %s freed, %d failures.",
+                         self.verified_files, B_to_readable(self.freed_size), len(self.failed_files))
+            self.catalog.refresh()
         return True
 
-    def update_status(self, line:str):
-        size = filename = None
+    def copy_file(self, rel:str, mtime_ns:int):
+        ''' Copy a single file, written to a temporary name and renamed once complete '''
+        src = os.path.join(self.source, rel)
+        dst = os.path.join(self.dest, rel)
+        tmp = dst + '.part'
+        crc = 0
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            while True:
+                buf = fsrc.read(COPY_BUFFER_SIZE)
+                if not buf:
+                    break
+                if self.throttle is not None:
+                    self.throttle.throttle(nbytes=len(buf))
+                fdst.write(buf)
+                if self.move:
+                    crc = zlib.crc32(buf, crc)
+                self.transfered_size += len(buf)
+                self.update_status()
+        os.utime(tmp, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp, dst)
+        return crc
+
+    # MOVE MODE
+    def move_journal_path(self) -> str:
+        return os.path.join(self.source, MOVE_JOURNAL_FILE)
+
+    def resume_move(self):
+        ''' Delete the files verified during an interrupted move '''
         try:
-            size, filename, _  = line.split('$')
-        except ValueError:
-            logging.error(line, exc_info=True)
-            return None
-        if filename in self.transfered_files:
-            logging.warning(' + duplicate file')
+            with open(self.move_journal_path(), 'r') as f:
+                verified = [line.rstrip('\n') for line in f if line.strip()]
+        except FileNotFoundError:
+            return
+        logging.info('Resuming move: %d verified files to delete.', len(verified))
+        dirs = set()
+        for rel in verified:
+            try:
+                os.remove(os.path.join(self.source, rel))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logging.error('Impossible to delete %s', rel, exc_info=True)
+            if os.path.dirname(rel):
+                dirs.add(os.path.dirname(rel))
+        for d in dirs:
+            self.remove_empty_dir(d)
+        os.remove(self.move_journal_path())
+
+    def remove_empty_dir(self, rel_dir:str):
+        try:
+            os.rmdir(os.path.join(self.source, rel_dir))
+        except OSError:
+            # Not empty, e.g. files which could not be moved
+            logging.debug('%s not removed.', rel_dir)
+
+    def start_verifier(self, files:list):
+        # Number of files left in each directory, to remove it after its last file
+        self._remaining = {}
+        for rel, _, _ in files:
+            d = os.path.dirname(rel)
+            if d:
+                self._remaining[d] = self._remaining.get(d, 0) + 1
+        self.verify_queue = Queue(maxsize=VERIFY_QUEUE_SIZE)
+        self.verify_thread = threading.Thread(name='verifyThread', target=self.verify_loop, args=())
+        self.verify_thread.start()
+
+    def queue_verification(self, item) -> bool:
+        ''' Queue item for the verifier, False if the verifier stopped '''
+        while self.verify_thread.is_alive():
+            try:
+                self.verify_queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def stop_verifier(self):
+        ''' Wait for the files already copied to be verified '''
+        self.queue_verification(None)
+        self.verify_thread.join()
+        self.verify_thread = None
+        try:
+            os.remove(self.move_journal_path())
+        except FileNotFoundError:
+            pass
+
+    def verify_loop(self):
+        ''' @Threaded - verify each copied file, then delete the source '''
+        try:
+            journal = open(self.move_journal_path(), 'a')
+        except OSError:
+            logging.error('Impossible to open the move journal, files kept.', exc_info=True)
+            return
+        with journal:
+            while True:
+                item = self.verify_queue.get()
+                if item is None:
+                    return
+                self.move_file(journal, *item)
+
+    def move_file(self, journal, rel:str, size:int, crc:int):
+        ''' Verify the copy of rel, journal it then delete the source '''
+        verified = False
+        try:
+            if not self.verify_file(rel, size, crc):
+                logging.error('Verification failed for %s, file kept.', rel)
+                self.failed_files.append(rel)
+                with self.manifest_lock:
+                    self.manifest.pop(rel, None)
+                return
+            verified = True
+            journal.write(rel + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+            os.remove(os.path.join(self.source, rel))
+            self.verified_files += 1
+            self.freed_size += size
+            d = os.path.dirname(rel)
+            if d:
+                self._remaining[d] -= 1
+                if self._remaining[d] == 0:
+                    self.remove_empty_dir(d)
+        except Exception:  # pylint: disable=broad-except
+            logging.error('Error while moving %s', rel, exc_info=True)
+            self.failed_files.append(rel)
+            if not verified:
+                # Copy missing or unreadable: export it again next time
+                with self.manifest_lock:
+                    self.manifest.pop(rel, None)
+
+    def verify_file(self, rel:str, size:int, crc:int=None) -> bool:
+        ''' Compare the copy on the device with the source (crc of the source if None) '''
+        if crc is None:
+            crc = self.crc32(os.path.join(self.source, rel))
+        with open(os.path.join(self.dest, rel), 'rb') as f:
+            # Make sure the data is read back from the device, not from the page cache
+            os.fsync(f.fileno())
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            dest_crc = 0
+            dest_size = 0
+            while True:
+                buf = f.read(COPY_BUFFER_SIZE)
+                if not buf:
+                    break
+                dest_crc = zlib.crc32(buf, dest_crc)
+                dest_size += len(buf)
+        return dest_size == size and dest_crc == crc
+
+    @staticmethod
+    def crc32(path:str) -> int:
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(COPY_BUFFER_SIZE)
+                if not buf:
+                    return crc
+                crc = zlib.crc32(buf, crc)
+
+    def update_status(self, force:bool=False):
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
             return None
-        self.transfered_size += int(size)
-        self.transfered_files.append(filename)
-        prct = 100 * (self.transfered_size / self.source_size)
-        self.percent.set(int(prct))
-        self.transfered_size_str.set(B_to_readable(self.transfered_size))
-        self.progress_value.set(self.transfered_size)
+        self._last_progress = now
+        prct = 100 * (self.transfered_size / self.source_size) if self.source_size else 100
+        post(self.percent, int(prct))
+        post(self.transfered_size_str, B_to_readable(self.transfered_size))
+        post(self.progress_value, self.transfered_size)
+        return None
 
     def status(self) -> float:
         ''' return None if not running, or percentage executed'''
         if not self.isrunning():
             return None
+        if not self.source_size:
+            return 0.0
         return round(self.transfered_size / self.source_size, 4)
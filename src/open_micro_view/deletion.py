@@ -0,0 +1,146 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import stat
+import threading
+import time
+from queue import Empty, Queue
+
+from .media_catalog import MediaCatalog
+from .tracing import span
+
+# Minimum delay between two progress messages (seconds)
+PROGRESS_INTERVAL = 0.1
+
+
+class DeletionProgress:
+    """ Progress message sent by the DeletionWorker """
+    __slots__ = ('files_deleted', 'files_total', 'bytes_freed', 'done', 'error')
+
+    def __init__(self, files_deleted:int, files_total:int, bytes_freed:int,
+                 done:bool=False, error:str=None):
+        self.files_deleted = files_deleted
+        self.files_total = files_total
+        self.bytes_freed = bytes_freed
+        self.done = done
+        self.error = error
+
+
+def delete_tree(name:str, parent_fd:int, stop_event:threading.Event=None, on_file=None):
+    ''' Remove directory name (relative to parent_fd) and its content.
+
+    Files are unlinked relatively to the opened directory, so no path is
+    resolved again for each of them. on_file(size) is called after each
+    unlink. Return False if interrupted by stop_event.
+    '''
+    fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=parent_fd)
+    try:
+        with os.scandir(fd) as it:
+            for f in it:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                if f.is_dir(follow_symlinks=False):
+                    if not delete_tree(f.name, fd, stop_event, on_file):
+                        return False
+                    continue
+                size = f.stat(follow_symlinks=False).st_size
+                os.unlink(f.name, dir_fd=fd)
+                if on_file is not None:
+                    on_file(size)
+    finally:
+        os.close(fd)
+    os.rmdir(name, dir_fd=parent_fd)
+    return True
+
+
+class DeletionWorker:
+    """ Delete media entries (pictures and timelapses) in a background thread.
+
+    Progress is reported through a thread-safe queue which the UI polls with
+    `poll()`, so no Tk call is ever made from the worker thread.
+    """
+    def __init__(self, catalog:MediaCatalog, names:list):
+        self.catalog = catalog
+        self.names = list(names)
+        self.progress = Queue()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.files_total = 0
+        self.files_deleted = 0
+        self.bytes_freed = 0
+        self._last_report = 0
+        for name in self.names:
+            entry = catalog.get(name)
+            self.files_total += entry.n_files if entry is not None else 1
+
+    def start(self):
+        self.thread = threading.Thread(name='deletionThread', target=self.run, args=())
+        self.thread.start()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def isrunning(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def poll(self) -> DeletionProgress:
+        ''' Return the latest progress message, or None if nothing new happened '''
+        msg = None
+        try:
+            while True:
+                msg = self.progress.get_nowait()
+        except Empty:
+            pass
+        return msg
+
+    def _report(self, done:bool=False, error:str=None):
+        now = time.monotonic()
+        if done or error or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress.put(DeletionProgress(self.files_deleted, self.files_total,
+                                               self.bytes_freed, done, error))
+
+    def _file_deleted(self, size:int):
+        self.files_deleted += 1
+        self.bytes_freed += size
+        self._report()
+
+    def run(self):
+        ''' @Threaded - Delete every entry, then update the catalog at once '''
+        logging.info('Deleting %d entries (%d files)...', len(self.names), self.files_total)
+        deleted = []
+        error = None
+        try:
+            root_fd = os.open(self.catalog.path, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            self._report(done=True, error=str(e))
+            return
+        try:
+            with span('delete entries', entries=len(self.names)):
+                for name in self.names:
+                    if self.stop_event.is_set():
+                        logging.warning('Deletion cancelled.')
+                        break
+                    try:
+                        with span('delete entry', entry=name):
+                            st = os.stat(name, dir_fd=root_fd, follow_symlinks=False)
+                            if stat.S_ISDIR(st.st_mode):
+                                if not delete_tree(name, root_fd, self.stop_event, self._file_deleted):
+                                    break
+                            else:
+                                os.unlink(name, dir_fd=root_fd)
+                                self._file_deleted(st.st_size)
+                        deleted.append(name)
+                    except FileNotFoundError:
+                        deleted.append(name)
+                    except OSError as e:
+                        logging.error('Impossible to delete %s', name, exc_info=True)
+                        error = f'{name}: {e.strerror}'
+        finally:
+            os.close(root_fd)
+            self.catalog.remove(deleted)
+            self.catalog.prune(deleted)
+        logging.info('%d files deleted, %d bytes freed.', self.files_deleted, self.bytes_freed)
+        self._report(done=True, error=error)
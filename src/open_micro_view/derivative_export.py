@@ -0,0 +1,224 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from .io_throttle import EXPORT_NICENESS, ExportThrottle
+from .media_catalog import MediaCatalog, is_media_file
+from .observable import int_var, str_var
+from .ui_dispatcher import post
+from .utils import B_to_readable
+
+# Minimum delay between two refresh of the Tk progress variables
+PROGRESS_INTERVAL = 0.1
+
+
+class ExportProfile:
+    """ Size, quality and format of exported derivatives """
+    def __init__(self, name:str, max_size:int=None, quality:int=85, fmt:str='JPEG'):
+        self.name = name
+        self.max_size = max_size  # Longest edge in pixels, None to keep the resolution
+        self.quality = quality
+        self.format = fmt
+
+    @property
+    def extension(self) -> str:
+        return {'JPEG': 'jpg', 'WEBP': 'webp'}[self.format]
+
+    def __repr__(self):
+        return f"ExportProfile({self.name!r}, {self.max_size}, {self.quality}, {self.format!r})"
+
+
+PROFILES = {p.name: p for p in (
+    ExportProfile('Share (1920px)', 1920, 80),
+    ExportProfile('Small (1280px)', 1280, 75),
+    ExportProfile('Preview (640px)', 640, 70),
+    ExportProfile('WebP (1920px)', 1920, 75, 'WEBP'),
+    ExportProfile('Recompressed', None, 75),
+)}
+
+
+def _init_worker():
+    # Exports must not take CPU time from the live view or timelapse captures
+    os.nice(EXPORT_NICENESS)
+
+
+def make_derivative(src:str, dst:str, max_size:int, quality:int, fmt:str, box:tuple=None) -> int:
+    ''' Write the derivative of src, cropped to box (full resolution pixels), to dst,
+    return its size in bytes '''
+    with Image.open(src) as img:
+        width = img.width
+        if max_size:
+            # JPEG: decode directly at a reduced scale when possible
+            img.draft('RGB', (max_size, max_size))
+        photo = img.convert('RGB')
+    if box is not None:
+        scale = photo.width / width
+        photo = photo.crop(tuple(round(v * scale) for v in box))
+    if max_size:
+        photo.thumbnail((max_size, max_size), Image.LANCZOS)
+    tmp = dst + '.part'
+    photo.save(tmp, fmt, quality=quality)
+    os.replace(tmp, dst)
+    return os.path.getsize(dst)
+
+
+def ordered_map(pool, fn, items, window:int, stop_event:threading.Event=None, key=None):
+    ''' Submit fn(*key(item)) to pool and yield (item, future) in submission order.
+
+    At most `window` tasks are pending at once, so results do not pile up in
+    memory and a cancellation (stop_event) only waits for the pending ones.
+    '''
+    pending = deque()
+    todo = iter(items)
+    while True:
+        while (stop_event is None or not stop_event.is_set()) and len(pending) < window:
+            item = next(todo, None)
+            if item is None:
+                break
+            args = key(item) if key is not None else (item,)
+            pending.append((item, pool.submit(fn, *args)))
+        if not pending:
+            return
+        yield pending.popleft()
+
+
+class DerivativeExporter():
+    """ Export downscaled and/or recompressed copies of the pictures.
+
+    Pictures are processed by a pool of processes (one per core), results are
+    collected in order so the progress always reflects a contiguous prefix of
+    the export.
+    """
+    def __init__(self, catalog:MediaCatalog, throttle:ExportThrottle=None):
+        self.catalog = catalog
+        self.throttle = throttle
+        self.profile:ExportProfile = PROFILES['Share (1920px)']
+        self.dest:str = None
+        self.entries:list = None
+        # Crop the frames of the timelapses whose drift was estimated
+        self.stabilize:bool = True
+        self.workers = os.cpu_count() or 1
+        self.percent = int_var()
+        self.progress_value = int_var()
+        self.transfered_size_str = str_var()
+
+        self.running = threading.Event()
+        self.stop_event = threading.Event()
+        self.total_files:int = 0
+        self.source_size:int = 0
+        self.transfered_size:int = 0
+        self.transfered_files:int = 0
+        self.failed_files:list = []
+        self._last_progress:float = 0
+
+    def isrunning(self) -> bool:
+        return self.running.is_set()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def target_dir(self) -> str:
+        name = ''.join(c if c.isalnum() else '_' for c in self.profile.name).strip('_')
+        return os.path.join(self.dest, f'Derivatives_{name}')
+
+    def tasks(self) -> list:
+        ''' Return (relative path, source, destination, source size, crop box) of the files to export '''
+        # pylint: disable=import-outside-toplevel
+        from .stabilization import stabilized_boxes
+        self.catalog.refresh()
+        entries = self.entries if self.entries is not None else self.catalog.entries()
+        target = self.target_dir()
+        tasks = []
+        for entry in entries:
+            boxes = None
+            if entry.is_timelapse and self.stabilize:
+                boxes = stabilized_boxes(os.path.join(self.catalog.path, entry.name))
+            for rel, size, _ in entry.files:
+                if not is_media_file(rel):
+                    continue  # Raw captures have no derivative
+                dst = os.path.join(target, os.path.splitext(rel)[0] + '.' + self.profile.extension)
+                if os.path.exists(dst):
+                    continue
+                box = boxes.get(os.path.basename(rel)) if boxes else None
+                tasks.append((rel, os.path.join(self.catalog.path, rel), dst, size, box))
+        return tasks
+
+    def execute(self) -> bool:
+        if self.isrunning():
+            logging.warning("The export is already on going.")
+            return False
+        self.running.set()
+        self.stop_event.clear()
+        try:
+            return self._execute()
+        finally:
+            self.running.clear()
+
+    def _execute(self) -> bool:
+        if self.throttle is not None:
+            self.throttle.stop_event = self.stop_event
+            self.throttle.lower_priority()
+        tasks = self.tasks()
+        self.total_files = len(tasks)
+        self.source_size = sum(t[3] for t in tasks)
+        self.transfered_files = 0
+        self.transfered_size = 0
+        self.failed_files = []
+        self.update_status(force=True)
+        logging.info('Exporting %d derivatives (%s, %s of originals) with %d workers',
+                     self.total_files, self.profile, B_to_readable(self.source_size), self.workers)
+        for d in sorted({os.path.dirname(t[2]) for t in tasks}):
+            os.makedirs(d, exist_ok=True)
+        p = self.profile
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker) as pool:
+                jobs = ordered_map(pool, make_derivative, tasks, 2 * self.workers, self.stop_event,
+                                   key=lambda t: (t[1], t[2], p.max_size, p.quality, p.format, t[4]))
+                for task, future in jobs:
+                    try:
+                        size = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception:  # pylint: disable=broad-except
+                        # Any error of a picture (e.g. Image.DecompressionBombError) only skips it
+                        logging.error('Impossible to export %s', task[0], exc_info=True)
+                        self.failed_files.append(task[0])
+                        continue
+                    if self.throttle is not None:
+                        self.throttle.throttle(nbytes=size, files=1)
+                    self.transfered_files += 1
+                    self.transfered_size += size
+                    self.update_status()
+        except BrokenProcessPool:
+            # A worker was killed (e.g. out of memory): the next pictures are not exported
+            logging.error('Derivatives export aborted after %d files.', self.transfered_files,
+                          exc_info=True)
+            self.failed_files.extend(t[0] for t in tasks[self.transfered_files + len(self.failed_files):])
+            self.update_status(force=True)
+            return False
+        self.update_status(force=True)
+        logging.info('Derivatives exported: %d files, %s.', self.transfered_files,
+                     B_to_readable(self.transfered_size))
+        return not self.stop_event.is_set()
+
+    def update_status(self, force:bool=False):
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return None
+        self._last_progress = now
+        done = self.transfered_files + len(self.failed_files)
+        prct = 100 * done / self.total_files if self.total_files else 100
+        post(self.percent, int(prct))
+        post(self.transfered_size_str, f'{done}/{self.total_files} - '
+                                       + B_to_readable(self.transfered_size))
+        post(self.progress_value, done)
+        return None
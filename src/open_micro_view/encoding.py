@@ -0,0 +1,253 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic
+
+import numpy as np
+from PIL import Image
+
+from .capture_process import CameraProxy, grab_array
+from .utils import B_to_readable, part_path
+
+# Format: (file extension, encoded by the GPU while capturing)
+FORMATS = {
+    'jpeg': ('jpg', True),
+    'png': ('png', True),
+    'webp': ('webp', False),
+    'rgb': ('npy', False),      # Raw RGB array (height, width, 3)
+    'yuv': ('yuv.npy', False),  # Raw YUV array (height, width, 3)
+}
+# Capture modes with their own encoding
+SNAPSHOT = 'snapshot'
+TIMELAPSE = 'timelapse'
+MODES = (SNAPSHOT, TIMELAPSE)
+# Threads encoding the formats not handled by the GPU (the encoders release the GIL)
+ENCODING_WORKERS = 2
+# Raw frames waiting for their encoding, captures wait above (bounds the memory used)
+MAX_PENDING = 4
+# Typical bytes per pixel, to estimate the size of the pictures before any capture
+BYTES_PER_PIXEL = {'jpeg': 0.5, 'png': 2.0, 'webp': 0.3, 'rgb': 3.0, 'yuv': 3.0}
+
+
+class Encoding:
+    """ Format and quality of the captured pictures """
+    def __init__(self, fmt:str='jpeg', quality:int=85, lossless:bool=False):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown format {fmt!r}, expected one of {list(FORMATS)}')
+        self.format = fmt
+        self.quality = min(max(int(quality), 1), 100)
+        self.lossless = lossless
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.format][0]
+
+    @property
+    def gpu(self) -> bool:
+        return FORMATS[self.format][1]
+
+    @property
+    def name(self) -> str:
+        if self.format == 'jpeg':
+            return f'JPEG {self.quality}'
+        if self.format == 'webp':
+            return 'WebP lossless' if self.lossless else f'WebP {self.quality}'
+        if self.format in ('rgb', 'yuv'):
+            return f'{self.format.upper()} (.npy)'
+        return self.format.upper()
+
+    def to_dict(self) -> dict:
+        return {'format': self.format, 'quality': self.quality, 'lossless': self.lossless}
+
+    @classmethod
+    def from_dict(cls, config:dict) -> 'Encoding':
+        return cls(config.get('format', 'jpeg'), config.get('quality', 85),
+                   bool(config.get('lossless', False)))
+
+    def __repr__(self):
+        return f"Encoding({self.name!r})"
+
+
+ENCODINGS = {e.name: e for e in (
+    Encoding('jpeg', 85),
+    Encoding('jpeg', 95),
+    Encoding('png'),
+    Encoding('webp', 80),
+    Encoding('webp', lossless=True),
+    Encoding('rgb'),
+    Encoding('yuv'),
+)}
+
+
+class FormatStats:
+    """ Size and latency (capture to file written) of the pictures of a format """
+    __slots__ = ('count', 'size', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.seconds = 0.0
+
+    def add(self, size:int, seconds:float):
+        self.count += 1
+        self.size += size
+        self.seconds += seconds
+
+    def __str__(self):
+        if not self.count:
+            return '-'
+        return (f'{self.count} x {B_to_readable(self.size / self.count)}, '
+                f'{1000 * self.seconds / self.count:.0f} ms')
+
+
+def capture_array(camera, fmt:str='rgb') -> np.ndarray:
+    ''' Raw still of the camera, possibly owned by the capture process '''
+    if isinstance(camera, CameraProxy):
+        return camera.capture_array(fmt)
+    return grab_array(camera, fmt)
+
+
+def write_array(array:np.ndarray, path:str, encoding:Encoding):
+    ''' Encode array to path (written to a temporary name, renamed once complete) '''
+    tmp = part_path(path)
+    if encoding.format == 'webp':
+        Image.fromarray(array).save(tmp, 'WEBP', quality=encoding.quality,
+                                    lossless=encoding.lossless)
+    else:
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+    os.replace(tmp, path)
+
+
+class Encoder:
+    """ Capture pictures with the encoding configured for each mode.
+
+    JPEG and PNG are encoded by the GPU of the camera. The other formats are
+    captured raw and encoded by a pool of threads, so that a timelapse can
+    go on while the previous frame is being written. Statistics are kept
+    per encoding to compare the storage and time spent by each of them.
+    """
+    def __init__(self, config:dict=None):
+        self.modes = {mode: Encoding() for mode in MODES}
+        self.stats:dict = {}
+        self.lock = threading.Lock()
+        # Path: (future, raw frame) of the pictures being encoded
+        self.pending:dict = {}
+        self.slots = threading.BoundedSemaphore(MAX_PENDING)
+        self._pool:ThreadPoolExecutor = None
+        if config:
+            self.load(config)
+
+    def load(self, config:dict):
+        ''' Apply the 'encoding' section of the configuration: {mode: encoding dict} '''
+        for mode in MODES:
+            if mode in config:
+                try:
+                    self.modes[mode] = Encoding.from_dict(config[mode])
+                except (ValueError, TypeError, AttributeError):
+                    logging.error('Invalid %s encoding: %s', mode, config[mode], exc_info=True)
+
+    def get_config(self) -> dict:
+        return {mode: encoding.to_dict() for mode, encoding in self.modes.items()}
+
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=ENCODING_WORKERS,
+                                            thread_name_prefix='encoder')
+        return self._pool
+
+    def capture(self, camera, path:str, mode:str=SNAPSHOT) -> str:
+        ''' Capture a picture to path, its extension replaced by the one of the format.
+        Return the path of the picture, which may still be encoded (see wait()) '''
+        encoding = self.modes[mode]
+        folder, name = os.path.split(path)
+        path = os.path.join(folder, name.split('.', 1)[0] + '.' + encoding.extension)
+        start = monotonic()
+        if encoding.gpu:
+            options = {'quality': encoding.quality} if encoding.format == 'jpeg' else {}
+            camera.capture(path, encoding.format, **options)
+            self._record(encoding, path, start)
+            return path
+        array = capture_array(camera, 'yuv' if encoding.format == 'yuv' else 'rgb')
+        self.slots.acquire()
+        with self.lock:
+            future = Future()
+            self.pending[path] = (future, array)
+        try:
+            self.pool().submit(self._encode, array, path, encoding, start, future)
+        except RuntimeError:
+            # Pool shut down: encoded here
+            self._encode(array, path, encoding, start, future)
+        return path
+
+    def _encode(self, array:np.ndarray, path:str, encoding:Encoding, start:float, future:Future):
+        try:
+            write_array(array, path, encoding)
+            self._record(encoding, path, start)
+            future.set_result(path)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error('Impossible to encode %s', path, exc_info=True)
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+            self.slots.release()
+
+    def _record(self, encoding:Encoding, path:str, start:float):
+        seconds = monotonic() - start
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            self.stats.setdefault(encoding.name, FormatStats()).add(size, seconds)
+        logging.debug('%s: %s in %.0f ms (%s)', os.path.basename(path), B_to_readable(size),
+                      1000 * seconds, encoding.name)
+
+    def wait(self, path:str=None, timeout:float=None):
+        ''' Wait until path (default: every pending picture) is written '''
+        with self.lock:
+            if path is None:
+                futures = [future for future, _ in self.pending.values()]
+            else:
+                futures = [self.pending[path][0]] if path in self.pending else []
+        for future in futures:
+            try:
+                future.result(timeout)
+            except Exception:  # pylint: disable=broad-except
+                pass  # Already logged
+
+    def preview(self, path:str) -> Image.Image:
+        ''' RGB image of a picture captured by capture(), read from memory if still encoded '''
+        with self.lock:
+            array = self.pending[path][1] if path in self.pending else None
+        if array is None and path.endswith('.npy'):
+            array = np.load(path)
+        if array is None:
+            with Image.open(path) as img:
+                return img.convert('RGB')
+        if path.endswith('.yuv.npy'):
+            return Image.fromarray(array, 'YCbCr').convert('RGB')
+        return Image.fromarray(array)
+
+    def frame_size(self, mode:str, resolution:tuple) -> int:
+        ''' Expected size of a picture of mode: average of the previous ones, else an estimate '''
+        encoding = self.modes[mode]
+        with self.lock:
+            stats = self.stats.get(encoding.name)
+            if stats is not None and stats.count:
+                return stats.size // stats.count
+        return int(resolution[0] * resolution[1] * BYTES_PER_PIXEL[encoding.format])
+
+    def summary(self) -> str:
+        with self.lock:
+            return ' - '.join(f'{name}: {stats}' for name, stats in self.stats.items())
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
@@ -0,0 +1,219 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty, Queue
+
+import numpy as np
+from PIL import Image
+
+from .derivative_export import ordered_map
+from .io_throttle import EXPORT_NICENESS
+from .media_catalog import IMG_EXTENSIONS
+from .tracing import span
+
+# Sidecar of the timelapse directory (hidden files are not media, see MediaCatalog)
+STATS_FILE = '.omv_stats.npy'
+# Longest edge of the frames decoded for the statistics
+STATS_SIZE = 320
+# Frames per task: each task decodes the frame before its chunk again for the difference
+CHUNK = 16
+# One row per frame: mean of each channel, percentiles of the luminance,
+# focus (variance of the Laplacian) and mean absolute difference with the previous frame
+FIELDS = ('mean_r', 'mean_g', 'mean_b', 'p5', 'p50', 'p95', 'focus', 'diff')
+STATS_DTYPE = np.dtype([(f, '<f4') for f in FIELDS])
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+# Minimum delay between two progress messages (seconds)
+PROGRESS_INTERVAL = 0.1
+
+
+def _init_worker():
+    # Statistics must not take CPU time from the live view or timelapse captures
+    os.nice(EXPORT_NICENESS)
+
+
+def frame_files(path:str) -> list:
+    ''' Frames of a timelapse directory, in capture order '''
+    return sorted(f for f in os.listdir(path) if f.split('.')[-1] in IMG_EXTENSIONS)
+
+
+def load_rgb(path:str, size:int = STATS_SIZE) -> np.ndarray:
+    ''' Frame as a float32 (height, width, 3) array, longest edge at most size '''
+    with Image.open(path) as img:
+        # JPEG: decoded directly at a reduced scale
+        img.draft('RGB', (size, size))
+        photo = img.convert('RGB')
+    photo.thumbnail((size, size), Image.BILINEAR)
+    return np.asarray(photo, dtype=np.float32)
+
+
+def load_gray(path:str, size:int = STATS_SIZE) -> np.ndarray:
+    ''' Luminance of a frame as a float32 (height, width) array, longest edge at most size '''
+    return load_rgb(path, size) @ LUMA
+
+
+def compute_stats(paths:list, previous:str = None, size:int = STATS_SIZE) -> np.ndarray:
+    ''' Statistics (STATS_DTYPE) of the frames paths, previous being the frame before them '''
+    stats = np.full(len(paths), np.nan, dtype=STATS_DTYPE)
+    last = None
+    if previous is not None:
+        try:
+            last = load_gray(previous, size)
+        except (OSError, ValueError):
+            pass
+    for i, path in enumerate(paths):
+        try:
+            rgb = load_rgb(path, size)
+        except (OSError, ValueError):
+            last = None
+            continue
+        row = stats[i]
+        row['mean_r'], row['mean_g'], row['mean_b'] = rgb.reshape(-1, 3).mean(axis=0)
+        gray = rgb @ LUMA
+        row['p5'], row['p50'], row['p95'] = np.percentile(gray, (5, 50, 95))
+        laplacian = (4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1]
+                     - gray[1:-1, :-2] - gray[1:-1, 2:])
+        row['focus'] = laplacian.var()
+        if last is not None and last.shape == gray.shape:
+            row['diff'] = np.abs(gray - last).mean()
+        last = gray
+    return stats
+
+
+def read_sidecar(path:str, name:str, dtype:np.dtype) -> np.ndarray:
+    ''' Per-frame array saved as name in the timelapse directory path, None if missing '''
+    try:
+        rows = np.load(os.path.join(path, name), allow_pickle=False)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logging.warning('Invalid %s in %s', name, path, exc_info=True)
+        return None
+    return rows if rows.dtype == dtype else None
+
+
+def write_sidecar(path:str, name:str, rows:np.ndarray):
+    tmp = os.path.join(path, name + '.part')
+    with open(tmp, 'wb') as f:
+        np.save(f, rows, allow_pickle=False)
+    os.replace(tmp, os.path.join(path, name))
+
+
+def read_stats(path:str) -> np.ndarray:
+    ''' Statistics of the timelapse directory path, None if not computed yet '''
+    return read_sidecar(path, STATS_FILE, STATS_DTYPE)
+
+
+class StatsProgress:
+    """ Progress message sent by the FrameStatsJob """
+    __slots__ = ('frames_done', 'frames_total', 'done', 'error')
+
+    def __init__(self, frames_done:int, frames_total:int, done:bool=False, error:str=None):
+        self.frames_done = frames_done
+        self.frames_total = frames_total
+        self.done = done
+        self.error = error
+
+
+class FrameStatsJob:
+    """ Compute the statistics of every frame of a timelapse in the background.
+
+    Frames are decoded at a reduced size (STATS_SIZE) by a pool of processes,
+    CHUNK frames per task, and the statistics are saved as a small structured
+    array next to the frames (STATS_FILE, one row per frame). Frames already
+    processed are kept: a growing or interrupted timelapse only gets its new
+    frames computed. Subclasses compute other per-frame results by changing
+    the function, its arguments (task_args) and the sidecar.
+    """
+    NAME = 'statistics'
+    SIDECAR = STATS_FILE
+    DTYPE = STATS_DTYPE
+    # Run in the pool on each chunk, returns one DTYPE row per frame
+    function = staticmethod(compute_stats)
+
+    def __init__(self, path:str, workers:int = None):
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.progress = Queue()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.results:np.ndarray = None
+        self.frames_total = 0
+        self.frames_done = 0
+        self._last_report = 0
+
+    def start(self):
+        self.thread = threading.Thread(name='frameStats', target=self.run, args=())
+        self.thread.start()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def isrunning(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def poll(self) -> StatsProgress:
+        ''' Return the latest progress message, or None if nothing new happened '''
+        msg = None
+        try:
+            while True:
+                msg = self.progress.get_nowait()
+        except Empty:
+            pass
+        return msg
+
+    def _report(self, done:bool=False, error:str=None):
+        now = time.monotonic()
+        if done or error or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress.put(StatsProgress(self.frames_done, self.frames_total, done, error))
+
+    def task_args(self, files:list, start:int) -> tuple:
+        ''' Arguments of function for the chunk of files starting at start '''
+        return files[start:start + CHUNK], files[start - 1] if start else None
+
+    def run(self) -> bool:
+        ''' @Threaded - Compute the results of the frames not processed yet '''
+        try:
+            files = [os.path.join(self.path, f) for f in frame_files(self.path)]
+        except OSError as e:
+            logging.error('Impossible to list %s', self.path, exc_info=True)
+            self._report(done=True, error=str(e))
+            return False
+        previous = read_sidecar(self.path, self.SIDECAR, self.DTYPE)
+        known = len(previous) if previous is not None and len(previous) <= len(files) else 0
+        self.frames_total = len(files)
+        self.frames_done = known
+        chunks = [self.task_args(files, i) for i in range(known, len(files), CHUNK)]
+        results = [previous[:known]] if known else []
+        logging.info('%s of %s: %d frames, %d to compute.', self.NAME.capitalize(), self.path,
+                     len(files), len(files) - known)
+        error = None
+        with span(f'frame {self.NAME}', frames=len(files) - known), \
+                ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker) as pool:
+            jobs = ordered_map(pool, self.function, chunks, 2 * self.workers, self.stop_event,
+                               key=lambda chunk: chunk)
+            for (paths, _), future in jobs:
+                try:
+                    results.append(future.result())
+                except Exception as e:  # pylint: disable=broad-except
+                    # Results of the next frames would be shifted: stop here
+                    logging.error('Impossible to compute the %s of %s', self.NAME, paths[0],
+                                  exc_info=True)
+                    error = str(e)
+                    break
+                self.frames_done += len(paths)
+                self._report()
+        self.results = np.concatenate(results) if results else np.empty(0, dtype=self.DTYPE)
+        if len(self.results) > known:
+            try:
+                write_sidecar(self.path, self.SIDECAR, self.results)
+            except OSError as e:
+                logging.error('Impossible to save the %s of %s', self.NAME, self.path, exc_info=True)
+                error = error or str(e)
+        self._report(done=True, error=error)
+        return error is None and not self.stop_event.is_set()
@@ -0,0 +1,266 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import argparse
+import json as Json
+import logging
+import math
+import os
+import signal
+import threading
+from datetime import datetime
+from functools import partial
+from time import monotonic
+
+from .media_catalog import entry_dir
+from .observable import set_headless
+
+# Job types and their options, given on the command line or in a job file:
+#   snapshot   [path] [light]
+#   timelapse  interval (s) [count] [duration (s)] [light]
+#   export     kind (copy, move, archive, derivatives, movie) [dest] [profile]
+#              [timelapse] [fps] [max_size] [since] [until] (archive: YYYY-MM-DD)
+#   migrate    (moves the pictures to YYYY/MM/DD directories)
+JOB_TYPES = ['snapshot', 'timelapse', 'export', 'migrate']
+EXPORT_KINDS = ['copy', 'move', 'archive', 'derivatives', 'movie']
+# Export progress is logged every x percent
+PROGRESS_STEP = 10
+
+
+def load_jobs(path:str) -> list:
+    ''' Read a JSON job file: a list of jobs, or {"jobs": [...]} '''
+    with open(path, 'r') as f:
+        jobs = Json.loads(f.read())
+    if isinstance(jobs, dict):
+        jobs = jobs.get('jobs', [])
+    for job in jobs:
+        if job.get('job') not in JOB_TYPES:
+            raise ValueError(f"Unknown job {job.get('job')!r}, expected one of {JOB_TYPES}")
+    return jobs
+
+
+class Acquisition:
+    """ Run snapshot, timelapse and export jobs without display.
+
+    The camera runs without live preview and the state usually shown by the
+    UI (light, exporters progress...) is kept in plain observable values, so
+    that no Tk interpreter is needed. Jobs run one after the other, until the
+    end of the list or until stop() (e.g. on SIGTERM).
+    """
+    def __init__(self):
+        # pylint: disable=import-outside-toplevel
+        from .microscope import Microscope
+        self.microscope = Microscope(None, None, preview=False)
+        self.light = self.microscope.light
+        self.camera = self.microscope.camera
+        self.stop_event = threading.Event()
+        self.exporter = None
+
+    def stop(self, *_):
+        ''' Signal handler: interrupt the current job and skip the next ones '''
+        logging.warning('Stop requested, ending the current job...')
+        self.stop_event.set()
+        if self.exporter is not None:
+            self.exporter.cancel()
+
+    def close(self):
+        self.microscope.close()
+
+    def run(self, jobs:list) -> bool:
+        ''' Run jobs in order, return False if one of them failed or was interrupted '''
+        # pylint: disable=import-outside-toplevel
+        from picamera.exc import PiCameraError
+        self.microscope.start_telemetry()
+        success = True
+        for i, job in enumerate(jobs):
+            if self.stop_event.is_set():
+                return False
+            logging.info('Job %d/%d: %s', i + 1, len(jobs), job)
+            try:
+                result = getattr(self, job['job'])(**{k: v for k, v in job.items() if k != 'job'})
+            except (OSError, KeyError, ValueError, TypeError, RuntimeError, PiCameraError):
+                logging.error('Job %d failed.', i + 1, exc_info=True)
+                result = False
+            success = success and result is not False
+        return success and not self.stop_event.is_set()
+
+    # JOBS
+    def snapshot(self, path:str=None, light:float=None) -> str:
+        previous = self.light.get_brightness() * 100
+        if light is not None:
+            self.light.set_brightness(light)
+        try:
+            return self.camera.capture(path)
+        finally:
+            self.light.set_brightness(previous)
+
+    def timelapse(self, interval:float, count:int=0, duration:float=0, light:float=None) -> str:
+        ''' Capture a picture every interval seconds, count pictures or for duration (0: until stopped) '''
+        # pylint: disable=import-outside-toplevel
+        from picamera.exc import PiCameraRuntimeError
+
+        from .encoding import TIMELAPSE
+        from .timelapse import AUTOLIGHT_INTERVAL, MIN_INTERVAL_AUTOLIGHT, space_check
+        from .utils import B_to_readable
+        frames = count or (math.ceil(duration / interval) if duration else 0)
+        free, frame, enough = space_check(self.microscope, frames)
+        if not enough:
+            logging.warning('Only %s free, room for about %d frames of %s.', B_to_readable(free),
+                            free // frame, B_to_readable(frame))
+        begin = datetime.now()
+        path = os.path.join(entry_dir(self.camera.get_image_path(), begin),
+                            f"TL_{begin.strftime(r'%Y-%m-%d_%H-%M-%S')}")
+        os.mkdir(path)
+        brightness = light if light is not None else self.light.get_brightness() * 100
+        # The light is only switched on around the captures of long intervals
+        autolight = interval > MIN_INTERVAL_AUTOLIGHT
+        self.light.set_brightness(0 if autolight else brightness)
+        logging.info('Timelapse in %s: every %s s, %s pictures, %s s', path, interval,
+                     count or '∞', duration or '∞')
+        staging = self.microscope.staging
+        start = monotonic()
+        n = 0
+        try:
+            while not self.stop_event.is_set():
+                due = start + n * interval
+                if (count and n >= count) or (duration and due - start >= duration):
+                    break
+                if autolight:
+                    if self.stop_event.wait(max(0, due - AUTOLIGHT_INTERVAL - monotonic())):
+                        break
+                    self.light.set_brightness(brightness)
+                if self.stop_event.wait(max(0, due - monotonic())):
+                    break
+                filename = datetime.now().strftime(r'%Y-%m-%d_%H-%M-%S')
+                try:
+                    if staging is None:
+                        self.camera.capture(os.path.join(path, filename), TIMELAPSE)
+                    else:
+                        staging.commit(self.camera.capture(staging.stage(os.path.join(path, filename)),
+                                                           TIMELAPSE))
+                except PiCameraRuntimeError:
+                    logging.error("Impossible to capture picture %s", filename, exc_info=True)
+                n += 1
+                if autolight:
+                    self.light.set_brightness(0)
+        finally:
+            self.light.set_brightness(brightness)
+            self.camera.encoder.wait()
+            if staging is not None:
+                staging.request_flush()
+        logging.info('Timelapse ended: %d pictures in %s.', n, path)
+        logging.info('Encoding: %s', self.camera.encoder.summary())
+        return path
+
+    def export(self, kind:str, dest:str=None, profile:str=None, timelapse=None,
+               fps:float=None, max_size:int=None, since:str=None, until:str=None) -> bool:
+        ''' timelapse: the timelapse of a movie, or the timelapse(s) to archive '''
+        # pylint: disable=import-outside-toplevel
+        catalog = self.microscope.catalog
+        if kind not in EXPORT_KINDS:
+            raise ValueError(f"Unknown export {kind!r}, expected one of {EXPORT_KINDS}")
+        if kind != 'movie' and not dest:
+            raise ValueError(f"The {kind} export needs a destination (dest)")
+        if kind in ('copy', 'move'):
+            from .copy_manager import CopyManager
+            exporter = CopyManager(catalog)
+            exporter.source = self.camera.get_image_path()
+            exporter.dest = dest
+            execute = partial(exporter.execute, move=(kind == 'move'))
+        elif kind == 'archive':
+            from .archive_export import ArchiveExporter, parse_date
+            exporter = ArchiveExporter(catalog)
+            exporter.dest = dest
+            exporter.start = parse_date(since)
+            exporter.end = parse_date(until, end=True)
+            if timelapse:
+                exporter.timelapses = [timelapse] if isinstance(timelapse, str) else list(timelapse)
+            execute = exporter.execute
+        elif kind == 'derivatives':
+            from .derivative_export import PROFILES, DerivativeExporter
+            exporter = DerivativeExporter(catalog)
+            if profile is not None:
+                exporter.profile = PROFILES[profile]
+            exporter.dest = dest
+            execute = exporter.execute
+        else:
+            from .movie_export import MovieExporter
+            if not timelapse:
+                raise ValueError('The movie export needs a timelapse')
+            exporter = MovieExporter(catalog)
+            exporter.timelapse = timelapse
+            exporter.dest = dest
+            exporter.fps = fps or exporter.fps
+            exporter.max_size = max_size
+            execute = exporter.execute
+        exporter.percent.subscribe(self._log_progress(kind))
+        self.exporter = exporter
+        try:
+            return execute()
+        finally:
+            self.exporter = None
+
+    def migrate(self) -> bool:
+        ''' Switch the media folder to the date layout, moving the existing entries '''
+        # pylint: disable=import-outside-toplevel
+        from .media_migration import LayoutMigration
+        migration = LayoutMigration(self.microscope.catalog)
+        # Cancelled by stop(), as the exports
+        self.exporter = migration
+        try:
+            return migration.run()
+        finally:
+            self.exporter = None
+
+    def _log_progress(self, kind:str):
+        last = [-PROGRESS_STEP]
+
+        def log(percent:int):
+            if percent >= last[0] + PROGRESS_STEP or percent == 100:
+                last[0] = percent
+                logging.info('Export (%s): %d%%', kind, percent)
+        return log
+
+
+def parse_args(argv:list=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='start_headless.py',
+                                     description='OpenMicroView acquisition without display')
+    sub = parser.add_subparsers(dest='job', required=True)
+    p = sub.add_parser('snapshot', help='capture a single picture')
+    p.add_argument('--path', help='output file (default: dated, in the pictures folder)')
+    p.add_argument('--light', type=float, help='light brightness (0-100)')
+    p = sub.add_parser('timelapse', help='capture a timelapse')
+    p.add_argument('interval', type=float, help='seconds between two pictures')
+    p.add_argument('--count', type=int, default=0, help='number of pictures (default: no limit)')
+    p.add_argument('--duration', type=float, default=0, help='seconds (default: no limit)')
+    p.add_argument('--light', type=float, help='light brightness (0-100)')
+    p = sub.add_parser('export', help='export the pictures')
+    p.add_argument('kind', choices=EXPORT_KINDS)
+    p.add_argument('--dest', help='destination directory')
+    p.add_argument('--profile', help='derivatives profile')
+    p.add_argument('--timelapse', help='timelapse directory (movie, archive)')
+    p.add_argument('--fps', type=float)
+    p.add_argument('--max-size', dest='max_size', type=int)
+    p.add_argument('--since', help='archive the entries captured from this date (YYYY-MM-DD)')
+    p.add_argument('--until', help='archive the entries captured until this date (YYYY-MM-DD)')
+    sub.add_parser('migrate', help='organize the pictures in YYYY/MM/DD directories')
+    p = sub.add_parser('run', help='run the jobs of a JSON job file')
+    p.add_argument('jobs', help='job file: [{"job": "timelapse", "interval": 60, ...}, ...]')
+    return parser.parse_args(argv)
+
+
+def main(argv:list=None) -> int:
+    args = parse_args(argv)
+    if args.job == 'run':
+        jobs = load_jobs(args.jobs)
+    else:
+        jobs = [{k: v for k, v in vars(args).items() if v is not None}]
+    # Plain values instead of Tk variables: no display needed
+    set_headless()
+    acquisition = Acquisition()
+    signal.signal(signal.SIGTERM, acquisition.stop)
+    signal.signal(signal.SIGINT, acquisition.stop)
+    try:
+        return 0 if acquisition.run(jobs) else 1
+    finally:
+        acquisition.close()
@@ -0,0 +1,96 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+from datetime import datetime
+from math import cos, radians
+
+from .media_catalog import entry_dir
+from .microscope_camera import Camera
+from .microscope_light import LED_COUNT, Light
+
+# LED layout (7 LEDs "jewel"): LED 0 in the center, 1 to 6 on the ring, every 60°
+CENTER_LED = 0
+RING_LEDS = list(range(1, LED_COUNT))
+
+
+def ring_angle(led:int) -> float:
+    return 60 * (led - RING_LEDS[0])
+
+
+class Pattern:
+    """ Illumination pattern: weight (0 to 1) of each LED, and an optional colour.
+
+    Without colour, the current colour of the light is used.
+    """
+    def __init__(self, name:str, weights:list, color:dict=None):
+        self.name = name
+        self.weights = weights
+        self.color = color
+
+    def buffer(self, light:Light) -> list:
+        ''' Return the pixel values of the pattern, in the order of the strip '''
+        colors = self.color if self.color is not None else light.get_colors()
+        pixel = tuple(int(colors.get(c, 0)) for c in 'grbw')
+        return [tuple(round(v * w) for v in pixel) for w in self.weights]
+
+    def __repr__(self):
+        return f"Pattern({self.name!r})"
+
+
+def _weights(leds) -> list:
+    return [1 if i in leds else 0 for i in range(LED_COUNT)]
+
+
+def oblique(angle:float) -> Pattern:
+    ''' Light the 3 ring LEDs around angle (60° at most from it) '''
+    leds = [i for i in RING_LEDS if cos(radians(ring_angle(i) - angle)) > 0.49]
+    return Pattern(f'Oblique {angle}°', _weights(leds))
+
+
+PATTERNS = {p.name: p for p in [
+    Pattern('Brightfield', _weights(range(LED_COUNT))),
+    Pattern('Darkfield', _weights(RING_LEDS)),
+    *(oblique(a) for a in range(0, 360, 60)),
+    *(Pattern(f'LED {i}', _weights([i])) for i in range(LED_COUNT)),
+    Pattern('Red', _weights(range(LED_COUNT)), {'r': 255}),
+    Pattern('Green', _weights(range(LED_COUNT)), {'g': 255}),
+    Pattern('Blue', _weights(range(LED_COUNT)), {'b': 255}),
+]}
+
+# Patterns captured by each sequence, in order
+SEQUENCES = {
+    'Brightfield + Darkfield': ['Brightfield', 'Darkfield'],
+    'Oblique (6 directions)': [f'Oblique {a}°' for a in range(0, 360, 60)],
+    'Single LEDs': [f'LED {i}' for i in range(LED_COUNT)],
+    'Colour channels (RGB)': ['Red', 'Green', 'Blue'],
+}
+
+
+def pattern_suffix(name:str) -> str:
+    return ''.join(c if c.isalnum() else '-' for c in name.replace('°', '')).strip('-')
+
+
+def capture_sequence(light:Light, camera:Camera, sequence:str, path:str=None,
+                     lock_exposure:bool=True) -> list:
+    ''' Capture one picture per pattern of sequence, return the files written.
+
+    Pixel buffers are computed before the first capture, so switching the
+    pattern between two frames is a single write to the strip. Pictures are
+    named after the date of the sequence and the pattern.
+    '''
+    patterns = [PATTERNS[name] for name in SEQUENCES[sequence]]
+    buffers = [p.buffer(light) for p in patterns]
+    now = datetime.now()
+    path = path or entry_dir(camera.get_image_path(), now)
+    stamp = now.strftime(r'%Y-%m-%d_%H-%M-%S')
+    files = [os.path.join(path, f'{stamp}_{pattern_suffix(p.name)}.jpg') for p in patterns]
+    logging.info("Capturing sequence '%s' (%d patterns)", sequence, len(patterns))
+    try:
+        camera.capture_sequence(files, lambda i: light.show_buffer(buffers[i]),
+                                lock_exposure=lock_exposure)
+    finally:
+        # Back to the normal illumination
+        light.reload(force=True)
+    return files
@@ -3,16 +3,26 @@
 
 import logging
 import os
-import shutil
-from functools import cmp_to_key, partial
-from tkinter import (FLAT, GROOVE, Button, Frame, Label, PhotoImage, StringVar,
-                     TclError, ttk)
+import threading
+from functools import partial
+from typing import Callable
+from tkinter import (FLAT, GROOVE, Button, Canvas, Frame, IntVar, Label, PhotoImage,
+                     StringVar, TclError, ttk)
 
+import numpy as np
 from PIL import Image, ImageTk
 
 from .assets.icons import PAUSE_ICON, PLAY_ICON, TRASH_ICON, icon_button
-from .timelapse_loader import IMG_EXTENSIONS, TimelapseLoader
-from .utils import (B_to_MB, B_to_readable, create_popup, dir_size_bytes,
+from .deletion import DeletionWorker
+from .frame_stats import FrameStatsJob, read_stats
+from .io_throttle import ExportThrottle
+from .media_catalog import IMG_EXTENSIONS, MediaCatalog
+from .movie_export import FPS_CHOICES, SIZE_CHOICES, MovieExporter
+from .stabilization import StabilizationJob, drift_range
+from .tile_viewer import TileViewer
+from .timelapse_loader import TimelapseLoader
+from .tracing import span
+from .utils import (B_to_MB, B_to_readable, create_popup, create_progress_popup,
                     seconds_to_readable)
 
 
@@ -27,9 +37,16 @@ class ImageBrowser():
                 |- PhotoImage
     '''
 
-    def __init__(self, path:str):
+    def __init__(self, path:str, catalog:MediaCatalog=None, throttle:ExportThrottle=None,
+                 running:Callable=None):
         self.max_w, self.max_h = 700, 350
         self.path:str = path
+        self.catalog:MediaCatalog = catalog if catalog is not None else MediaCatalog(path)
+        self.deletions:list = []
+        # Directory of the timelapse being captured, never deleted
+        self.running:Callable = running
+        self.movie_exporter = MovieExporter(self.catalog, throttle)
+        self.movie_thread:threading.Thread = None
         self.img_list:list = None
         self.frame:Frame = None
         self.root = None
@@ -40,6 +57,7 @@ class ImageBrowser():
         self.load_tl_btn:ttk.Button = None
         self.timelapse_loader:TimelapseLoader = None
         self.timelapse_fps:int = 5
+        self.stats_job:FrameStatsJob = None
         # TKinter Variales
         self.tk_file_info:StringVar = StringVar()
         self.tk_filename:StringVar = StringVar()
@@ -49,6 +67,10 @@ class ImageBrowser():
     def quit(self) -> None:
         if self.timelapse_loader:
             self.timelapse_loader.quit()
+        if self.movie_exporter.isrunning():
+            self.movie_exporter.cancel()
+        if self.stats_job is not None and self.stats_job.isrunning():
+            self.stats_job.cancel()
         if self.frame:
             self.frame.destroy()
             self.frame = None
@@ -59,18 +81,11 @@ class ImageBrowser():
         self.current_image_path = None
         return None
 
-    def compare_file_creation_date(self, f1:str, f2:str) -> float:
-        t1 = os.path.getctime(os.path.join(self.path, f1))
-        t2 = os.path.getctime(os.path.join(self.path, f2))
-        return t2 - t1
-
     def start(self):
         logging.info('Starting picture browser')
         try:
-            self.img_list = [f for f in os.listdir(self.path)
-                             if f.split('.')[-1] in IMG_EXTENSIONS or f[0:3] == 'TL_']
-            self.img_list = sorted(self.img_list,
-                                   key=cmp_to_key(self.compare_file_creation_date))
+            self.catalog.refresh()
+            self.img_list = [e.name for e in self.catalog.entries()]
         except OSError as e:
             create_popup(close_btn='Ok',
                          text=f'Error: impossible to read directory:\n"{self.path}",\n{str(e)}')
@@ -134,18 +149,35 @@ class ImageBrowser():
         return self.frame
 
     def delete_picture(self):
-        try:
-            full_path = self.current_image_path
-            if os.path.isfile(full_path):
-                os.remove(full_path)
-                self.img_list.pop(self.current_index)
-            elif os.path.isdir(full_path):
-                shutil.rmtree(full_path)
-                self.img_list.pop(self.current_index)
-        except OSError as e:
-            create_popup("ok", f'An error occured :\n{str(e)}')
-        finally:
-            self.update_picture(self.current_index, force=True)
+        running = self.running() if self.running is not None else None
+        name = self.img_list[self.current_index]
+        if running and os.path.normpath(os.path.join(self.path, name)) == os.path.normpath(running):
+            create_popup(close_btn='Ok', text='This timelapse is being captured.',
+                         raise_over=self.frame)
+            return
+        if self.timelapse_loader:
+            self.timelapse_loader.quit()
+            self.timelapse_loader = None
+        name = self.img_list.pop(self.current_index)
+        # Delete in background, large timelapses would freeze the UI
+        worker = DeletionWorker(self.catalog, [name])
+        worker.start()
+        self.deletions.append(worker)
+        self.frame.after(200, self.check_deletions)
+        self.update_picture(self.current_index, force=True)
+
+    def check_deletions(self):
+        ''' Report errors of background deletions, until all of them are finished '''
+        for worker in list(self.deletions):
+            progress = worker.poll()
+            if progress is not None and progress.done:
+                self.deletions.remove(worker)
+                if progress.error:
+                    create_popup("ok", f'An error occured :\n{progress.error}')
+            elif not worker.isrunning() and worker.progress.empty():
+                self.deletions.remove(worker)
+        if self.deletions and self.frame is not None:
+            self.frame.after(200, self.check_deletions)
 
     def clear_picture_frame(self):
         if self.current_image is not None:
@@ -195,7 +227,7 @@ class ImageBrowser():
         ttk.Scale(timelapse_toolbar,
                   from_=0, to=self.timelapse_loader.total_frames - 1,
                   variable=self.timelapse_loader.tk_player_index,
-                  command=(lambda v: self.timelapse_loader.pause(True))
+                  command=self.timelapse_loader.seek
                   ).grid(column=2, row=0, columnspan=8, sticky='news', padx=5)
 
         self.timelapse_loader.play(self.current_image)
@@ -207,7 +239,8 @@ class ImageBrowser():
     def prompt_timelapse(self):
         dirname = self.img_list[self.current_index]
         fullpath = os.path.join(self.path, dirname)
-        size = dir_size_bytes(fullpath)
+        entry = self.catalog.get(dirname)
+        size = entry.size if entry is not None else 0
         self.clear_picture_frame()
         frame = Frame(self.image_frame, background='white', borderwidth=2)
         frame.pack(fill='both', expand=True, padx=20, pady=30)
@@ -223,15 +256,29 @@ class ImageBrowser():
         text = (f'Do you want to load the timelapse {dirname} of size {B_to_readable(size)} ?\n'
                 + f'This operation may take some time (ETA: ~ {estimation}).')
         ttk.Label(frame, text=text, justify='center').pack(expand=True, pady=5)
-        load_tl = ttk.Button(frame, text="Load Timelapse", style='config.TButton',
+        # Brightness, focus and frame-to-frame change over the whole run
+        plot = Canvas(frame, width=400, height=90, background='white', highlightthickness=0)
+        plot.pack(expand=True, pady=5)
+        stats = read_stats(fullpath)
+        if stats is not None:
+            self.draw_stats(plot, stats)
+        buttons = Frame(frame, background='white')
+        buttons.pack(side='bottom', expand=True, pady=10)
+        load_tl = ttk.Button(buttons, text="Load Timelapse", style='config.TButton',
                              command=partial(self.load_timelapse, fullpath))
-        load_tl.pack(side='bottom', expand=True, pady=10)
-
-        try:
-            n_frames = f' - {len(os.listdir(fullpath))} frames'
-            self.tk_file_info.set(self.tk_file_info.get() + n_frames)
-        except OSError:
-            logging.error("Impossible to list files in %s", fullpath, exc_info=True)
+        load_tl.grid(row=0, column=0, padx=10)
+        export_btn = ttk.Button(buttons, text="Export Movie", style='config.TButton',
+                                command=partial(self.confirm_movie_export, dirname))
+        export_btn.grid(row=0, column=1, padx=10)
+        stats_btn = ttk.Button(buttons, text="Statistics", style='config.TButton',
+                               command=partial(self.compute_stats, fullpath, plot))
+        stats_btn.grid(row=0, column=2, padx=10)
+        stab_btn = ttk.Button(buttons, text="Stabilize", style='config.TButton',
+                              command=partial(self.stabilize, fullpath, plot))
+        stab_btn.grid(row=0, column=3, padx=10)
+
+        if entry is not None:
+            self.tk_file_info.set(self.tk_file_info.get() + f' - {entry.n_files} frames')
 
         frame.update()
         try:
@@ -252,6 +299,145 @@ class ImageBrowser():
         except TclError:
             logging.error("prompt_timelapse: Frame was destroyed.")
 
+    # FRAME STATISTICS
+    def start_job(self, job:FrameStatsJob, plot:Canvas, done:callable) -> bool:
+        ''' Run a per-frame job (statistics, offsets) in the background, done(job) at the end '''
+        if self.stats_job is not None and self.stats_job.isrunning():
+            create_popup(close_btn='Ok', text=f'The {self.stats_job.NAME} are already being computed.',
+                         raise_over=self.frame)
+            return False
+        self.stats_job = job
+        job.start()
+        plot.after(100, self.check_job, job, plot, done)
+        return True
+
+    def compute_stats(self, fullpath:str, plot:Canvas):
+        ''' Compute the statistics of the frames not processed yet, then plot them '''
+        self.start_job(FrameStatsJob(fullpath), plot, lambda job: self.draw_stats(plot, job.results))
+
+    def stabilize(self, fullpath:str, plot:Canvas):
+        ''' Estimate the drift of the frames not processed yet, applied when playing and exporting '''
+        def done(_):
+            stats = read_stats(fullpath)
+            if stats is not None:
+                self.draw_stats(plot, stats)
+            else:
+                plot.delete('all')
+            dx, dy = drift_range(fullpath)
+            text = (f'Drift of {dx} x {dy} px removed by cropping the frames\n'
+                    + 'when playing and exporting the timelapse.' if dx or dy
+                    else 'No drift found: the frames are used as they are.')
+            create_popup(close_btn='Ok', text=text, raise_over=self.frame)
+        self.start_job(StabilizationJob(fullpath), plot, done)
+
+    def check_job(self, job:FrameStatsJob, plot:Canvas, done:callable):
+        msg = job.poll()
+        try:
+            if msg is not None and msg.done:
+                if msg.error:
+                    create_popup(close_btn='Ok', raise_over=self.frame,
+                                 text=f'Error while computing the {job.NAME}:\n{msg.error}')
+                if job.results is not None:
+                    done(job)
+                return
+            if msg is not None:
+                plot.delete('all')
+                plot.create_text(int(plot['width']) // 2, int(plot['height']) // 2,
+                                 text=f'Computing {job.NAME}: {msg.frames_done}/{msg.frames_total}')
+            plot.after(100, self.check_job, job, plot, done)
+        except TclError:
+            # Another picture is displayed: the job goes on and saves its results
+            pass
+
+    @staticmethod
+    def draw_stats(plot:Canvas, stats:np.ndarray):
+        ''' Plot the median brightness, focus and change of each frame, each on its own scale '''
+        plot.delete('all')
+        width, height = int(plot['width']), int(plot['height'])
+        top, bottom = 14, height - 14
+        n = len(stats)
+        if n == 0:
+            return
+        # Each pixel column shows the range of its frames: single frame failures stay visible
+        columns = min(n, width)
+        starts = np.linspace(0, n, columns + 1).astype(int)[:-1]
+        series = (('p50', '#3366CC', 'brightness'), ('focus', '#109618', 'focus'),
+                  ('diff', '#DC3912', 'change'))
+        for i, (field, color, label) in enumerate(series):
+            values = stats[field].astype(np.float64)
+            if np.isnan(values).all():
+                continue
+            lows = np.fmin.reduceat(values, starts)
+            highs = np.fmax.reduceat(values, starts)
+            lo, hi = np.nanmin(lows), np.nanmax(highs)
+            scale = (bottom - top) / (hi - lo) if hi > lo else 0
+            points = []
+            for x, low, high in zip(np.arange(columns) * width / columns, lows, highs):
+                if not np.isnan(low):
+                    points += [x, bottom - (low - lo) * scale, x, bottom - (high - lo) * scale]
+            if len(points) >= 4:
+                plot.create_line(*points, fill=color)
+            plot.create_text(5 + i * 90, 0, anchor='nw', text=label, fill=color)
+        plot.create_text(width - 5, height, anchor='se', text=f'{n} frames', fill='grey')
+
+    # MOVIE EXPORT
+    def confirm_movie_export(self, dirname:str):
+        if self.movie_exporter.isrunning():
+            create_popup(close_btn='Ok', text='A movie is already being exported.',
+                         raise_over=self.frame)
+            return
+        popup = create_popup(text=f'Export {dirname} as a movie (MJPEG .avi)\n'
+                             + 'next to the timelapse directory.', raise_over=self.frame, cols=2)
+        fps = IntVar(value=self.movie_exporter.fps)
+        size = StringVar(value=list(SIZE_CHOICES)[0])
+        ttk.Label(popup, text='Frames per second').grid(row=1, column=0, padx=10, sticky='E')
+        ttk.Combobox(popup, textvariable=fps, values=FPS_CHOICES, state='readonly',
+                     width=12).grid(row=1, column=1, padx=10, pady=5, sticky='W')
+        ttk.Label(popup, text='Frame size').grid(row=2, column=0, padx=10, sticky='E')
+        ttk.Combobox(popup, textvariable=size, values=list(SIZE_CHOICES), state='readonly',
+                     width=12).grid(row=2, column=1, padx=10, pady=5, sticky='W')
+        ttk.Button(popup, text='Cancel', style='config.TButton',
+                   command=popup.destroy).grid(row=3, column=0, ipadx=20, pady=10)
+        ttk.Button(popup, text='Export', style='config.TButton',
+                   command=lambda: (popup.destroy(),
+                                    self.start_movie_export(dirname, fps.get(),
+                                                            SIZE_CHOICES[size.get()]))
+                   ).grid(row=3, column=1, ipadx=20, pady=10)
+
+    def start_movie_export(self, dirname:str, fps:int, max_size:int=None):
+        exporter = self.movie_exporter
+        exporter.timelapse = dirname
+        exporter.fps = fps
+        exporter.max_size = max_size
+        popup = create_progress_popup(text=f'Exporting {dirname} as a movie...',
+                                      raise_over=self.frame,
+                                      variable=exporter.percent,
+                                      status_var=exporter.transfered_size_str,
+                                      maximum=100)
+        ttk.Button(popup, text='Cancel', style='config.TButton',
+                   command=exporter.cancel).grid(row=2, sticky='NS', ipadx=50, pady=10)
+        self.movie_thread = threading.Thread(name='movieThread', target=exporter.execute, args=())
+        self.movie_thread.start()
+        popup.after(200, self.check_movie_export, popup)
+
+    def check_movie_export(self, popup:Frame):
+        if self.movie_thread.is_alive():
+            popup.after(200, self.check_movie_export, popup)
+            return
+        popup.destroy()
+        exporter = self.movie_exporter
+        if exporter.stop_event.is_set():
+            text = 'Movie export cancelled.'
+        elif not exporter.movies:
+            text = 'Error: no frame could be exported.'
+        else:
+            text = (f'{exporter.transfered_files} frames exported '
+                    + f'({B_to_readable(exporter.transfered_size)}) to:\n'
+                    + '\n'.join(os.path.basename(m) for m in exporter.movies))
+            if exporter.failed_files:
+                text += f'\n{len(exporter.failed_files)} frames could not be read.'
+        create_popup(close_btn='Ok', text=text, raise_over=self.frame)
+
     def update_picture(self, index:int, force:bool=False):
         if self.timelapse_loader:
             self.timelapse_loader.quit()
@@ -259,6 +445,7 @@ class ImageBrowser():
         if len(self.img_list) <= 0:
             create_popup(text="There is no more picture to browse.",
                          accept_btn='Close browser', accept_callback=self.quit)
+            return None
         # Ensure index is valid
         index = min(max(index, 0), len(self.img_list) - 1)
         if not force and index == self.current_index:
@@ -269,46 +456,38 @@ class ImageBrowser():
         self.current_image_path = os.path.join(self.path, filename)
 
         # update Info
-        file_size_bytes = 0
-        if os.path.isfile(self.current_image_path):
-            file_size_bytes = os.path.getsize(self.current_image_path)
-        elif os.path.isdir(self.current_image_path):
-            file_size_bytes = dir_size_bytes(self.current_image_path)
+        entry = self.catalog.get(filename)
+        file_size_bytes = entry.size if entry is not None else 0
         self.tk_filename.set(filename)
         self.tk_filesize.set(B_to_readable(file_size_bytes))
         self.tk_file_info.set(filename + " - " + B_to_readable(file_size_bytes))
         self.tk_file_index.set(f"{self.current_index + 1}/{len(self.img_list)}")
 
-        if filename[0:3] == 'TL_' and os.path.isdir(self.current_image_path):
+        if os.path.basename(filename)[0:3] == 'TL_' and os.path.isdir(self.current_image_path):
             self.prompt_timelapse()
             return None
         # Load image
-        self.clear_picture_frame()
-        self.frame.update()
-        try:
-            photo:Image = Image.open(self.current_image_path)
-            mp = f"{round((photo.width * photo.height) / 1_000_000, 1):.1f} MP"
-            self.tk_file_info.set(self.tk_file_info.get() +
-                                  f" - {photo.width}x{photo.height} ({mp})")
-            # Set size
-            ratio = min(self.max_w / photo.width, self.max_h / photo.height)
-            height = int(photo.height * ratio)
-            width = int(photo.width * ratio)
-            # In case the button has been pushed multiple times, another picture should take over.
-            if index != self.current_index:
-                return False
-            photo = ImageTk.PhotoImage(photo.resize((width, height), Image.LANCZOS))
-            # Remove previous image
-            # Create Frame
-            self.clear_picture_frame()
-            self.current_image = Label(self.image_frame, image=photo)
-            self.current_image.image = photo
-            self.current_image.pack(fill='both')
-        except OSError as e:
+        with span('update picture', file=filename):
             self.clear_picture_frame()
-            self.current_image = Label(self.image_frame, background='white',
-                                       text=f'Error while opening {filename}:\n{str(e)}')
-            self.current_image.pack(fill='both')
+            self.frame.update()
+            try:
+                # In case the button has been pushed multiple times, another picture should take over.
+                if index != self.current_index:
+                    return False
+                # Remove previous image
+                self.clear_picture_frame()
+                # Zoomable viewer, only the visible tiles are decoded
+                self.current_image = TileViewer(self.image_frame, self.current_image_path,
+                                                width=self.max_w, height=self.max_h)
+                self.current_image.pack(fill='both')
+                width, height = self.current_image.pyramid.width, self.current_image.pyramid.height
+                mp = f"{round((width * height) / 1_000_000, 1):.1f} MP"
+                self.tk_file_info.set(self.tk_file_info.get() + f" - {width}x{height} ({mp})")
+            except OSError as e:
+                self.clear_picture_frame()
+                self.current_image = Label(self.image_frame, background='white',
+                                           text=f'Error while opening {filename}:\n{str(e)}')
+                self.current_image.pack(fill='both')
         return None
 
     def next_pic(self, n:int=1):
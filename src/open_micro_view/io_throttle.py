@@ -0,0 +1,123 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from .utils import MB, ioprio_set
+
+# Budget applied to exports while a timelapse is running
+DEFAULT_BANDWIDTH = 4 * MB  # bytes per second
+DEFAULT_IOPS = 50           # files per second
+# Exports are paused from x seconds before a scheduled capture...
+CAPTURE_GUARD_BEFORE = 5
+# ...until x seconds after it
+CAPTURE_GUARD_AFTER = 5
+# Niceness of export threads
+EXPORT_NICENESS = 10
+
+
+class TokenBucket:
+    """ Token bucket: `rate` tokens per second, at most `burst` tokens saved """
+    def __init__(self, rate:float, burst:float=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def consume(self, n:float, stop_event:threading.Event=None):
+        ''' Take n tokens, sleeping until they are available (or stop_event is set) '''
+        with self.lock:
+            self._refill()
+            self.tokens -= n
+            missing = -self.tokens
+        if missing > 0:
+            delay = missing / self.rate
+            if stop_event is not None:
+                stop_event.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+class ExportThrottle:
+    """ Keep exports from delaying timelapse captures.
+
+    While a timelapse is running (capture_schedule returns the monotonic times
+    of the last and of the next captures), the export is limited by a bandwidth
+    and a file rate budget, and completely paused around each capture. Without
+    a running timelapse (capture_schedule returns None), exports run at full
+    speed.
+    """
+    def __init__(self, capture_schedule:Callable[[], tuple]=None,
+                 bandwidth:float=DEFAULT_BANDWIDTH, iops:float=DEFAULT_IOPS):
+        self.capture_schedule = capture_schedule
+        self.bandwidth = TokenBucket(bandwidth, burst=bandwidth / 4)
+        self.iops = TokenBucket(iops, burst=max(1, iops / 4))
+        self.stop_event:threading.Event = None
+
+    def lower_priority(self):
+        ''' Lower CPU and I/O priority of the calling (export) thread '''
+        tid = threading.get_native_id() if hasattr(threading, 'get_native_id') else 0
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, EXPORT_NICENESS)
+        except OSError:
+            logging.warning('Impossible to change export thread niceness.', exc_info=True)
+        try:
+            ioprio_set(level=7, tid=tid)
+        except OSError:
+            logging.warning('Impossible to change export thread I/O priority.', exc_info=True)
+
+    def _schedule(self) -> tuple:
+        if self.capture_schedule is None:
+            return None
+        try:
+            return self.capture_schedule()
+        except Exception:  # pylint: disable=broad-except
+            logging.error('Error reading timelapse schedule.', exc_info=True)
+            return None
+
+    def wait_capture_window(self) -> bool:
+        ''' Block while a capture is imminent or in progress. Return True if throttling applies '''
+        paused = False
+        while True:
+            schedule = self._schedule()
+            if schedule is None:
+                return False
+            last, upcoming = schedule
+            now = time.monotonic()
+            before, after = CAPTURE_GUARD_BEFORE, CAPTURE_GUARD_AFTER
+            if last is not None and upcoming is not None:
+                # Short intervals: keep half of the time available for the export
+                before = min(before, (upcoming - last) / 4)
+                after = min(after, (upcoming - last) / 4)
+            after_last = last is not None and now - last < after
+            before_next = upcoming is not None and upcoming - now < before
+            if not (after_last or before_next):
+                if paused:
+                    logging.info('Export resumed after timelapse capture.')
+                return True
+            if not paused:
+                logging.info('Export paused around timelapse capture.')
+                paused = True
+            if self.stop_event is not None and self.stop_event.wait(0.2):
+                return True
+            if self.stop_event is None:
+                time.sleep(0.2)
+
+    def throttle(self, nbytes:int=0, files:int=0):
+        ''' Called by exporters before writing nbytes and/or creating files '''
+        if not self.wait_capture_window():
+            return
+        if files:
+            self.iops.consume(files, self.stop_event)
+        if nbytes:
+            self.bandwidth.consume(nbytes, self.stop_event)
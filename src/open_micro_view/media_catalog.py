@@ -0,0 +1,280 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import errno
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+
+TIMELAPSE_PREFIX = 'TL_'
+IMG_EXTENSIONS = ['jpg', 'jpeg', 'png', 'webp']
+# Pictures and timelapses are named after their capture date
+DATE_FORMAT = r'%Y-%m-%d_%H-%M-%S'
+DATE_FORMAT_EXAMPLE = '2023-01-01_00-00-00'
+# Layout of the media folder, written in LAYOUT_FILE: 'flat' (all entries in
+# the folder) or 'date' (new entries in YYYY/MM/DD sub-directories). Both are
+# read in any case, e.g. while a library is being migrated.
+LAYOUT_FILE = '.openmicroview_layout'
+LAYOUT_FLAT = 'flat'
+LAYOUT_DATE = 'date'
+SHARD_FORMAT = r'%Y/%m/%d'
+# Names of the year, month and day directories
+SHARD_NAMES = (re.compile(r'\d{4}'), re.compile(r'\d{2}'), re.compile(r'\d{2}'))
+SHARD_PREFIX = re.compile(r'\d{4}/\d{2}/\d{2}/')
+# Raw captures (numpy arrays): stored and exported, but not displayed
+RAW_EXTENSIONS = ['npy']
+
+
+class MediaEntry:
+    """ A single picture or a timelapse directory of the media folder.
+
+    name is the path relative to the media folder, e.g. 2023/01/31/TL_...
+    in the date layout.
+    """
+    __slots__ = ('name', 'is_timelapse', 'size', 'n_files', 'ctime', 'mtime_ns', 'files')
+
+    def __init__(self, name:str, is_timelapse:bool, size:int=0, n_files:int=0,
+                 ctime:float=0, mtime_ns:int=0):
+        self.name = name
+        self.is_timelapse = is_timelapse
+        self.size = size
+        self.n_files = n_files
+        self.ctime = ctime
+        self.mtime_ns = mtime_ns
+        # (relative path, size, mtime_ns) of each file of the entry
+        self.files:list = []
+
+    @property
+    def basename(self) -> str:
+        return self.name.rpartition('/')[2]
+
+    def __repr__(self):
+        return f"MediaEntry({self.name!r}, size={self.size}, n_files={self.n_files})"
+
+
+def entry_datetime(entry:MediaEntry) -> datetime:
+    ''' Return the capture date of an entry, read from its name when possible '''
+    name = entry.basename
+    name = name[len(TIMELAPSE_PREFIX):] if entry.is_timelapse else name
+    try:
+        return datetime.strptime(name[:len(DATE_FORMAT_EXAMPLE)], DATE_FORMAT)
+    except ValueError:
+        return datetime.fromtimestamp(entry.ctime)
+
+
+def is_media_file(name:str) -> bool:
+    return name.split('.')[-1].lower() in IMG_EXTENSIONS
+
+
+def is_capture_file(name:str) -> bool:
+    ''' Pictures and raw captures '''
+    return is_media_file(name) or name.split('.')[-1].lower() in RAW_EXTENSIONS
+
+
+def read_layout(root:str) -> str:
+    try:
+        with open(os.path.join(root, LAYOUT_FILE), 'r') as f:
+            layout = f.read().strip()
+    except FileNotFoundError:
+        return LAYOUT_FLAT
+    except OSError:
+        logging.error('Impossible to read the layout of %s', root, exc_info=True)
+        return LAYOUT_FLAT
+    return layout if layout in (LAYOUT_FLAT, LAYOUT_DATE) else LAYOUT_FLAT
+
+
+def write_layout(root:str, layout:str):
+    tmp = os.path.join(root, LAYOUT_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(layout)
+    os.replace(tmp, os.path.join(root, LAYOUT_FILE))
+
+
+def shard(date:datetime) -> str:
+    ''' Directory of the entries captured at date, relative to the media folder '''
+    return date.strftime(SHARD_FORMAT)
+
+
+def entry_dir(root:str, date:datetime = None) -> str:
+    ''' Directory where to create an entry captured at date (default: now) '''
+    if read_layout(root) != LAYOUT_DATE:
+        return root
+    path = os.path.join(root, shard(date or datetime.now()))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def unsharded(rel:str) -> str:
+    ''' Path rel had in the flat layout, None if rel is not in a date directory '''
+    match = SHARD_PREFIX.match(rel)
+    return rel[match.end():] if match else None
+
+
+class MediaCatalog:
+    """ Cached listing of the media folder with the size of each entry.
+
+    Directories are only rescanned when their modification time changed, so
+    refreshing the catalog after a capture or a deletion is cheap: the size of
+    an untouched timelapse is never recomputed. In the date layout, only the
+    day directories which changed are listed again.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.RLock()
+        self._entries:dict = {}
+        # Relative path of each directory: (mtime_ns, entry names, date sub-directories)
+        self._dirs:dict = {}
+
+    @property
+    def layout(self) -> str:
+        return read_layout(self.path)
+
+    def refresh(self, force:bool=False) -> bool:
+        ''' Update the catalog if the media folder changed. Return True if rescanned '''
+        with self.lock:
+            entries = {}
+            dirs = {}
+            try:
+                changed = self._refresh_dir('', 0, entries, dirs, force)
+            except OSError:
+                logging.error('Impossible to read directory %s', self.path, exc_info=True)
+                changed = True
+            # Date directories removed
+            changed = changed or dirs.keys() != self._dirs.keys()
+            self._entries = entries
+            self._dirs = dirs
+            return changed
+
+    def _refresh_dir(self, rel:str, depth:int, entries:dict, dirs:dict, force:bool) -> bool:
+        ''' Collect the entries of directory rel and of its date directories, return True if
+        one of them was listed again '''
+        path = os.path.join(self.path, rel)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            if depth:
+                return True
+            raise
+        cached = self._dirs.get(rel)
+        changed = (force or cached is None or cached[0] != mtime_ns
+                   # Entries removed from the catalog meanwhile
+                   or any(name not in self._entries for name in cached[1]))
+        if not changed:
+            # Listing unchanged, timelapses may still receive new frames
+            names, subdirs = cached[1], cached[2]
+            for name in names:
+                entry = self._entries[name]
+                if entry.is_timelapse:
+                    self._refresh_timelapse(entry)
+                entries[name] = entry
+        else:
+            names, subdirs = [], []
+            with os.scandir(path) as it:
+                for f in it:
+                    if (depth < len(SHARD_NAMES) and SHARD_NAMES[depth].fullmatch(f.name)
+                            and f.is_dir(follow_symlinks=False)):
+                        subdirs.append(f.name)
+                        continue
+                    entry = self._scan_entry(f, rel)
+                    if entry is not None:
+                        names.append(entry.name)
+                        entries[entry.name] = entry
+        dirs[rel] = (mtime_ns, names, subdirs)
+        for subdir in subdirs:
+            changed = self._refresh_dir(rel + subdir + '/', depth + 1, entries, dirs, force) or changed
+        return changed
+
+    def _scan_entry(self, f:os.DirEntry, rel:str = '') -> MediaEntry:
+        name = rel + f.name
+        try:
+            if f.name.startswith(TIMELAPSE_PREFIX) and f.is_dir(follow_symlinks=False):
+                previous = self._entries.get(name)
+                if previous is not None and previous.is_timelapse:
+                    self._refresh_timelapse(previous)
+                    return previous
+                entry = MediaEntry(name, True, ctime=f.stat().st_ctime)
+                self._refresh_timelapse(entry)
+                return entry
+            if is_capture_file(f.name) and f.is_file(follow_symlinks=False):
+                st = f.stat()
+                entry = MediaEntry(name, False, st.st_size, 1, st.st_ctime, st.st_mtime_ns)
+                entry.files = [(name, st.st_size, st.st_mtime_ns)]
+                return entry
+        except OSError:
+            logging.warning('Impossible to read %s', f.path, exc_info=True)
+        return None
+
+    def _refresh_timelapse(self, entry:MediaEntry):
+        ''' Compute the size of a timelapse directory if it changed since last scan '''
+        path = os.path.join(self.path, entry.name)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            if mtime_ns == entry.mtime_ns:
+                return
+            files = []
+            with os.scandir(path) as it:
+                for f in it:
+                    # Hidden files are sidecars of the application (e.g. statistics)
+                    if f.is_file(follow_symlinks=False) and not f.name.startswith('.'):
+                        st = f.stat()
+                        files.append((entry.name + '/' + f.name, st.st_size, st.st_mtime_ns))
+            entry.files = files
+            entry.size = sum(f[1] for f in files)
+            entry.n_files = len(files)
+            entry.mtime_ns = mtime_ns
+        except OSError:
+            logging.warning('Impossible to read timelapse %s', path, exc_info=True)
+
+    def entries(self) -> list:
+        ''' Return all entries, most recent first '''
+        with self.lock:
+            return sorted(self._entries.values(), key=lambda e: e.ctime, reverse=True)
+
+    def pictures(self) -> list:
+        return [e for e in self.entries() if not e.is_timelapse]
+
+    def timelapses(self) -> list:
+        return [e for e in self.entries() if e.is_timelapse]
+
+    def get(self, name:str) -> MediaEntry:
+        with self.lock:
+            return self._entries.get(name)
+
+    def find(self, name:str) -> MediaEntry:
+        ''' Entry name, or the entry named name in any date directory '''
+        with self.lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = next((e for e in self._entries.values() if e.basename == name), None)
+            return entry
+
+    def total_size(self) -> int:
+        with self.lock:
+            return sum(e.size for e in self._entries.values())
+
+    def files(self, entries:list=None):
+        ''' Yield (relative path, size, mtime_ns) of every file of entries (default: all) '''
+        if entries is None:
+            entries = self.entries()
+        for entry in entries:
+            yield from entry.files
+
+    def remove(self, names):
+        ''' Drop several entries at once, e.g. after a bulk deletion '''
+        with self.lock:
+            for name in names:
+                self._entries.pop(name, None)
+
+    def prune(self, names):
+        ''' Remove the date directories left empty by the removal of entries names '''
+        days = {rel[:-len(unsharded(rel)) - 1] for rel in names if unsharded(rel)}
+        for day in sorted(days):
+            for rel in (day, day[:7], day[:4]):
+                try:
+                    os.rmdir(os.path.join(self.path, rel))
+                except OSError as e:
+                    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                        logging.warning('Impossible to remove %s', rel, exc_info=True)
+                    break
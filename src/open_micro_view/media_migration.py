@@ -0,0 +1,106 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import threading
+import time
+from queue import Empty, Queue
+
+from .media_catalog import LAYOUT_DATE, MediaCatalog, entry_datetime, shard, write_layout
+
+# Minimum delay between two progress messages (seconds)
+PROGRESS_INTERVAL = 0.1
+
+
+class MigrationProgress:
+    """ Progress message sent by the LayoutMigration """
+    __slots__ = ('entries_moved', 'entries_total', 'done', 'error')
+
+    def __init__(self, entries_moved:int, entries_total:int, done:bool=False, error:str=None):
+        self.entries_moved = entries_moved
+        self.entries_total = entries_total
+        self.done = done
+        self.error = error
+
+
+class LayoutMigration:
+    """ Move the entries of a flat media folder to YYYY/MM/DD directories.
+
+    The folder switches to the date layout first, so new captures go to their
+    date directory while the existing entries are moved in a background
+    thread. Entries are renamed (same file system): a timelapse moves in a
+    single operation whatever its number of frames. The catalog reads both
+    layouts, so the migration can be interrupted and resumed at any time.
+    Entries in skip (e.g. the timelapse being captured) are left in place.
+    """
+    def __init__(self, catalog:MediaCatalog, skip:list=None):
+        self.catalog = catalog
+        self.progress = Queue()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.entries_moved = 0
+        self._last_report = 0
+        catalog.refresh()
+        skip = set(skip or [])
+        self.entries = [e for e in catalog.entries() if '/' not in e.name and e.name not in skip]
+        self.entries_total = len(self.entries)
+
+    def start(self):
+        self.thread = threading.Thread(name='layoutMigration', target=self.run, args=())
+        self.thread.start()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def isrunning(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def poll(self) -> MigrationProgress:
+        ''' Return the latest progress message, or None if nothing new happened '''
+        msg = None
+        try:
+            while True:
+                msg = self.progress.get_nowait()
+        except Empty:
+            pass
+        return msg
+
+    def _report(self, done:bool=False, error:str=None):
+        now = time.monotonic()
+        if done or error or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.progress.put(MigrationProgress(self.entries_moved, self.entries_total, done, error))
+
+    def run(self) -> bool:
+        ''' @Threaded - Move every flat entry to its date directory '''
+        root = self.catalog.path
+        try:
+            write_layout(root, LAYOUT_DATE)
+        except OSError as e:
+            logging.error('Impossible to change the layout of %s', root, exc_info=True)
+            self._report(done=True, error=str(e))
+            return False
+        logging.info('Moving %d entries to date directories...', self.entries_total)
+        error = None
+        for entry in self.entries:
+            if self.stop_event.is_set():
+                logging.warning('Migration cancelled.')
+                break
+            target = os.path.join(shard(entry_datetime(entry)), entry.name)
+            try:
+                os.makedirs(os.path.dirname(os.path.join(root, target)), exist_ok=True)
+                if os.path.lexists(os.path.join(root, target)):
+                    raise FileExistsError(f'{target} already exists')
+                os.rename(os.path.join(root, entry.name), os.path.join(root, target))
+                self.entries_moved += 1
+            except FileNotFoundError:
+                pass  # Deleted meanwhile
+            except OSError as e:
+                logging.error('Impossible to move %s', entry.name, exc_info=True)
+                error = f'{entry.name}: {e.strerror or e}'
+            self._report()
+        self.catalog.refresh(force=True)
+        logging.info('%d/%d entries moved.', self.entries_moved, self.entries_total)
+        self._report(done=True, error=error)
+        return error is None and not self.stop_event.is_set()
@@ -0,0 +1,186 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Hashable
+
+from .ui_dispatcher import post
+from .utils import MB, B_to_readable
+
+# Priorities of the decoded images, the lowest are evicted first
+PREFETCH = 0  # Decoded in advance (e.g. other pyramid level)
+PLAYBACK = 1  # Frames of a timelapse being played
+VISIBLE = 2   # On screen: never evicted
+PRIORITIES = (PREFETCH, PLAYBACK, VISIBLE)
+# Part of the system memory given to the decoded images
+BUDGET_FRACTION = 0.15
+# Budget used if the system memory is unknown
+DEFAULT_BUDGET = 128 * MB
+MEMINFO = '/proc/meminfo'
+
+
+def image_bytes(width:int, height:int, channels:int=4) -> int:
+    ''' Memory used by a decoded image (Tk photo images are stored as 32 bits pixels) '''
+    return width * height * channels
+
+
+def system_budget(fraction:float=BUDGET_FRACTION) -> int:
+    ''' BUDGET_FRACTION of the system memory (MemTotal), in bytes '''
+    try:
+        with open(MEMINFO, 'rb') as f:
+            for line in f:
+                if line.startswith(b'MemTotal:'):
+                    return int(int(line.split()[1]) * 1024 * fraction)  # kB
+    except (OSError, ValueError, IndexError):
+        logging.warning('Impossible to read the system memory, image budget: %s',
+                        B_to_readable(DEFAULT_BUDGET))
+    return DEFAULT_BUDGET
+
+
+class Consumer:
+    """ Decoded images held by one component, accounted in a MemoryBudget.
+
+    evict(key) is called from the Tk thread (posted by the thread adding an
+    image) when the budget drops one of the images: the consumer must release
+    it, and decode it again if needed later. Consumers without evict can only add VISIBLE images.
+    """
+    def __init__(self, owner:'MemoryBudget', name:str, evict:Callable[[Hashable], None]=None):
+        self.budget = owner
+        self.name = name
+        self.evict = evict
+
+    def add(self, key:Hashable, nbytes:int, priority:int=PLAYBACK):
+        ''' Account an image (replaces the previous one of key), may evict other images '''
+        if priority != VISIBLE and self.evict is None:
+            raise ValueError(f'{self.name}: images without evict callback must be VISIBLE')
+        self.budget.add(self, key, nbytes, priority)
+
+    def set_priority(self, key:Hashable, priority:int):
+        self.budget.set_priority(self, key, priority)
+
+    def remove(self, key:Hashable):
+        ''' The image was released by the consumer '''
+        self.budget.remove(self, key)
+
+    def clear(self):
+        self.budget.clear(self)
+
+    def fits(self, nbytes:int) -> bool:
+        ''' True if nbytes can be added without evicting anything '''
+        return self.budget.total + nbytes <= self.budget.limit
+
+    @property
+    def size(self) -> int:
+        return self.budget.usage().get(self.name, 0)
+
+
+class MemoryBudget:
+    """ Process-wide limit of the memory used by the decoded images.
+
+    Images are accounted per consumer (timelapse loader, browser, snapshot
+    preview...) with a priority. When the total exceeds the limit, the least
+    recently used images of the lowest priority are evicted: prefetched
+    images first, then playback frames. Visible images are never evicted.
+    """
+    def __init__(self, limit:int=None):
+        self.limit = limit or system_budget()
+        self.lock = threading.Lock()
+        # Priority: {(consumer, key): nbytes}, least recently used first
+        self._entries = {p: OrderedDict() for p in PRIORITIES}
+        # (consumer, key): priority
+        self._priority:dict = {}
+        self.total = 0
+        self.evicted = 0
+        self._over = False
+
+    def add(self, consumer:Consumer, key:Hashable, nbytes:int, priority:int=PLAYBACK):
+        with self.lock:
+            self._pop((consumer, key))
+            self._entries[priority][(consumer, key)] = nbytes
+            self._priority[(consumer, key)] = priority
+            self.total += nbytes
+            victims = self._select_victims()
+        self._evict(victims)
+
+    def set_priority(self, consumer:Consumer, key:Hashable, priority:int):
+        with self.lock:
+            if self._priority.get((consumer, key), priority) == priority:
+                return
+            nbytes = self._pop((consumer, key))
+            self._entries[priority][(consumer, key)] = nbytes
+            self._priority[(consumer, key)] = priority
+            self.total += nbytes
+            victims = self._select_victims()
+        self._evict(victims)
+
+    def remove(self, consumer:Consumer, key:Hashable):
+        with self.lock:
+            self._pop((consumer, key))
+
+    def clear(self, consumer:Consumer):
+        with self.lock:
+            for entry in [e for e in self._priority if e[0] is consumer]:
+                self._pop(entry)
+
+    def usage(self) -> dict:
+        ''' Bytes accounted per consumer name '''
+        result = {}
+        with self.lock:
+            for entries in self._entries.values():
+                for (consumer, _), nbytes in entries.items():
+                    result[consumer.name] = result.get(consumer.name, 0) + nbytes
+        return result
+
+    def _pop(self, entry:tuple) -> int:
+        ''' Forget entry (lock held), return its size '''
+        priority = self._priority.pop(entry, None)
+        if priority is None:
+            return 0
+        nbytes = self._entries[priority].pop(entry)
+        self.total -= nbytes
+        return nbytes
+
+    def _select_victims(self) -> list:
+        ''' Remove the images to evict (lock held), the consumers are called without the lock '''
+        victims = []
+        for priority in (PREFETCH, PLAYBACK):
+            entries = self._entries[priority]
+            while self.total > self.limit and entries:
+                entry, nbytes = entries.popitem(last=False)
+                del self._priority[entry]
+                self.total -= nbytes
+                victims.append(entry)
+        over = self.total > self.limit
+        if over and not self._over:
+            logging.warning('Visible images use %s, over the image budget (%s).',
+                            B_to_readable(self.total), B_to_readable(self.limit))
+        self._over = over
+        return victims
+
+    def _evict(self, victims:list):
+        ''' Release the victims from the Tk thread: photo images must not be deleted elsewhere '''
+        for consumer, key in victims:
+            self.evicted += 1
+            logging.debug('Image budget: evicting %s %s', consumer.name, key)
+            post(partial(self._release, consumer, key))
+
+    def _release(self, consumer:Consumer, key:Hashable):
+        with self.lock:
+            if (consumer, key) in self._priority:
+                # Added again since its eviction
+                return
+        try:
+            consumer.evict(key)
+        except Exception:  # pylint: disable=broad-except
+            logging.error('Impossible to evict %s %s', consumer.name, key, exc_info=True)
+
+
+budget = MemoryBudget()
+
+
+def register(name:str, evict:Callable[[Hashable], None]=None) -> Consumer:
+    ''' New consumer of the process-wide budget '''
+    return Consumer(budget, name, evict)
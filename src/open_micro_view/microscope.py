@@ -1,50 +1,75 @@
 # OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
 # Copyright (C) 2023 V. Salvadori
 
-import logging
-import sys
-import threading
-from time import sleep
-from tkinter import Frame, StringVar, Tk
+from functools import partial
+from math import isnan
+from tkinter import Frame, Tk
 
+from .media_catalog import MediaCatalog
 from .microscope_camera import Camera
 from .microscope_light import Light
+from .observable import str_var
+from .parameter_bus import ParameterBus
+from .storage_monitor import StorageMonitor
+from .telemetry import Telemetry
+from .thermal_governor import ThermalGovernor
+from .ui_dispatcher import post
+from .utils import read_config
+from .write_back import WriteBack
 
 
 class Microscope():
     """ Microscope object including camera and light"""
-    def __init__(self, root:Tk, camera_frame:Frame):
+    def __init__(self, root:Tk, camera_frame:Frame, preview:bool=True):
         self.light  = Light()
         self.master = root
-        self.camera = Camera(self.master, camera_frame)
-        self.temperature = StringVar()
-        self.stop_event = threading.Event()
-        self.thread = threading.Thread(name='temperatureThread', target=self.temperature_watchdog, args=())
-        self.thread.start()
+        self.camera = Camera(self.master, camera_frame, preview=preview)
+        self.catalog = MediaCatalog(self.camera.get_image_path())
+        # Optional RAM staging of the timelapse frames, None if disabled
+        self.staging = WriteBack.from_config(self.camera.get_image_path(),
+                                             read_config().get('write_back'),
+                                             wait=self.camera.encoder.wait)
+        if self.staging is not None:
+            self.staging.recover()
+            self.staging.start()
+        # Slider values are applied to the hardware from a background thread
+        self.parameters = ParameterBus()
+        self.parameters.register('light.brightness', self.light.set_brightness,
+                                 self.light.transaction)
+        for c in ['r', 'g', 'b', 'w']:
+            self.parameters.register(f'light.{c}', partial(self.light.set_color, c),
+                                     self.light.transaction)
+        for p in ['brightness', 'contrast', 'sharpness', 'saturation']:
+            self.parameters.register(f'camera.{p}', getattr(self.camera, p),
+                                     self.camera.transaction)
+        self.temperature = str_var()
+        self.telemetry = Telemetry(self.camera.get_image_path())
+        # USB storages and free space, followed in the background
+        self.storage = StorageMonitor(self.camera.get_image_path())
+        self.telemetry.subscribe(self.refresh_temp)
+        # Live preview slows down when the SoC heats up
+        self.governor = ThermalGovernor(self.camera)
+        if preview:
+            self.telemetry.subscribe(self.governor.update)
+
+    def start_telemetry(self):
+        ''' Start sampling, deferred by the application until the window is shown '''
+        self.telemetry.start()
+        self.storage.start()
 
     def close(self):
-        self.stop_event.set()
+        self.parameters.close()
+        self.telemetry.stop()
+        self.storage.stop()
         self.light.off()
         self.camera.close()
-        self.thread.join(timeout=1.0)
-
-    def temperature_watchdog(self):
-        logging.info("Starting Temperature watchdog...")
-        while not self.stop_event.is_set():
-            self.refresh_temp()
-            sleep(1)
+        # After the camera: the frames being encoded are written first
+        if self.staging is not None:
+            self.staging.close()
 
-    def refresh_temp(self):
-        try:
-            t = 0
-            with open(r"/sys/class/thermal/thermal_zone0/temp", "r") as f:
-                t = f.readline()
-            t = round(float(t) / 1000)
-            if not self.stop_event.is_set():
-                self.temperature.set(f"{t} °C")
-        except OSError:
-            logging.error('Impossible to read temperature', exc_info=True)
-            self.temperature.set('? ?')
-        except RuntimeError:
-            logging.error('RuntimeError: Exiting Temperature thread...', exc_info=True)
-            sys.exit()
+    def refresh_temp(self, sample:dict):
+        ''' Called by the telemetry thread after each sample '''
+        t = sample['temperature']
+        if self.telemetry.stop_event.is_set():
+            return
+        post(self.temperature, '? ?' if isnan(t) else f"{round(t)} °C")
@@ -6,32 +6,53 @@ import logging
 import os
 import threading
 import time
+from contextlib import contextmanager, nullcontext
 from functools import partial
 from queue import Queue
 from statistics import mean
 from time import sleep
-from tkinter import FLAT, Button, Frame, IntVar, Label, PhotoImage, ttk
+from tkinter import FLAT, Button, Frame, Label, PhotoImage, ttk
+from typing import Callable
 
 from picamera import PiCamera
 from picamera.array import PiRGBArray
 from PIL import Image, ImageTk
 
 from .assets.icons import TRASH_ICON
-from .utils import create_popup
+from .capture_process import POLL_INTERVAL, CaptureProcess
+from .capture_process import available as capture_process_available
+from .encoding import SNAPSHOT, Encoder
+from .media_catalog import entry_dir
+from .memory_budget import VISIBLE, image_bytes, register
+from .observable import int_var
+from .startup_timeline import first_frame
+from .tracing import span
+from .ui_dispatcher import post
+from .utils import create_popup, read_config
 
 DEFAULT_IMAGES_STORAGE = '/opt'
 PICTURE_FOLDER_NAME = 'OpenMicroView_Media'
 PREVIEW_MAX_H = 400
 PREVIEW_MAX_W = 510
+# Width of the frames captured for the live preview
+PREVIEW_WIDTH = 240
 
 
 class Camera:
     """ OpenMicroView Microscope Camera """
-    def __init__(self, root, tab):
+    def __init__(self, root, tab, preview:bool=True, capture_process:bool=True):
         self.vs = None
-        self.camera = PiCamera()
+        # The live preview is captured by a dedicated process when possible
+        self.process:CaptureProcess = None
+        if preview and capture_process and capture_process_available():
+            self.process = self.start_capture_process()
+        self.camera = self.process.proxy if self.process is not None else PiCamera()
         self.output_path = DEFAULT_IMAGES_STORAGE
+        # Format and quality of the captures, per mode
+        self.encoder = Encoder(read_config().get('encoding'))
         self.snapshot_frame = None
+        # Live preview and snapshot preview, both on screen
+        self.images = register('camera')
         self.frame = None
         self.tab = tab
         self.thread = None
@@ -39,12 +60,23 @@ class Camera:
         self.restart_event = threading.Event()
         self.root = root
         self.panel = None
-        self.i_fps = IntVar()
-        self.i_brightness = IntVar()
-        self.i_contrast = IntVar()
-        self.i_sharpness = IntVar()
-        self.i_saturation = IntVar()
+        self.i_fps = int_var()
+        self.i_brightness = int_var()
+        self.i_contrast = int_var()
+        self.i_sharpness = int_var()
+        self.i_saturation = int_var()
+        # Parameters staged by a transaction, None outside of transactions
+        self._staged:dict = None
         self.new_resolution = None
+        # Live preview limits, lowered by the thermal governor
+        self.preview_width:int = PREVIEW_WIDTH
+        self.preview_fps:float = None  # None: as fast as possible
+        self.preview_paused:bool = False
+        # Without preview (headless), the camera is only used for captures
+        self.preview = preview
+        self._fps_list = [0] * 10
+        self._fps_index = 0
+        self._time_frame:float = None
         self.video_queue = Queue()
         self.camera.vflip = True
         self.image = None
@@ -59,6 +91,20 @@ class Camera:
         self.restart_event.set()
         if self.thread:
             self.thread.join(timeout=1.0)
+        # Pictures still being encoded are written before the camera goes away
+        self.encoder.close()
+        if self.process is not None:
+            self.process.close()
+
+    def start_capture_process(self) -> CaptureProcess:
+        ''' Start the capture process, None if impossible (the camera stays in this process) '''
+        process = CaptureProcess(frame_size=PREVIEW_WIDTH * PREVIEW_WIDTH * 3)
+        try:
+            process.start()
+        except Exception:  # pylint: disable=broad-except
+            logging.error('Impossible to start the capture process.', exc_info=True)
+            return None
+        return process
 
     def fps(self, n=None):
         if (n is not None):
@@ -66,48 +112,74 @@ class Camera:
         return self.camera.framerate
 
     def brightness(self, n=None):
-        if (n is None):
-            self.i_brightness = self.camera.brightness
-        else:
-            n = round(float(n))
-            self.camera.brightness = n
-            self.i_brightness = self.camera.brightness
-        return self.camera.brightness
+        return self._parameter('brightness', n)
 
     def contrast(self, n=None):
-        if (n is None):
-            self.i_contrast = self.camera.contrast
-        else:
-            n = round(float(n))
-            self.camera.contrast = n
-            self.i_contrast = self.camera.contrast
-        return self.camera.contrast
+        return self._parameter('contrast', n)
 
     def sharpness(self, n=None):
-        if (n is None):
-            self.i_sharpness = self.camera.sharpness
-        else:
-            n = round(float(n))
-            self.camera.sharpness = n
-            self.i_sharpness = self.camera.sharpness
-        return self.camera.sharpness
+        return self._parameter('sharpness', n)
 
     def saturation(self, n=None):
-        if (n is None):
-            self.i_saturation = self.camera.saturation
-        else:
+        return self._parameter('saturation', n)
+
+    def _parameter(self, name:str, n=None):
+        ''' Get or set a camera parameter, staged if a transaction is open '''
+        if n is not None:
             n = round(float(n))
-            self.camera.saturation = n
-            self.i_saturation = self.camera.saturation
-        return self.camera.saturation
+            if self._staged is not None:
+                self._staged[name] = n
+                return n
+            if getattr(self.camera, name) != n:
+                setattr(self.camera, name, n)
+        elif self._staged is not None and name in self._staged:
+            return self._staged[name]
+        value = getattr(self.camera, name)
+        post(getattr(self, 'i_' + name), value)
+        return value
+
+    @contextmanager
+    def transaction(self):
+        """ Stage the parameters set in the with block and apply them together.
+
+        Only parameters different from the current camera settings are sent to
+        the camera, back to back.
+        """
+        if self._staged is not None:
+            # Nested: part of the outer transaction
+            yield self
+            return
+        self._staged = {}
+        try:
+            yield self
+        finally:
+            staged, self._staged = self._staged, None
+            for name, n in staged.items():
+                if getattr(self.camera, name) != n:
+                    setattr(self.camera, name, n)
+                post(getattr(self, 'i_' + name), n)
+
+    @staticmethod
+    def fit_preview(image:Image.Image) -> Image.Image:
+        ''' Copy of image resized to the preview panel '''
+        ratio = min(PREVIEW_MAX_W / image.width, PREVIEW_MAX_H / image.height)
+        width = round(image.width * ratio)
+        height = round(image.height * ratio)
+        return image.resize((width, height), Image.LANCZOS)
+
+    def publish_frame(self, image:Image.Image, fitted:bool=False):
+        ''' Send a preview frame (already resized if fitted) to the panel, and update the framerate '''
+        # Converted to a Tk image by the UI thread, latest frame only
+        post(self.show_frame, image if fitted else self.fit_preview(image))
+        # Calculate Live Framerate (mean of last 10)
+        time_previous, self._time_frame = self._time_frame, time.monotonic()
+        if (time_previous is not None):
+            self._fps_list[self._fps_index] = round(1 / (self._time_frame - time_previous))
+            post(self.i_fps, round(mean(tuple(self._fps_list))))
+            self._fps_index = (self._fps_index + 1) % 10
 
     def video_loop(self, q):
         preset_ratio = self.camera.resolution[1] / self.camera.resolution[0]
-        time_frame = None
-        time_previous = None
-        # We calculate FPS on the last 10
-        fps_list = [0] * 10
-        index = 0
         # If StopEvent is Set => Quit the loop
         while not self.stop_event.is_set():
             self.restart_event.clear()
@@ -119,54 +191,116 @@ class Camera:
                     preset_ratio = self.camera.resolution[1] / self.camera.resolution[0]
                     logging.debug('Camera Resolution changed to %s', res)
                     sleep(0.3)
+                if self.preview_paused:
+                    self.wait_preview_resumed()
+                    continue
                 # Set the preview resolution
-                img_w = 240
+                img_w = self.preview_width
                 img_h = round(img_w * preset_ratio)
                 stream = PiRGBArray(self.camera, size=(img_w, img_h))
-                if self.panel:
-                    self.panel.destroy()
-                self.panel = None
+                post(self.clear_panel)
                 logging.info('Start Capture...')
                 for frame in self.camera.capture_continuous(stream,
                                                             format='rgb',
                                                             use_video_port=True,
                                                             resize=(img_w, img_h)):
-                    stream.truncate()
-                    stream.seek(0)
-                    self.image = frame.array
-                    image = Image.fromarray(self.image)
-                    max_h = PREVIEW_MAX_H
-                    max_w = PREVIEW_MAX_W
-                    ratio = min(max_w / image.width, max_h / image.height)
-                    width = round(image.width * ratio)
-                    height = round(image.height * ratio)
-                    image = ImageTk.PhotoImage(image.resize((width, height), Image.LANCZOS))
-
-                    if self.panel is None:
-                        self.panel = Label(self.tab, image=image)
-                        self.panel.image = image
-                        self.panel.pack(padx=5, pady=10, fill='none')
-                    else:
-                        self.panel.configure(image=image)
-                        self.panel.image = image
-                    # Calculate Live Framerate (mean of last 10)
-                    time_previous = time_frame
-                    time_frame = time.monotonic()
-                    if (time_previous is not None):
-                        curr_fps = round(1 / (time_frame - time_previous))
-                        fps_list[index] = curr_fps
-                        self.i_fps.set(round(mean(tuple(fps_list))))
-                        index = (index + 1) % 10
+                    frame_start = time.monotonic()
+                    with span('preview frame', width=img_w):
+                        stream.truncate()
+                        stream.seek(0)
+                        self.image = frame.array
+                        self.publish_frame(Image.fromarray(self.image))
                     # If StopEvent is Set => Quit the loop
                     # if RestartEvent is Set => Reload the stream
                     if self.stop_event.is_set() or self.restart_event.is_set() or not q.empty():
                         break
+                    if self.preview_fps:
+                        # Limit the CPU time spent on the preview
+                        delay = 1 / self.preview_fps - (time.monotonic() - frame_start)
+                        if delay > 0 and self.restart_event.wait(delay):
+                            break
             except RuntimeError:
                 logging.error('RuntimeError: Exiting Camera thread...', exc_info=True)
                 exit()
         logging.warning('End of VideoLoop Thread')
         return True
 
+    def ring_loop(self, q):
+        ''' @Threaded - Display the frames written by the capture process in the frame ring '''
+        ring = self.process.ring
+        try:
+            while not self.stop_event.is_set():
+                self.restart_event.clear()
+                while not q.empty():
+                    res = q.get()
+                    self.camera.resolution = res
+                    logging.debug('Camera Resolution changed to %s', res)
+                self.process.set_preview(True, self.preview_width, self.preview_fps,
+                                         self.preview_paused)
+                if self.preview_paused:
+                    self.wait_preview_resumed()
+                    continue
+                post(self.clear_panel)
+                logging.info('Start Capture...')
+                seq = ring.latest()
+                while not (self.stop_event.is_set() or self.restart_event.is_set() or not q.empty()):
+                    if ring.latest() == seq:
+                        self.restart_event.wait(POLL_INTERVAL)
+                        continue
+                    seq = ring.latest()
+                    frame = ring.read(seq)
+                    if frame is None:
+                        continue
+                    width, height, data = frame
+                    with span('preview frame', width=width, seq=seq):
+                        # Resized straight from the shared memory: the copy is dropped
+                        # if the slot was overwritten while it was being read
+                        image = Image.frombuffer('RGB', (width, height), data, 'raw', 'RGB', 0, 1)
+                        preview = self.fit_preview(image)
+                        if ring.valid(seq):
+                            self.publish_frame(preview, fitted=True)
+            self.process.set_preview(False)
+        except RuntimeError:
+            logging.error('RuntimeError: Exiting Camera thread...', exc_info=True)
+        logging.warning('End of VideoLoop Thread')
+        return True
+
+    def show_frame(self, image:Image.Image):
+        ''' Display image in the preview panel (Tk thread) '''
+        photo = ImageTk.PhotoImage(image)
+        self.images.add('preview', image_bytes(*image.size), VISIBLE)
+        if self.panel is None:
+            self.panel = Label(self.tab, image=photo)
+            self.panel.pack(padx=5, pady=10, fill='none')
+            first_frame()
+        else:
+            self.panel.configure(image=photo)
+        self.panel.image = photo
+
+    def clear_panel(self):
+        ''' Remove the preview panel, created again with the next frame (Tk thread) '''
+        if self.panel:
+            self.panel.destroy()
+        self.panel = None
+        self.images.remove('preview')
+
+    def set_preview_limits(self, fps:float=None, width:int=PREVIEW_WIDTH, paused:bool=False):
+        ''' Change the live preview framerate/width, or pause it (restarts the preview) '''
+        if (fps, width, paused) == (self.preview_fps, self.preview_width, self.preview_paused):
+            return
+        self.preview_fps = fps
+        self.preview_width = width
+        self.preview_paused = paused
+        self.restart_event.set()
+
+    def wait_preview_resumed(self):
+        ''' Wait, without capturing anything, until the preview is resumed or stopped '''
+        logging.info('Live preview paused.')
+        post(self.i_fps, 0)
+        while self.preview_paused and not self.stop_event.is_set():
+            self.restart_event.wait(1.0)
+            self.restart_event.clear()
+
     def stop_video(self):
         logging.info('Stopping Video...')
         self.stop_event.set()
@@ -176,6 +310,8 @@ class Camera:
         self.restart_event.set()
 
     def start_video(self):
+        if not self.preview:
+            return
         sleep(0.2)
         logging.debug('Threads : %d', threading.active_count())
         self.restart_event.clear()
@@ -184,35 +320,89 @@ class Camera:
             self.thread.join()
         logging.info('Ready - Starting new video hread')
         self.thread = threading.Thread(name='videoLoop',
-                                       target=self.video_loop,
+                                       target=self.video_loop if self.process is None
+                                       else self.ring_loop,
                                        args=[self.video_queue])
         self.restart_event.clear()
         self.stop_event.clear()
         self.thread.start()
         logging.debug('Thread Started')
 
+    @contextmanager
+    def exposure_locked(self):
+        """ Freeze exposure and white balance to their current values in the with block """
+        cam = self.camera
+        modes = (cam.exposure_mode, cam.awb_mode, cam.shutter_speed)
+        cam.shutter_speed = cam.exposure_speed
+        cam.exposure_mode = 'off'
+        gains = cam.awb_gains
+        cam.awb_mode = 'off'
+        cam.awb_gains = gains
+        try:
+            yield self
+        finally:
+            cam.exposure_mode, cam.awb_mode, cam.shutter_speed = modes
+
+    def capture_sequence(self, outputs:list, before_frame:Callable[[int], None]=None,
+                         settle:float=None, lock_exposure:bool=True):
+        ''' Capture one picture per output, back to back.
+
+        before_frame(i) is called before the capture of outputs[i], e.g. to
+        switch the illumination; settle (default: one frame) is the delay
+        left between this call and the capture.
+        '''
+        if settle is None:
+            settle = 1 / float(self.camera.framerate)
+
+        def frames():
+            for i, output in enumerate(outputs):
+                if before_frame is not None:
+                    before_frame(i)
+                sleep(settle)
+                yield output
+
+        self.stop_video()
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+        try:
+            with (self.exposure_locked() if lock_exposure else nullcontext()):
+                # Burst mode: no new metering between the frames
+                self.camera.capture_sequence(frames(), 'jpeg', burst=True)
+            logging.info('Sequence of %d pictures captured.', len(outputs))
+        finally:
+            self.start_video()
+
     def get_image_path(self):
         return os.path.join(self.output_path, PICTURE_FOLDER_NAME)
 
+    def capture(self, path:str=None, mode:str=SNAPSHOT) -> str:
+        ''' Save a picture, named after the current date by default, return its path
+        (its extension is the one of the encoding of mode) '''
+        if path is None:
+            ts = datetime.datetime.now()
+            path = os.path.join(entry_dir(self.get_image_path(), ts),
+                                ts.strftime(r'%Y-%m-%d_%H-%M-%S'))
+        with span('capture', path=path, mode=mode):
+            path = self.encoder.capture(self.camera, path, mode)
+        logging.info("Picture '%s' saved.", os.path.basename(path))
+        return path
+
     def take_snapshot(self):
-        ts = datetime.datetime.now()
-        filename = f"{ts.strftime(r'%Y-%m-%d_%H-%M-%S')}.jpg"
-        p = os.path.join(self.get_image_path(), filename)
-        self.camera.capture(p, 'jpeg')
-        logging.info("Picture '%s' saved.", filename)
-        # Display the saved picture instead of Live video.
-        sleep(0.2)
-        photo = Image.open(p)
-        max_w, max_h = 515, 330
-        ratio = min(max_w / photo.width, max_h / photo.height)
-        height = int(photo.height * ratio)
-        width = int(photo.width * ratio)
-        logging.debug("Resized snapshot: %dx%d", width, height)
-        photo = photo.resize((width, height), Image.LANCZOS)
-        photo = ImageTk.PhotoImage(photo)
+        with span('snapshot'):
+            p = self.capture()
+            # Display the saved picture instead of Live video.
+            photo = self.encoder.preview(p)
+            max_w, max_h = 515, 330
+            ratio = min(max_w / photo.width, max_h / photo.height)
+            height = int(photo.height * ratio)
+            width = int(photo.width * ratio)
+            logging.debug("Resized snapshot: %dx%d", width, height)
+            photo = photo.resize((width, height), Image.LANCZOS)
+            photo = ImageTk.PhotoImage(photo)
         if (self.snapshot_frame is not None):
             self.snapshot_frame.destroy()
             self.snapshot_frame = None
+        self.images.add('snapshot', image_bytes(width, height), VISIBLE)
 
         self.snapshot_frame = Frame(self.tab, bg='white')
         self.snapshot_frame.grid_columnconfigure(0, weight=1)
@@ -237,6 +427,7 @@ class Camera:
     def delete_snapshot(self, filename):
         self.close_snapshot_preview()
         try:
+            self.encoder.wait(filename)
             os.remove(filename)
             create_popup(text='The picture has been deleted.', close_btn='Ok')
             return True
@@ -248,5 +439,6 @@ class Camera:
     def close_snapshot_preview(self):
         self.snapshot_frame.destroy()
         self.snapshot_frame = None
+        self.images.remove('snapshot')
         self.panel.pack(padx=10, pady=10)
         return 0
@@ -1,11 +1,15 @@
 # OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
 # Copyright (C) 2023 V. Salvadori
 
-from tkinter import IntVar
+import threading
+from contextlib import contextmanager
 
 import board
 import neopixel
 
+from .observable import int_var
+from .ui_dispatcher import post
+
 # LED Strip  Configuration
 LED_COUNT = 7            # Number of LEDs
 LED_PIN = board.D18      # GPIO Pin
@@ -13,37 +17,90 @@ LED_ORDER = neopixel.RGBW
 
 
 class Light():
-    """ OpenMicroView Microscope Light """
+    """ OpenMicroView Microscope Light
+
+    The state is kept in plain attributes, under lock: sliders update the
+    strip from the parameter bus thread. The Tk variables of the sliders
+    (brightness, color) only mirror it and are updated with post().
+    """
     def __init__(self):
+        # Sliders update the strip from the parameter bus thread
+        self.lock = threading.RLock()
         # by default light is off
-        self.brightness:IntVar = IntVar()
+        self._brightness = 0
+        self.brightness = int_var()
         # default color is white
-        self.color:dict = {'r':IntVar(), 'g':IntVar(), 'b':IntVar(), 'w':IntVar()}
+        self._colors:dict = {'r': 0, 'g': 0, 'b': 0, 'w': 0}
+        self.color:dict = {'r':int_var(), 'g':int_var(), 'b':int_var(), 'w':int_var()}
         self.pixels:neopixel.NeoPixel = neopixel.NeoPixel(LED_PIN, LED_COUNT,
                                                           pixel_order=LED_ORDER,
                                                           brightness=self.get_brightness(),
-                                                          auto_write=True)
-        self.set_color('w', 255)
-        self.set_color('r', 0)
-        self.set_color('g', 0)
-        self.set_color('b', 0)
+                                                          auto_write=False)
+        # Nested transactions count, and pending changes to write once they end
+        self._transaction = 0
+        self._dirty = False
+        # Last state written to the strip
+        self._applied = None
+        with self.transaction():
+            self.set_colors({'w': 255, 'r': 0, 'g': 0, 'b': 0})
         self.reload()
 
     # Reload function applies the changes to the hardware.
-    def reload(self):
-        self.pixels.brightness = self.get_brightness()
-        self.pixels.fill((self.get_color('g'),
-                          self.get_color('r'),
-                          self.get_color('b'),
-                          self.get_color('w')))
+    def reload(self, force:bool=False):
+        with self.lock:
+            if force:
+                self._applied = None
+            if self._transaction:
+                # Written once, at the end of the transaction
+                self._dirty = True
+                return
+            self._dirty = False
+            state = (self.get_brightness(), (self._colors['g'],
+                                             self._colors['r'],
+                                             self._colors['b'],
+                                             self._colors['w']))
+            if state == self._applied:
+                return
+            # auto_write is off: brightness and colors are sent in a single write
+            self.pixels.brightness = state[0]
+            self.pixels.fill(state[1])
+            self.pixels.show()
+            self._applied = state
+
+    def show_buffer(self, buffer:list):
+        ''' Write precomputed per-LED values (see illumination.Pattern), until next reload '''
+        with self.lock:
+            self.pixels[:] = buffer
+            self.pixels.show()
+            # The strip no longer shows the light settings
+            self._applied = None
+
+    def begin(self):
+        ''' Stage the next changes, until commit() '''
+        with self.lock:
+            self._transaction += 1
+
+    def commit(self):
+        ''' Write the staged changes to the strip, at once '''
+        with self.lock:
+            self._transaction = max(0, self._transaction - 1)
+            if not self._transaction and self._dirty:
+                self.reload()
+
+    @contextmanager
+    def transaction(self):
+        """ Apply every change made in the with block in a single hardware write """
+        self.begin()
+        try:
+            yield self
+        finally:
+            self.commit()
 
     def on(self):
-        self.brightness.set(100)
-        self.reload()
+        self.set_brightness(100)
 
     def off(self):
-        self.brightness.set(0)
-        self.reload()
+        self.set_brightness(0)
 
     def set_red(self, n:int):
         self.set_color('r', n)
@@ -59,26 +116,39 @@ class Light():
 
     def set_color(self, color:str, n:int):
         if color in ['r','g','b','w']:
-            self.color[color].set(round(float(n)))
-            self.reload()
+            value = round(float(n))
+            with self.lock:
+                self._colors[color] = value
+                self.reload()
+            post(self.color[color], value)
         else:
             raise ValueError(f"Color '{color}' not in ['r','g','b','w']. ")
 
+    def set_colors(self, colors:dict):
+        ''' Set several colors, e.g. {'r': 255, 'w': 0}, in a single write '''
+        with self.transaction():
+            for color, n in colors.items():
+                self.set_color(color, n)
+
     def set_brightness(self, b:float):
-        self.brightness.set(round(float(b)))
-        self.reload()
+        value = round(float(b))
+        with self.lock:
+            self._brightness = value
+            self.reload()
+        post(self.brightness, value)
 
     def get_brightness(self) -> float:
-        return self.brightness.get() / 100
+        return self._brightness / 100
 
     def get_color(self, color) -> int:
-        return int(self.color[color].get())
+        return self._colors[color]
 
-    def get_colors(self) -> int:
-        return {k: v.get() for k, v in self.color.items()}
+    def get_colors(self) -> dict:
+        with self.lock:
+            return dict(self._colors)
 
     def toggle(self) -> bool:
         # If light is on turn it off, if its off turn it on
-        self.set_brightness(0 if self.brightness.get() else 100)
-        self.reload()
-        return self.brightness.get() > 0
+        with self.lock:
+            self.set_brightness(0 if self._brightness else 100)
+            return self._brightness > 0
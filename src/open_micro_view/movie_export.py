@@ -0,0 +1,332 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from io import BytesIO
+
+from PIL import Image
+
+from .derivative_export import _init_worker, ordered_map
+from .io_throttle import ExportThrottle
+from .media_catalog import MediaCatalog, is_media_file
+from .observable import int_var, str_var
+from .ui_dispatcher import post
+from .utils import GB, B_to_readable
+
+# Many players do not handle AVI 1.0 files above 1 GB: longer movies are split
+MAX_VOLUME_SIZE = 1 * GB
+FPS_CHOICES = [5, 10, 15, 24, 30]
+# Longest edge of the movie frames, None to keep the original frames
+SIZE_CHOICES = {'Original size': None, '1920px': 1920, '1280px': 1280, '640px': 640}
+# Minimum delay between two refresh of the Tk progress variables
+PROGRESS_INTERVAL = 0.1
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+# RIFF/hdrl/strl headers, the 'movi' list starts right after
+_HEADER_SIZE = 224
+_MOVI_FOURCC_OFFSET = 220
+# JPEG markers with a length but no image size
+_NOT_SOF = (0xC4, 0xC8, 0xCC)
+
+
+def jpeg_size(data:bytes) -> tuple:
+    ''' Return (width, height) read from the SOF marker of a JPEG, None if not a JPEG '''
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        length = struct.unpack_from('>H', data, i + 2)[0]
+        if 0xC0 <= marker <= 0xCF and marker not in _NOT_SOF:
+            height, width = struct.unpack_from('>HH', data, i + 5)
+            return width, height
+        if marker == 0xDA:
+            # Start of scan without any frame header
+            return None
+        i += 2 + length
+    return None
+
+
+def encode_frame(src:str, max_size:int=None, size:tuple=None, quality:int=85,
+                 box:tuple=None) -> bytes:
+    ''' Return src as JPEG bytes, cropped to box (full resolution pixels), then
+    fitting in max_size or resized to exactly size '''
+    target = size or ((max_size, max_size) if max_size else None)
+    with Image.open(src) as img:
+        width = img.width
+        if target is not None:
+            # JPEG: decode directly at a reduced scale when possible
+            img.draft('RGB', target)
+        photo = img.convert('RGB')
+    if box is not None:
+        scale = photo.width / width
+        photo = photo.crop(tuple(round(v * scale) for v in box))
+    if size is not None and photo.size != tuple(size):
+        photo = photo.resize(size, Image.LANCZOS)
+    elif max_size:
+        photo.thumbnail((max_size, max_size), Image.LANCZOS)
+    buf = BytesIO()
+    photo.save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+class AviWriter:
+    """ Minimal MJPEG AVI (1.0) writer: one video stream, an idx1 index.
+
+    JPEG frames are stored as they are, headers are written with placeholder
+    values and updated once the number of frames is known.
+    """
+    def __init__(self, path:str, width:int, height:int, fps:float):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = Fraction(fps).limit_denominator(1000)
+        # (offset from the 'movi' fourcc, size) of each frame
+        self.index = array('L')
+        self.max_frame = 0
+        self.file = open(path, 'wb')
+        self.file.write(self._headers(0, 0))
+        self.offset = _HEADER_SIZE
+
+    def _headers(self, movi_size:int, riff_size:int) -> bytes:
+        n_frames = len(self.index) // 2
+        w, h = self.width, self.height
+        avih = struct.pack('<14I', round(1e6 / self.fps),
+                           int(self.max_frame * self.fps), 0, AVIF_HASINDEX, n_frames,
+                           0, 1, self.max_frame, w, h, 0, 0, 0, 0)
+        strh = struct.pack('<4s4sIHHIIIIIIiI4h', b'vids', b'MJPG', 0, 0, 0, 0,
+                           self.fps.denominator, self.fps.numerator, 0, n_frames,
+                           self.max_frame, -1, 0, 0, 0, w, h)
+        strf = struct.pack('<IiiHH4sIiiII', 40, w, h, 1, 24, b'MJPG', w * h * 3, 0, 0, 0, 0)
+        strl = (b'LIST' + struct.pack('<I', 4 + 8 + len(strh) + 8 + len(strf)) + b'strl'
+                + b'strh' + struct.pack('<I', len(strh)) + strh
+                + b'strf' + struct.pack('<I', len(strf)) + strf)
+        hdrl = b'hdrl' + b'avih' + struct.pack('<I', len(avih)) + avih + strl
+        return (b'RIFF' + struct.pack('<I', riff_size) + b'AVI '
+                + b'LIST' + struct.pack('<I', len(hdrl)) + hdrl
+                + b'LIST' + struct.pack('<I', movi_size) + b'movi')
+
+    def size(self) -> int:
+        ''' Size of the file if closed now '''
+        return self.offset + 8 + 8 * len(self.index)
+
+    def add_frame(self, data:bytes):
+        pad = len(data) & 1
+        self.file.write(b'00dc' + struct.pack('<I', len(data)))
+        self.file.write(data)
+        if pad:
+            self.file.write(b'\0')
+        self.index.append(self.offset - _MOVI_FOURCC_OFFSET)
+        self.index.append(len(data))
+        self.max_frame = max(self.max_frame, len(data))
+        self.offset += 8 + len(data) + pad
+
+    def close(self):
+        ''' Write the index and update the headers '''
+        movi_size = self.offset - _MOVI_FOURCC_OFFSET
+        idx1 = bytearray()
+        for i in range(0, len(self.index), 2):
+            idx1 += struct.pack('<4sIII', b'00dc', AVIIF_KEYFRAME, self.index[i], self.index[i + 1])
+        self.file.write(b'idx1' + struct.pack('<I', len(idx1)) + idx1)
+        riff_size = self.file.tell() - 8
+        self.file.seek(0)
+        self.file.write(self._headers(movi_size, riff_size))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class MovieExporter():
+    """ Turn a timelapse into MJPEG AVI movie(s) without decoding its frames.
+
+    Frames already stored as JPEG are copied as they are into the movie; when
+    a maximum size is set or the timelapse was stabilized (cropped frames),
+    frames are first processed by a pool of processes. Frames of another
+    format or size are re-encoded to the movie size.
+    """
+    def __init__(self, catalog:MediaCatalog, throttle:ExportThrottle=None):
+        self.catalog = catalog
+        self.throttle = throttle
+        self.timelapse:str = None
+        self.dest:str = None  # Default: next to the timelapse directory
+        self.fps:float = FPS_CHOICES[0]
+        self.max_size:int = None
+        self.quality:int = 85
+        self.volume_size:int = MAX_VOLUME_SIZE
+        # Apply the drift offsets of the timelapse, when estimated
+        self.stabilize:bool = True
+        self.boxes:dict = None
+        self.workers = os.cpu_count() or 1
+        self.percent = int_var()
+        self.progress_value = int_var()
+        self.transfered_size_str = str_var()
+
+        self.running = threading.Event()
+        self.stop_event = threading.Event()
+        self.total_files:int = 0
+        self.transfered_size:int = 0
+        self.transfered_files:int = 0
+        self.failed_files:list = []
+        self.movies:list = []
+        self._last_progress:float = 0
+
+    def isrunning(self) -> bool:
+        return self.running.is_set()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def movie_path(self, volume:int) -> str:
+        # Not in the timelapse directory: the movie would be taken as one of its frames
+        dest = self.dest or os.path.dirname(os.path.join(self.catalog.path, self.timelapse))
+        suffix = f'_part{volume + 1}' if volume else ''
+        return os.path.join(dest, f'{os.path.basename(self.timelapse)}{suffix}.avi')
+
+    def execute(self) -> bool:
+        if self.isrunning():
+            logging.warning("The movie export is already on going.")
+            return False
+        self.running.set()
+        self.stop_event.clear()
+        try:
+            return self._execute()
+        finally:
+            self.running.clear()
+
+    def frames(self, files:list):
+        ''' Yield (relative path, JPEG bytes) of each frame, None if unreadable '''
+        if not self.max_size and self.boxes is None:
+            for rel in files:
+                if self.stop_event.is_set():
+                    return
+                try:
+                    with open(os.path.join(self.catalog.path, rel), 'rb') as f:
+                        yield rel, f.read()
+                except OSError:
+                    logging.error('Impossible to read %s', rel, exc_info=True)
+                    yield rel, None
+            return
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker) as pool:
+            jobs = ordered_map(pool, encode_frame, files, 2 * self.workers, self.stop_event,
+                               key=lambda rel: (os.path.join(self.catalog.path, rel),
+                                                self.max_size, None, self.quality, self._box(rel)))
+            for rel, future in jobs:
+                try:
+                    yield rel, future.result()
+                except (OSError, ValueError):
+                    logging.error('Impossible to encode %s', rel, exc_info=True)
+                    yield rel, None
+
+    def _execute(self) -> bool:
+        if self.throttle is not None:
+            self.throttle.stop_event = self.stop_event
+            self.throttle.lower_priority()
+        self.catalog.refresh()
+        # A timelapse name is enough, whatever its date directory
+        entry = self.catalog.find(self.timelapse)
+        if entry is not None:
+            self.timelapse = entry.name
+        files = sorted(rel for rel, _, _ in entry.files if is_media_file(rel)) if entry else []
+        self.boxes = None
+        if entry is not None and self.stabilize:
+            # pylint: disable=import-outside-toplevel
+            from .stabilization import stabilized_boxes
+            self.boxes = stabilized_boxes(os.path.join(self.catalog.path, entry.name))
+        self.total_files = len(files)
+        self.transfered_files = 0
+        self.transfered_size = 0
+        self.failed_files = []
+        self.movies = []
+        self.update_status(force=True)
+        logging.info('Exporting %d frames of %s as a %s fps movie%s', len(files), self.timelapse,
+                     self.fps, ' (stabilized)' if self.boxes else '')
+        writer = None
+        size = None
+        try:
+            for rel, data in self.frames(files):
+                if data is not None:
+                    dims = jpeg_size(data)
+                    if size is None:
+                        size = dims
+                    if dims is None or dims != size:
+                        # Not a JPEG, or not the size of the movie
+                        data = self._reencode(rel, size)
+                        if size is None and data is not None:
+                            size = jpeg_size(data)
+                if data is None:
+                    self.failed_files.append(rel)
+                    continue
+                if writer is not None and writer.size() + len(data) + 24 > self.volume_size:
+                    writer.close()
+                    os.replace(writer.path, self.movies[-1])
+                    writer = None
+                if writer is None:
+                    self.movies.append(self.movie_path(len(self.movies)))
+                    writer = AviWriter(self.movies[-1] + '.part', size[0], size[1], self.fps)
+                if self.throttle is not None:
+                    self.throttle.throttle(nbytes=len(data), files=1)
+                writer.add_frame(data)
+                self.transfered_files += 1
+                self.transfered_size += len(data)
+                self.update_status()
+            if writer is not None:
+                if self.stop_event.is_set():
+                    # Keep the movies already completed only
+                    writer.file.close()
+                    os.remove(writer.path)
+                    self.movies.pop()
+                else:
+                    writer.close()
+                    os.replace(writer.path, self.movies[-1])
+                writer = None
+        finally:
+            if writer is not None:
+                writer.file.close()
+                os.remove(writer.path)
+            self.update_status(force=True)
+        logging.info('Movie export ended: %d frames, %s in %d file(s).', self.transfered_files,
+                     B_to_readable(self.transfered_size), len(self.movies))
+        return not self.stop_event.is_set()
+
+    def _box(self, rel:str) -> tuple:
+        ''' Crop box of a frame, None if the timelapse is not stabilized '''
+        return self.boxes.get(os.path.basename(rel)) if self.boxes else None
+
+    def _reencode(self, rel:str, size:tuple) -> bytes:
+        path = os.path.join(self.catalog.path, rel)
+        try:
+            if size is None:
+                data = encode_frame(path, self.max_size, quality=self.quality, box=self._box(rel))
+            else:
+                data = encode_frame(path, size=size, quality=self.quality, box=self._box(rel))
+        except (OSError, ValueError):
+            logging.error('Impossible to encode %s', rel, exc_info=True)
+            return None
+        return data
+
+    def update_status(self, force:bool=False):
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return None
+        self._last_progress = now
+        done = self.transfered_files + len(self.failed_files)
+        prct = 100 * done / self.total_files if self.total_files else 100
+        post(self.percent, int(prct))
+        post(self.transfered_size_str, f'{done}/{self.total_files} - '
+                                       + B_to_readable(self.transfered_size))
+        post(self.progress_value, done)
+        return None
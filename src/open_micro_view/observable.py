@@ -0,0 +1,59 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import threading
+from tkinter import IntVar, StringVar
+from typing import Any, Callable
+
+
+class Value:
+    """ Observable value with the get()/set() interface of the Tk variables.
+
+    Used instead of IntVar/StringVar when running without Tk (headless):
+    subscribers are called from the thread setting the value.
+    """
+    def __init__(self, value:Any=None):
+        self._value = value
+        self.subscribers:list = []
+        self.lock = threading.Lock()
+
+    def get(self) -> Any:
+        return self._value
+
+    def set(self, value:Any):
+        with self.lock:
+            changed = value != self._value
+            self._value = value
+        if changed:
+            for callback in self.subscribers:
+                callback(value)
+
+    def subscribe(self, callback:Callable[[Any], None]):
+        ''' callback(value) is called after each change '''
+        self.subscribers.append(callback)
+
+    def __repr__(self):
+        return f"Value({self._value!r})"
+
+
+_headless = False
+
+
+def set_headless(headless:bool=True):
+    ''' Create plain Values instead of Tk variables (no Tk interpreter needed) '''
+    global _headless  # pylint: disable=global-statement
+    _headless = headless
+
+
+def is_headless() -> bool:
+    return _headless
+
+
+def int_var(value:int=0):
+    ''' IntVar, or an int Value when headless '''
+    return Value(value) if _headless else IntVar(value=value)
+
+
+def str_var(value:str=''):
+    ''' StringVar, or a str Value when headless '''
+    return Value(value) if _headless else StringVar(value=value)
@@ -0,0 +1,105 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from typing import Callable
+
+# Maximum number of hardware updates per second
+DEFAULT_RATE = 20
+
+
+class ParameterBus:
+    """ Apply light/camera parameters requested by the UI from a background thread.
+
+    Widgets `post()` the requested values without blocking. Requests are
+    coalesced (only the latest value of each parameter is applied) and written
+    to the hardware at most `rate` times per second, parameters sharing a
+    transaction (e.g. Light.transaction) being applied in a single update.
+    """
+    def __init__(self, rate:float=DEFAULT_RATE):
+        self.rate = rate
+        self.cond = threading.Condition()
+        self.stop_event = threading.Event()
+        # name: (setter, transaction)
+        self.setters:dict = {}
+        self.pending:dict = {}
+        self.requested:dict = {}
+        self.applied:dict = {}
+        self.posted:int = 0
+        self.writes:int = 0
+        self._last_write:float = 0
+        self.thread = threading.Thread(name='parameterBus', target=self.run, args=())
+        self.thread.start()
+
+    def register(self, name:str, setter:Callable, transaction:Callable=None):
+        ''' setter(value) applies parameter name, in a `with transaction():` block if given '''
+        self.setters[name] = (setter, transaction)
+
+    def post(self, name:str, value):
+        ''' Request a new value for parameter name, the latest request wins '''
+        with self.cond:
+            self.pending[name] = value
+            self.requested[name] = value
+            self.posted += 1
+            self.cond.notify()
+
+    def setter(self, name:str) -> Callable:
+        ''' Return a callback posting to parameter name, e.g. for a Scale command '''
+        return lambda value, *_: self.post(name, value)
+
+    def status(self) -> dict:
+        ''' Return {name: (requested, applied)} of every parameter ever posted '''
+        with self.cond:
+            return {name: (value, self.applied.get(name)) for name, value in self.requested.items()}
+
+    def is_applied(self, name:str=None) -> bool:
+        ''' True once the latest request of name (default: all) has been applied '''
+        with self.cond:
+            if name is None:
+                return not self.pending and all(self.applied.get(k) == v
+                                                for k, v in self.requested.items())
+            return name not in self.pending and self.applied.get(name) == self.requested.get(name)
+
+    def close(self):
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify()
+        self.thread.join(timeout=1.0)
+
+    def run(self):
+        ''' @Threaded - apply the pending requests, at most `rate` times per second '''
+        while not self.stop_event.is_set():
+            with self.cond:
+                while not self.pending and not self.stop_event.is_set():
+                    self.cond.wait()
+            delay = self._last_write + 1 / self.rate - time.monotonic()
+            if delay > 0 and self.stop_event.wait(delay):
+                return
+            with self.cond:
+                batch, self.pending = self.pending, {}
+            self.apply(batch)
+            self._last_write = time.monotonic()
+
+    def apply(self, batch:dict):
+        groups = {}
+        for name, value in batch.items():
+            if name not in self.setters:
+                logging.error("Unknown parameter '%s'", name)
+                continue
+            setter, transaction = self.setters[name]
+            groups.setdefault(transaction, []).append((name, setter, value))
+        for transaction, params in groups.items():
+            try:
+                with (transaction() if transaction is not None else nullcontext()):
+                    for name, setter, value in params:
+                        setter(value)
+                        with self.cond:
+                            self.applied[name] = value
+            except Exception:  # pylint: disable=broad-except
+                logging.error('Error while applying %s', [p[0] for p in params], exc_info=True)
+        self.writes += 1
+        logging.debug('Parameters applied: %s (%d requests, %d updates)',
+                      batch, self.posted, self.writes)
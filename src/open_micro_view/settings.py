@@ -6,19 +6,25 @@ import logging
 import os
 import threading
 from functools import partial
-from math import ceil, gcd
-from time import sleep
-from tkinter import HORIZONTAL, Frame, IntVar, StringVar, X, ttk
+from math import gcd
+from tkinter import HORIZONTAL, MULTIPLE, Frame, IntVar, Listbox, StringVar, X, ttk
 
 from .assets.icons import POWER_ICON, icon_button
+from .archive_export import ArchiveExporter, parse_date, select_entries
 from .copy_manager import CopyManager
+from .deletion import DeletionWorker
+from .derivative_export import PROFILES, DerivativeExporter
+from .encoding import ENCODINGS, MODES, SNAPSHOT, TIMELAPSE
 from .image_browser import ImageBrowser
-from .utils import (B_to_readable, create_popup, create_progress_popup,
-                    dir_size_bytes, shutdown, umount2)
+from .io_throttle import ExportThrottle
+from .media_migration import LayoutMigration
+from .storage_monitor import MEDIA_FOLDER
+from .telemetry import throttled_str
+from .ui_dispatcher import post
+from .utils import (CONFIG_FILE, MB, B_to_readable, create_popup, create_progress_popup,
+                    read_config, resolution_str, shutdown, umount2)
 
 
-CONFIG_FILE = './config.json'
-MEDIA_FOLDER = '/media/'
 USB_CP_DIR = 'OpenMicroView_Pictures'
 LICENSE = 'OpenMicroView - Copyright © 2023 V. Salvadori'
 
@@ -32,27 +38,56 @@ class Settings:
         self.light      = microscope.light
         self.frame      = None
         self.app        = app
-        self.cam_res    = StringVar()
+        # Shared with the information bar of the main view
+        self.cam_res    = app.cam_res
         self.cur_res     = self.camera.camera.resolution
         self.btn        = {'saveConfig':None, 'loadConfig':None}
+        self.preset_name = StringVar()
         self.cp_dev     = StringVar()
         self.frame_cp   = None
         self.frame_mv   = None
         self.loading_frame = None
-        self.copy_manager  = CopyManager()
+        # Exports give way to timelapse captures
+        self.copy_manager  = CopyManager(microscope.catalog,
+                                         throttle=ExportThrottle(self.app.capture_schedule))
+        self.archive_exporter = ArchiveExporter(microscope.catalog,
+                                                throttle=ExportThrottle(self.app.capture_schedule))
+        self.derivative_exporter = DerivativeExporter(microscope.catalog,
+                                                      throttle=ExportThrottle(self.app.capture_schedule))
+        self.derivative_profile = StringVar(value=self.derivative_exporter.profile.name)
         self.copy_thread   = None
         self.number_imgs   = StringVar()
         self.number_tls    = StringVar()
         self.size_files    = StringVar()
+        self.system_status = StringVar()
+        self.encoding_stats = StringVar()
+        # Encoding name of each capture mode
+        self.encodings     = {mode: StringVar() for mode in MODES}
         self.storages      = []
+        # Free space and throughput of the selected USB storage
+        self.storage_status = StringVar()
+        self.storage       = microscope.storage
+        self.storage.subscribe(self.storages_changed)
         self.pic_management_frame = None
         self.tab_details   = None
         self.tab_cp        = None
         self.ejct_btn      = None
         self.cp_btn        = None
+        self.archive_btn   = None
+        self.move_btn      = None
+        self.derivative_btn = None
         self.del_btn       = None
         self.tab_del       = None
         self.no_usb        = None
+        self.catalog       = microscope.catalog
+        self.deletion      = None
+        self.deletion_popup    = None
+        self.deletion_progress = None
+        self.deletion_status   = None
+        self.migrate_btn       = None
+        self.migration         = None
+        self.migration_popup   = None
+        self.migration_progress = None
 
     def init_panel(self, frame:Frame):
         ''' Initialise setting panel.'''
@@ -62,8 +97,7 @@ class Settings:
         for row in range(0, 6):
             frame.grid_rowconfigure(row, weight=1, pad=2)
         frame.grid_columnconfigure(1, minsize=150)
-        res = self.camera.camera.resolution
-        self.cam_res.set(f"{res[0]}x{res[1]} ({self.resolution_ratio(res)})")
+        self.cam_res.set(resolution_str(self.camera.camera.resolution))
 
         # Title
         ttk.Label(frame, text='Settings', style='title.TLabel').grid(column=0,
@@ -109,24 +143,33 @@ class Settings:
         # TAB DETAILS
         self.tab_details = ttk.Frame(tabs)
         self.tab_details.grid_columnconfigure(0, weight=1)
-        self.tab_details.grid_rowconfigure(list(range(5)), weight=1)
+        self.tab_details.grid_rowconfigure(list(range(7)), weight=1)
         ttk.Label(self.tab_details, textvariable=self.number_imgs, justify='left').grid(row=0, sticky='news')
         ttk.Label(self.tab_details, textvariable=self.number_tls, justify='left').grid(row=1, sticky='news')
         ttk.Label(self.tab_details, textvariable=self.size_files, justify='left').grid(row=2, sticky='news')
+        ttk.Label(self.tab_details, textvariable=self.system_status,
+                  justify='left').grid(row=3, sticky='news')
+        ttk.Label(self.tab_details, textvariable=self.encoding_stats,
+                  justify='left').grid(row=4, sticky='news')
         browse_btn = ttk.Button(self.tab_details, text="Browse Pictures",
                                 style='TButton',
                                 command=self.image_browser)
-        browse_btn.grid(row=4, sticky='ews')
+        browse_btn.grid(row=5, sticky='ews')
+        # YYYY/MM/DD directories: listings stay short on large libraries
+        self.migrate_btn = ttk.Button(self.tab_details, text="Organize by date",
+                                      style='config.TButton',
+                                      command=self.start_migration)
+        self.migrate_btn.grid(row=6, sticky='ews', pady=(5, 0))
         tabs.add(self.tab_details, text="Details", sticky='news', padding=20)
 
         # TAB: COPY
         self.tab_cp = ttk.Frame(tabs)
-        self.tab_cp.grid_columnconfigure([0, 1], weight=1)
+        self.tab_cp.grid_columnconfigure([0, 1, 2, 3], weight=1)
         self.tab_cp.grid_rowconfigure([0, 2], weight=1)
         self.tab_cp.grid_rowconfigure(1, weight=2)
         ttk.Button(self.tab_cp, text='↻ Refresh list', style='config.TButton',
-                   command=self.refresh_devices_list).grid(row=0, columnspan=2,
-                                                         ipadx=10, pady=10, sticky="N")
+                   command=self.rescan_devices).grid(row=0, columnspan=4,
+                                                     ipadx=10, pady=10, sticky="N")
         self.cp_btn = ttk.Button(self.tab_cp, text="Copy All",
                                  style='config.TButton', state=['disabled'])
         self.cp_btn.grid(row=2, column=0, padx=10, pady=15, sticky='SEW')
@@ -135,7 +178,29 @@ class Settings:
         self.ejct_btn = ttk.Button(self.tab_cp, text="Eject",
                                    style='config.TButton', state=['disabled'],
                                    command=self.eject_usb)
-        self.ejct_btn.grid(row=2, column=1, padx=10, pady=15, sticky='SEW')
+        self.ejct_btn.grid(row=2, column=3, padx=10, pady=15, sticky='SEW')
+
+        # Single tar stream: much faster than many small files on FAT32 sticks
+        self.archive_btn = ttk.Button(self.tab_cp, text="Archive...",
+                                      style='config.TButton', state=['disabled'],
+                                      command=self.confirm_archive)
+        self.archive_btn.grid(row=2, column=2, padx=10, pady=15, sticky='SEW')
+
+        # Copy, verify and free local storage in one pass
+        self.move_btn = ttk.Button(self.tab_cp, text="Move All",
+                                   style='config.TButton', state=['disabled'],
+                                   command=self.confirm_move)
+        self.move_btn.grid(row=2, column=1, padx=10, pady=15, sticky='SEW')
+
+        # Smaller copies for sharing
+        ttk.Combobox(self.tab_cp, textvariable=self.derivative_profile, state='readonly',
+                     values=list(PROFILES)).grid(row=3, column=0, columnspan=2, padx=10,
+                                                 pady=5, sticky='EW')
+        self.derivative_btn = ttk.Button(self.tab_cp, text="Export Copies",
+                                         style='config.TButton', state=['disabled'],
+                                         command=self.trigger_derivatives)
+        self.derivative_btn.grid(row=3, column=2, columnspan=2, padx=10, pady=5, sticky='EW')
+        ttk.Label(self.tab_cp, textvariable=self.storage_status).grid(row=4, columnspan=4, padx=10)
 
         self.refresh_devices_list()
         tabs.add(self.tab_cp, text="Copy", sticky='WE')
@@ -162,24 +227,42 @@ class Settings:
                                           command=self.btn_load_config)
         self.btn['loadConf'].grid(column=5, columnspan=1, row=2, padx=10, sticky='news')
 
+        # Named presets, switched in a single light/camera update
+        presets = ttk.Combobox(frame, textvariable=self.preset_name,
+                               postcommand=lambda: presets.configure(values=list(self.presets())))
+        presets.grid(column=4, columnspan=2, row=3, padx=10, sticky='ew')
+        ttk.Button(frame, text='Apply preset', style='config.TButton',
+                   command=self.btn_apply_preset).grid(column=4, row=4, padx=10, sticky='news')
+        ttk.Button(frame, text='Save preset', style='config.TButton',
+                   command=self.btn_save_preset).grid(column=5, row=4, padx=10, sticky='news')
+
+        # Encoding of the snapshots and of the timelapse frames
+        self.refresh_encodings()
+        ttk.Label(frame, text='Encoding (snapshot / timelapse):').grid(column=3, row=5, sticky='e')
+        for column, mode in ((4, SNAPSHOT), (5, TIMELAPSE)):
+            encoding = ttk.Combobox(frame, textvariable=self.encodings[mode], state='readonly',
+                                    values=list(ENCODINGS), width=14)
+            encoding.grid(column=column, row=5, padx=10, sticky='ew')
+            encoding.bind('<<ComboboxSelected>>', partial(self.select_encoding, mode))
+
     def update_stats(self):
         def _f():
-            files = os.listdir(self.images_path)
-            n_imgs = 0
-            n_tl = 0
-            for f in files:
-                if f.split('.')[-1] in ['jpg', 'jpeg']:
-                    n_imgs += 1
-                elif f[0:3] == 'TL_':
-                    n_tl += 1
-            self.number_imgs.set(f'{n_imgs} single shot pictures')
-            self.number_tls.set(f'{n_tl} timelapses')
-            s = dir_size_bytes(self.images_path)
-            self.size_files.set(f'{B_to_readable(s)} used')
+            self.catalog.refresh()
+            post(self.number_imgs, f'{len(self.catalog.pictures())} single shot pictures')
+            post(self.number_tls, f'{len(self.catalog.timelapses())} timelapses')
+            post(self.size_files, f'{B_to_readable(self.catalog.total_size())} used, '
+                 + f'{B_to_readable(telemetry.latest("free_space") * MB)} free')
+            post(self.system_status, f'CPU {telemetry.latest("cpu"):.0f}% - '
+                 + f'RAM {telemetry.latest("mem_used"):.0f}% - '
+                 + f'Power: {throttled_str(telemetry.latest("throttled"))}')
+            post(self.encoding_stats, self.camera.encoder.summary() or 'No capture yet')
+        telemetry = self.microscope.telemetry
         threading.Thread(name='FilesStats', target=_f, args=()).start()
 
     def image_browser(self):
-        browser = ImageBrowser(path=self.images_path)
+        browser = ImageBrowser(path=self.images_path, catalog=self.catalog,
+                               throttle=ExportThrottle(self.app.capture_schedule),
+                               running=self.app.running_timelapse)
         browser.start()
 
     def load_copy_settings_section(self):
@@ -205,6 +288,33 @@ class Settings:
         self.btn['saveConf'].state(['!disabled'])
         self.btn['loadConf'].state(['!disabled'])
 
+    def btn_apply_preset(self):
+        name = self.preset_name.get()
+        if not self.apply_preset(name):
+            create_popup(text=f"Preset '{name}' not found.", close_btn="Ok")
+
+    def btn_save_preset(self):
+        name = self.preset_name.get().strip()
+        if not name:
+            create_popup(text="Enter a name for the preset.", close_btn="Ok")
+            return
+        try:
+            self.save_preset(name)
+        except OSError:
+            create_popup(text="Impossible to save the preset.", close_btn="Ok")
+            logging.error('Error while saving preset %s.', name, exc_info=True)
+
+    def select_encoding(self, mode:str, _event=None):
+        ''' Callback of the encoding comboboxes, used from the next capture '''
+        encoding = ENCODINGS.get(self.encodings[mode].get())
+        if encoding is not None:
+            self.camera.encoder.modes[mode] = encoding
+            logging.info('%s encoding: %s', mode.capitalize(), encoding.name)
+
+    def refresh_encodings(self):
+        for mode, encoding in self.camera.encoder.modes.items():
+            self.encodings[mode].set(encoding.name)
+
     def select_resolution(self, r):
         ''' Callback by scale object to select the Resolution '''
         r = round(float(r))
@@ -225,32 +335,52 @@ class Settings:
             self.cur_res = new
         return True
 
-    def resolution_ratio(self, r:tuple) -> str:
-        ''' return a string representing the resolution ratio (e.g. 16:9) '''
-        x, y = int(r[0]), int(r[1])
-        div = gcd(x, y)
-        return f'{int(x / div)}:{int(y / div)}'
+    def write_config_file(self, config:dict):
+        tmp = CONFIG_FILE + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(Json.dumps(config))
+        os.replace(tmp, CONFIG_FILE)
 
     def save_config(self):
         """ Get current config and save it to CONFIG_FILE """
         logging.info('Saving configuration...')
-        settings = self.get_config()
-        json_config = Json.dumps(settings)
-        with open(CONFIG_FILE, 'w') as f:
-            f.write(json_config)
+        config = read_config()
+        config.update(self.get_config())
+        self.write_config_file(config)
 
     def load_config(self):
         """ Load Config from CONFIG_FILE and apply it """
         logging.info('Reloading configuration...')
+        config = read_config()
+        if not config:
+            create_popup(text="No configuration to load.", close_btn="Ok")
+            return
         try:
-            with open(CONFIG_FILE, 'r') as f:
-                json_config = f.read()
-            settings = Json.loads(json_config)
-            self.set_config(settings)
-        except OSError:
+            self.set_config(config)
+        except (OSError, ValueError):
             create_popup(text="Impossible to load config.", close_btn="Ok")
             logging.error('Error while loading %s.', CONFIG_FILE, exc_info=True)
 
+    def presets(self) -> dict:
+        """ Named configurations saved in CONFIG_FILE """
+        return read_config().get('presets', {})
+
+    def save_preset(self, name:str):
+        """ Save the current config as preset name """
+        logging.info("Saving preset '%s'...", name)
+        config = read_config()
+        config.setdefault('presets', {})[name] = self.get_config()
+        self.write_config_file(config)
+
+    def apply_preset(self, name:str) -> bool:
+        """ Apply preset name, return False if it does not exist """
+        preset = self.presets().get(name)
+        if preset is None:
+            return False
+        logging.info("Applying preset '%s'.", name)
+        self.set_config(preset)
+        return True
+
     def get_config(self) -> dict:
         """ Returns current config in a dictionnary """
         return ({
@@ -260,37 +390,65 @@ class Settings:
                 'contrast': self.camera.contrast(),
                 'sharpness': self.camera.sharpness(),
                 'saturation': self.camera.saturation()
-            }
+            },
+            'encoding': self.camera.encoder.get_config()
         })
 
     def set_config(self, config:dict):
-        ''' Apply the Config passed in parameter '''
-        if ('light' in config):
-            for c in ['r', 'g', 'b', 'w']:
-                if c in config['light'] and (0 <= int(config['light'][c]) <= 255):
-                    self.light.set_color(c, int(config['light'][c]))
-            self.light.reload()  # Apply changes
-        if ('camera' in config):
-            cam_conf = config['camera']
-            if 'brightness' in cam_conf:
-                self.camera.brightness(cam_conf['brightness'])
-            if 'contrast' in cam_conf:
-                self.camera.contrast(cam_conf['contrast'])
-            if 'sharpness' in cam_conf:
-                self.camera.sharpness(cam_conf['sharpness'])
-            if 'saturation' in cam_conf:
-                self.camera.saturation(cam_conf['saturation'])
+        ''' Apply the Config passed in parameter, in a single light and camera update '''
+        with self.light.transaction(), self.camera.transaction():
+            if ('light' in config):
+                for c in ['r', 'g', 'b', 'w']:
+                    if c in config['light'] and (0 <= int(config['light'][c]) <= 255):
+                        self.light.set_color(c, int(config['light'][c]))
+            if ('camera' in config):
+                cam_conf = config['camera']
+                if 'brightness' in cam_conf:
+                    self.camera.brightness(cam_conf['brightness'])
+                if 'contrast' in cam_conf:
+                    self.camera.contrast(cam_conf['contrast'])
+                if 'sharpness' in cam_conf:
+                    self.camera.sharpness(cam_conf['sharpness'])
+                if 'saturation' in cam_conf:
+                    self.camera.saturation(cam_conf['saturation'])
+        if 'encoding' in config:
+            self.camera.encoder.load(config['encoding'])
+            self.refresh_encodings()
+
+    def storages_changed(self, _storages:list, changed:bool):
+        ''' Called by the storage monitor thread after each sample '''
+        if changed:
+            post(self.refresh_devices_list)
+        else:
+            post(self.update_storage_status)
+
+    def update_storage_status(self):
+        storage = self.storage.get(self.cp_dev.get())
+        if storage is None:
+            self.storage_status.set('')
+            return
+        rates = ''
+        if storage.write_rate is not None:
+            rates = (f' - read {B_to_readable(storage.read_rate)}/s,'
+                     f' write {B_to_readable(storage.write_rate)}/s')
+        self.storage_status.set(f'{B_to_readable(storage.free)} free of '
+                                f'{B_to_readable(storage.total)}{rates}')
 
     def refresh_devices_list(self):
         ''' Display the new usb devices List '''
+        if self.tab_cp is None:
+            return
         self.refresh_storages()
         if self.frame_cp is not None:
             self.frame_cp.destroy()
         self.cp_btn.state(['disabled'])
+        self.archive_btn.state(['disabled'])
+        self.move_btn.state(['disabled'])
+        self.derivative_btn.state(['disabled'])
         self.ejct_btn.state(['disabled'])
 
         self.frame_cp = ttk.Frame(self.tab_cp)
-        self.frame_cp.grid(row=1, columnspan=2, sticky='new', ipady=20)
+        self.frame_cp.grid(row=1, columnspan=4, sticky='new', ipady=20)
         for d in self.storages:
             # Add a line with detected usb devices, on click trigger mvcp_selection
             ttk.Radiobutton(self.frame_cp, text=d,
@@ -299,29 +457,36 @@ class Settings:
         if not self.storages:
             self.no_usb = ttk.Label(self.frame_cp, text="No USB device Connected.")
             self.no_usb.pack(fill='both', padx=20)
+        # Selection kept if the device is still there
+        self.cp_selection()
         # also refresh stats
         self.update_stats()
 
+    def rescan_devices(self):
+        ''' Refresh button: the monitor pushes the list back if it changed '''
+        self.storage.rescan()
+        self.refresh_devices_list()
+
     def refresh_storages(self):
-        ''' Add the USB Storage devices to self.storages '''
-        self.storages = []
-        self.cp_dev.set("")
-        # Browse /media/*
-        for _dir in os.listdir(MEDIA_FOLDER):
-            abs_path = os.path.join(MEDIA_FOLDER, _dir)
-            if os.path.isdir(abs_path):
-                # Browse /media/$username/*
-                for usb in os.listdir(abs_path):
-                    if (os.lstat(os.path.join(abs_path, usb)).st_uid != 0):
-                        self.storages.append(os.path.join(_dir, usb))
+        ''' Update self.storages from the storage monitor (no scan here) '''
+        self.storages = [s.name for s in self.storage.storages()]
+        if self.cp_dev.get() not in self.storages:
+            self.cp_dev.set("")
 
     def cp_selection(self):
         ''' Activate or deactivate the Copy Button after a change '''
-        if self.cp_dev.get() != '' and not self.copy_manager.isrunning():
+        self.update_storage_status()
+        if self.cp_dev.get() != '' and not self.export_running():
             self.cp_btn.state(['!disabled'])
+            self.archive_btn.state(['!disabled'])
+            self.move_btn.state(['!disabled'])
+            self.derivative_btn.state(['!disabled'])
             self.ejct_btn.state(['!disabled'])
         else:
             self.cp_btn.state(['disabled'])
+            self.archive_btn.state(['disabled'])
+            self.move_btn.state(['disabled'])
+            self.derivative_btn.state(['disabled'])
             self.ejct_btn.state(['disabled'])
 
     # SHUTDOWN RASPBERRY-PI
@@ -333,6 +498,9 @@ class Settings:
         def callback(r):
             popup.destroy()
             self.light.off()
+            # Frames still in RAM are lost at shutdown
+            if self.microscope.staging is not None:
+                self.microscope.staging.flush()
             if not shutdown(reboot=r):
                 create_popup(text="Error: Impossible to shutdown", close_btn='Ok')
 
@@ -347,16 +515,17 @@ class Settings:
     def confirm_delete_pictures(self):
         logging.info('Triggered deletion of Pictures')
         self.del_btn.state(['disabled'])
-        total = self.number_imgs.get()
-        if total == 0:
+        self.catalog.refresh()
+        n_imgs = len(self.catalog.pictures())
+        n_tls = len(self.catalog.timelapses())
+        if n_imgs + n_tls == 0:
             create_popup(text='There is currently no picture stored locally.',
                          close_btn='Ok', raise_over=self.frame)
             self.del_btn.state(['!disabled'])
             return None
-        popup = create_popup(text=f'This will delete all {total} currently stored locally.\nAre you sure ?',
-                             raise_over=self.frame, cols=2,
-                             accept_btn='Delete All',
-                             accept_callback=self.delete_pictures)
+        text = (f'This will delete all {n_imgs} pictures and {n_tls} timelapses '
+                + 'currently stored locally.\nAre you sure ?')
+        popup = create_popup(text=text, raise_over=self.frame, cols=2)
 
         ok_btn = ttk.Button(popup, text='Delete All', style='config.TButton',
                             command=partial(self.delete_pictures, popup))
@@ -370,41 +539,107 @@ class Settings:
     def delete_pictures(self, popup):
         logging.info("Deleting Pictures..")
         popup.destroy()
-        path = self.images_path
-        files = [f for f in os.listdir(path) if f.split('.')[-1] in ['jpeg', 'jpg', 'png']]
-        total = len(files)
-        progress = IntVar(0)
-        status = StringVar("")
-        i = 0
-        if total <= 0:
+        running = self.app.running_timelapse()
+        # The timelapse being captured stays in place, as for Move All
+        skip = os.path.relpath(running, self.images_path) if running else None
+        names = [e.name for e in self.catalog.entries() if e.name != skip]
+        if not names:
             logging.warning('No Files to delete.')
+            self.del_btn.state(['!disabled'])
             return None
-        logging.info('Deleting %d files...', total)
-        popup = create_progress_popup(text=f'Deleting {total} files...',
-                                      raise_over=self.frame,
-                                      variable=progress,
-                                      status_var=status,
-                                      maximum=total)
-        self.app.master.update()
-        sleep(0.5)
-        refresh_rate = ceil(total / 250)
-        for file in files:
-            i += 1
-            if i % refresh_rate == 0:
-                progress.set(i)
-                status.set(f"{i}/{total}")
-                self.app.master.update()
-            os.remove(os.path.join(path, file))
-        sleep(0.5)
-        popup.destroy()
-        create_popup(text='All images have been deleted.',
-                     close_btn='Ok', raise_over=self.frame)
+        self.deletion = DeletionWorker(self.catalog, names)
+        total = self.deletion.files_total
+        self.deletion_progress = IntVar(value=0)
+        self.deletion_status = StringVar(value="")
+        self.deletion_popup = create_progress_popup(text=f'Deleting {total} files...',
+                                                    raise_over=self.frame,
+                                                    variable=self.deletion_progress,
+                                                    status_var=self.deletion_status,
+                                                    maximum=total)
+        cancel_btn = ttk.Button(self.deletion_popup, text='Cancel', style='config.TButton',
+                                command=self.deletion.cancel)
+        cancel_btn.grid(row=2, sticky='NS', ipadx=50, pady=10)
+        self.deletion.start()
+        self.frame.after(100, self.check_deletion)
+        return None
+
+    def check_deletion(self):
+        ''' Poll the deletion worker and refresh the progress popup '''
+        progress = self.deletion.poll()
+        if progress is not None:
+            self.deletion_progress.set(progress.files_deleted)
+            self.deletion_status.set(f"{progress.files_deleted}/{progress.files_total}")
+        if progress is None or not progress.done:
+            self.frame.after(100, self.check_deletion)
+            return None
+        self.deletion_popup.destroy()
+        self.deletion_popup = None
+        if progress.error:
+            text = f'Some files could not be deleted:\n{progress.error}'
+        elif self.deletion.stop_event.is_set():
+            text = f'Deletion cancelled, {progress.files_deleted} files have been deleted.'
+        else:
+            text = 'All images have been deleted.'
+        create_popup(text=text, close_btn='Ok', raise_over=self.frame)
+        self.deletion = None
         self.del_btn.state(['!disabled'])
         self.update_stats()
+        return None
+
+    # DATE LAYOUT
+    def start_migration(self):
+        ''' Switch to the date layout and move the existing pictures to their date directory '''
+        if self.migration is not None and self.migration.isrunning():
+            return None
+        if self.export_running() or self.deletion is not None:
+            # Files would disappear under the export
+            create_popup(text='Wait for the end of the current export or deletion.',
+                         close_btn='Ok', raise_over=self.frame)
+            return None
+        logging.info('Triggered migration to the date layout')
+        running = self.app.running_timelapse()
+        # The timelapse being captured stays in place
+        skip = [os.path.basename(running)] if running else []
+        self.migration = LayoutMigration(self.catalog, skip)
+        self.migrate_btn.state(['disabled'])
+        self.migration_progress = IntVar(value=0)
+        self.migration_popup = create_progress_popup(
+            text=f'Moving {self.migration.entries_total} pictures and timelapses '
+                 + 'to date directories...',
+            raise_over=self.frame, variable=self.migration_progress,
+            maximum=max(1, self.migration.entries_total))
+        cancel_btn = ttk.Button(self.migration_popup, text='Cancel', style='config.TButton',
+                                command=self.migration.cancel)
+        cancel_btn.grid(row=2, sticky='NS', ipadx=50, pady=10)
+        self.migration.start()
+        self.frame.after(100, self.check_migration)
+        return None
+
+    def check_migration(self):
+        ''' Poll the migration and refresh the progress popup '''
+        progress = self.migration.poll()
+        if progress is not None:
+            self.migration_progress.set(progress.entries_moved)
+        if progress is None or not progress.done:
+            self.frame.after(100, self.check_migration)
+            return None
+        self.migration_popup.destroy()
+        self.migration_popup = None
+        if progress.error:
+            text = f'Some pictures could not be moved:\n{progress.error}'
+        elif self.migration.stop_event.is_set():
+            text = f'Cancelled, {progress.entries_moved} entries have been moved.'
+        else:
+            text = 'New and existing pictures are now organized by date.'
+        create_popup(text=text, close_btn='Ok', raise_over=self.frame)
+        self.migration = None
+        self.migrate_btn.state(['!disabled'])
+        self.update_stats()
+        return None
 
     # EJECT USB
     def eject_usb(self):
-        if self.copy_manager.isrunning():
+        if self.export_running():
             logging.error("The copy manager is already happening.")
             return False
         target = os.path.join(MEDIA_FOLDER, str(self.cp_dev.get()))
@@ -414,7 +649,7 @@ class Settings:
             create_popup("Cancel",
                          f"Impossible to eject device, try again later:\n Error: {os.strerror(e.errno)}")
             logging.error('Error while ejecting device.', exc_info=True)
-        self.refresh_devices_list()
+        self.storage.rescan()
 
     def show_license(self, event=None):
         lic = ("OpenMicroView - Copyright (C) 2023 V. Salvadori\n\n"
@@ -426,45 +661,168 @@ class Settings:
         return event
 
     # COPY PICTURES
-    def trigger_copy(self, event):
+    def export_running(self) -> bool:
+        return (self.copy_manager.isrunning() or self.archive_exporter.isrunning()
+                or self.derivative_exporter.isrunning())
+
+    def confirm_move(self):
+        text = ('This will copy all pictures to the USB device and delete them\n'
+                + 'locally once their copy is verified. Continue ?')
+        create_popup(text=text, close_btn='Cancel', raise_over=self.frame,
+                     accept_btn='Move All', accept_callback=partial(self.trigger_copy, None, True))
+
+    def trigger_copy(self, event, move:bool=False):
         logging.debug(event)
         self.update_stats()
-        if self.copy_manager.isrunning():
+        if self.export_running():
             logging.error("Copy is already happening.")
             return False
         target = os.path.join(MEDIA_FOLDER, str(self.cp_dev.get()), USB_CP_DIR)
         self.copy_manager.source = self.images_path
         self.copy_manager.dest = target
-        self.show_popup_copying()
+        running = self.app.running_timelapse()
+        # Its directory would be removed between two frames
+        self.copy_manager.skip = [os.path.relpath(running, self.images_path)] if running else []
+        text = 'Moving pictures...' if move else 'Copying new pictures...'
+        self.show_popup_copying(self.copy_manager, text)
         logging.info("Starting copy to USB '%s'...", target)
-        self.copy_thread = threading.Thread(name='copyThread', target=self.start_copy, args=())
+        self.copy_thread = threading.Thread(name='copyThread', target=self.start_copy,
+                                            args=(self.copy_manager, move))
+        self.copy_thread.start()
+        return True
+
+    def confirm_archive(self):
+        ''' Choose the dates and timelapses to archive '''
+        self.catalog.refresh()
+        timelapses = [e.name for e in self.catalog.timelapses()]
+        popup = create_popup(text='Archive the pictures and timelapses captured between\n'
+                             + 'two dates (YYYY-MM-DD, empty: no limit). Select timelapses\n'
+                             + 'below to archive only them.',
+                             raise_over=self.frame, cols=2)
+        since, until = StringVar(), StringVar()
+        dates = Frame(popup, background='white')
+        dates.grid(row=1, columnspan=2, pady=5)
+        ttk.Label(dates, text='From').grid(row=0, column=0, padx=5)
+        ttk.Entry(dates, textvariable=since, width=12).grid(row=0, column=1, padx=5)
+        ttk.Label(dates, text='To').grid(row=0, column=2, padx=5)
+        ttk.Entry(dates, textvariable=until, width=12).grid(row=0, column=3, padx=5)
+        picker = Listbox(popup, selectmode=MULTIPLE, height=6, exportselection=False)
+        for name in timelapses:
+            picker.insert('end', os.path.basename(name))
+        picker.grid(row=2, columnspan=2, padx=30, pady=5, sticky='EW')
+
+        def archive():
+            try:
+                start, end = parse_date(since.get()), parse_date(until.get(), end=True)
+            except ValueError:
+                create_popup(text='Invalid date, expected YYYY-MM-DD.', close_btn='Ok',
+                             raise_over=popup)
+                return
+            chosen = [timelapses[i] for i in picker.curselection()] or None
+            if not select_entries(self.catalog, start, end, chosen):
+                create_popup(text='Nothing to archive in this selection.', close_btn='Ok',
+                             raise_over=popup)
+                return
+            popup.destroy()
+            self.trigger_archive(start=start, end=end, timelapses=chosen)
+
+        ttk.Button(popup, text='Cancel', style='config.TButton',
+                   command=popup.destroy).grid(row=3, column=0, sticky='NS', ipadx=50, pady=10)
+        ttk.Button(popup, text='Archive', style='config.TButton',
+                   command=archive).grid(row=3, column=1, sticky='NS', ipadx=50, pady=10)
+
+    def trigger_archive(self, entries:list=None, start=None, end=None, timelapses:list=None):
+        ''' Export entries (default: the selection, see select_entries) as tar volumes
+        on the selected device '''
+        self.update_stats()
+        if self.export_running():
+            logging.error("Copy is already happening.")
+            return False
+        target = os.path.join(MEDIA_FOLDER, str(self.cp_dev.get()), USB_CP_DIR)
+        self.archive_exporter.dest = target
+        self.archive_exporter.entries = entries
+        self.archive_exporter.start = start
+        self.archive_exporter.end = end
+        self.archive_exporter.timelapses = timelapses
+        self.show_popup_copying(self.archive_exporter, 'Archiving pictures...')
+        logging.info("Starting archive export to USB '%s'...", target)
+        self.copy_thread = threading.Thread(name='copyThread', target=self.start_copy,
+                                            args=(self.archive_exporter,))
         self.copy_thread.start()
         return True
 
-    def show_popup_copying(self):
+    def trigger_derivatives(self, entries:list=None):
+        ''' Export downscaled/recompressed copies of entries (default: all) '''
+        self.update_stats()
+        if self.export_running():
+            logging.error("Copy is already happening.")
+            return False
+        exporter = self.derivative_exporter
+        exporter.profile = PROFILES[self.derivative_profile.get()]
+        exporter.dest = os.path.join(MEDIA_FOLDER, str(self.cp_dev.get()), USB_CP_DIR)
+        exporter.entries = entries
+        self.show_popup_copying(exporter, f'Exporting copies ({exporter.profile.name})...')
+        logging.info("Starting derivatives export to USB '%s'...", exporter.dest)
+        self.copy_thread = threading.Thread(name='copyThread', target=self.start_copy,
+                                            args=(exporter,))
+        self.copy_thread.start()
+        return True
+
+    def show_popup_copying(self, exporter, text:str):
         logging.info('Copying pictures to USB...')
-        total = dir_size_bytes(self.images_path)
-        popup = create_progress_popup(text=f'Copying {B_to_readable(total)}...',
+        popup = create_progress_popup(text=text,
                                       raise_over=self.frame,
-                                      variable=self.copy_manager.progress_value,
-                                      status_var=self.copy_manager.transfered_size_str,
-                                      maximum=total)
+                                      variable=exporter.percent,
+                                      status_var=exporter.transfered_size_str,
+                                      maximum=100)
+        cancel_btn = ttk.Button(popup, text='Cancel', style='config.TButton',
+                                command=exporter.cancel)
+        cancel_btn.grid(row=2, sticky='NS', ipadx=50, pady=10)
         self.loading_frame = popup
 
-    def show_popup_copied(self):
+    def show_popup_copied(self, exporter, completed:bool):
         self.loading_frame.destroy()
         self.loading_frame = None
-        create_popup(text='All images have been copied.',
-                     close_btn='Ok', raise_over=self.frame)
+        n_files = exporter.transfered_files
+        size = B_to_readable(exporter.transfered_size)
+        if exporter is self.derivative_exporter:
+            text = (f'{n_files} copies exported ({size}).' if completed
+                    else f'Export interrupted after {n_files} copies.')
+            if exporter.failed_files:
+                text += f'\n{len(exporter.failed_files)} pictures could not be exported.'
+        elif exporter is self.archive_exporter:
+            text = (f'{n_files} files ({size}) archived in {len(exporter.volumes)} file(s).'
+                    if completed else
+                    f'Archive interrupted after {n_files} files, run it again to resume.')
+        elif not completed:
+            text = f'Copy interrupted after {n_files} files ({size}).'
+        elif exporter.move:
+            text = (f'{exporter.verified_files} files moved, '
+                    + f'{B_to_readable(exporter.freed_size)} freed locally.')
+            if exporter.failed_files:
+                text += f'\n{len(exporter.failed_files)} files could not be verified and were kept.'
+        else:
+            text = (f'All images have been copied ({n_files} new files, {size}).' if n_files
+                    else 'All images were already copied on this device.')
+        create_popup(text=text, close_btn='Ok', raise_over=self.frame)
         self.update_stats()
         return 0
 
     # @THREADED
-    def start_copy(self):
-        self.cp_btn.state(['disabled'])
-        self.ejct_btn.state(['disabled'])
+    def start_copy(self, exporter, move:bool=False):
+        for btn in (self.cp_btn, self.archive_btn, self.move_btn, self.derivative_btn,
+                    self.ejct_btn):
+            post(btn.state, ['disabled'])
         logging.info("Thread: Starting copy...")
-        self.copy_manager.execute()
-        self.show_popup_copied()
-        logging.info("Thread: Copy done.")
-        self.copy_thread = None
+        completed = False
+        try:
+            result = exporter.execute(move=True) if move else exporter.execute()
+            completed = result and not exporter.stop_event.is_set()
+        except Exception:  # pylint: disable=broad-except
+            logging.error('Error during the export.', exc_info=True)
+        finally:
+            # Buttons are enabled again whatever happened
+            post(partial(self.show_popup_copied, exporter, completed))
+            post(self.cp_selection)
+            logging.info("Thread: Copy done.")
+            self.copy_thread = None
@@ -0,0 +1,145 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+from .frame_stats import CHUNK, FrameStatsJob, frame_files, load_gray, read_sidecar
+
+# Sidecar of the timelapse directory, next to the statistics
+OFFSETS_FILE = '.omv_offsets.npy'
+# Longest edge of the frames decoded for the correlation
+STAB_SIZE = 256
+# One row per frame: translation of the frame content relative to the first
+# frame, in full resolution pixels, and height of the correlation peak (0-1)
+OFFSETS_DTYPE = np.dtype([('dx', '<f4'), ('dy', '<f4'), ('peak', '<f4')])
+# Offsets with a lower peak are not trusted (e.g. a dark or blurred frame)
+MIN_PEAK = 0.05
+# Offsets above this fraction of the frame size are not trusted either
+MAX_DRIFT = 0.25
+
+
+@lru_cache(maxsize=4)
+def hann_window(shape:tuple) -> np.ndarray:
+    ''' 2D Hann window: the frame edges do not correlate as a strong cross '''
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def spectrum(gray:np.ndarray) -> np.ndarray:
+    ''' Spectrum of a grayscale frame, as used by phase_correlation '''
+    return np.fft.rfft2((gray - gray.mean()) * hann_window(gray.shape))
+
+
+def _subpixel(before:float, peak:float, after:float) -> float:
+    ''' Position of the vertex of the parabola through the 3 points, relative to the middle one '''
+    curvature = before - 2 * peak + after
+    return 0.5 * (before - after) / curvature if curvature < 0 else 0.0
+
+
+def phase_correlation(reference:np.ndarray, spec:np.ndarray, shape:tuple) -> tuple:
+    ''' (dx, dy, peak): translation of the frame of spectrum spec relative to the reference '''
+    cross = spec * np.conj(reference)
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    corr = np.fft.irfft2(cross, s=shape)
+    h, w = shape
+    y, x = divmod(int(np.argmax(corr)), w)
+    peak = corr[y, x]
+    dy = y + _subpixel(corr[y - 1, x], peak, corr[(y + 1) % h, x])
+    dx = x + _subpixel(corr[y, x - 1], peak, corr[y, (x + 1) % w])
+    # The correlation is circular: the second half are negative translations
+    if dy > h / 2:
+        dy -= h
+    if dx > w / 2:
+        dx -= w
+    return dx, dy, peak
+
+
+def estimate_offsets(paths:list, reference:str, size:int = STAB_SIZE) -> np.ndarray:
+    ''' Offsets (OFFSETS_DTYPE) of the frames paths relative to the reference frame '''
+    offsets = np.full(len(paths), np.nan, dtype=OFFSETS_DTYPE)
+    try:
+        ref = load_gray(reference, size)
+    except (OSError, ValueError):
+        return offsets
+    ref_spec = spectrum(ref)
+    for i, path in enumerate(paths):
+        try:
+            with Image.open(path) as img:
+                width = img.width
+            gray = load_gray(path, size)
+        except (OSError, ValueError):
+            continue
+        if gray.shape != ref.shape:
+            continue
+        dx, dy, peak = phase_correlation(ref_spec, spectrum(gray), gray.shape)
+        scale = width / gray.shape[1]
+        offsets[i] = (dx * scale, dy * scale, peak)
+    return offsets
+
+
+def read_offsets(path:str) -> np.ndarray:
+    ''' Offsets of the timelapse directory path, None if not estimated yet '''
+    return read_sidecar(path, OFFSETS_FILE, OFFSETS_DTYPE)
+
+
+class StabilizationJob(FrameStatsJob):
+    """ Estimate the drift of every frame of a timelapse in the background.
+
+    Each frame is registered against the first one by phase correlation of
+    their downscaled (STAB_SIZE) luminance: the peak of the inverse FFT of
+    the normalized cross-power spectrum gives the translation. Tasks only
+    keep the spectrum of the reference and of the current frame, whatever
+    the length of the timelapse. Offsets are saved next to the frames
+    (OFFSETS_FILE) and applied as crops by stabilized_boxes.
+    """
+    NAME = 'offsets'
+    SIDECAR = OFFSETS_FILE
+    DTYPE = OFFSETS_DTYPE
+    function = staticmethod(estimate_offsets)
+
+    def task_args(self, files:list, start:int) -> tuple:
+        return files[start:start + CHUNK], files[0]
+
+
+def stabilized_boxes(path:str) -> dict:
+    ''' Crop box (left, top, right, bottom) of each frame of the timelapse directory path,
+    in full resolution pixels, so that the frames line up. None if not stabilized '''
+    offsets = read_offsets(path)
+    if offsets is None or len(offsets) == 0:
+        return None
+    try:
+        files = frame_files(path)
+        with Image.open(os.path.join(path, files[0])) as img:
+            width, height = img.size
+    except (OSError, ValueError, IndexError):
+        logging.warning('Impossible to read the frames of %s', path, exc_info=True)
+        return None
+    # Frames added since the estimation, or not trusted, keep the offset of the frame before
+    rows = np.full(len(files), np.nan, dtype=OFFSETS_DTYPE)
+    rows[:min(len(rows), len(offsets))] = offsets[:len(rows)]
+    dx, dy = rows['dx'].astype(np.float64), rows['dy'].astype(np.float64)
+    valid = ((rows['peak'] >= MIN_PEAK) & (np.abs(dx) <= MAX_DRIFT * width)
+             & (np.abs(dy) <= MAX_DRIFT * height))
+    valid[0] = True
+    dx[0] = dy[0] = 0
+    last = np.maximum.accumulate(np.where(valid, np.arange(len(rows)), 0))
+    dx, dy = np.rint(dx[last]).astype(int), np.rint(dy[last]).astype(int)
+    if dx.min() == dx.max() and dy.min() == dy.max():
+        return None
+    # Part of the first frame visible in every frame
+    w, h = width - int(dx.max() - dx.min()), height - int(dy.max() - dy.min())
+    left, top = dx - dx.min(), dy - dy.min()
+    return {f: (int(x), int(y), int(x) + w, int(y) + h) for f, x, y in zip(files, left, top)}
+
+
+def drift_range(path:str) -> tuple:
+    ''' (horizontal, vertical) extent of the drift in pixels, removed by the crops '''
+    boxes = stabilized_boxes(path)
+    if not boxes:
+        return 0, 0
+    lefts, tops = zip(*((box[0], box[1]) for box in boxes.values()))
+    return max(lefts) - min(lefts), max(tops) - min(tops)
@@ -0,0 +1,87 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def process_age() -> float:
+    ''' Seconds since the start of the process (interpreter start-up included), 0 if unknown '''
+    try:
+        with open('/proc/self/stat', 'rb') as f:
+            # The command name may contain spaces: fields are counted after it
+            start_ticks = int(f.read().rsplit(b')', 1)[1].split()[19])
+        with open('/proc/uptime', 'rb') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupTimeline:
+    """ Record the end of each startup phase and log the timeline at the first frame.
+
+    Phases are marked from the main thread as the application is built, the
+    camera thread reports the first preview frame: the duration of each phase
+    and the time-to-first-frame (from the start of the process) are then
+    logged once. UI built later on demand is timed with `timed()`.
+    """
+    def __init__(self, start:float=None):
+        self.start = start if start is not None else time.monotonic() - process_age()
+        # (phase, monotonic time at its end)
+        self.phases:list = [('interpreter', time.monotonic())]
+        self.first_frame_time:float = None
+        self.lock = threading.Lock()
+
+    def mark(self, phase:str):
+        ''' Mark the end of phase '''
+        with self.lock:
+            self.phases.append((phase, time.monotonic()))
+        logging.debug('Startup: %s done at %.2f s', phase, time.monotonic() - self.start)
+
+    def first_frame(self):
+        ''' Called for every preview frame, the timeline is logged after the first one '''
+        if self.first_frame_time is not None:
+            return
+        with self.lock:
+            if self.first_frame_time is not None:
+                return
+            self.first_frame_time = time.monotonic()
+        logging.info('Startup: %s', self.report())
+
+    def durations(self) -> list:
+        ''' Return [(phase, duration)] in order, the first frame included once shown '''
+        with self.lock:
+            phases = list(self.phases)
+            if self.first_frame_time is not None:
+                phases.append(('first frame', self.first_frame_time))
+        previous = self.start
+        result = []
+        for phase, end in sorted(phases, key=lambda p: p[1]):
+            result.append((phase, end - previous))
+            previous = end
+        return result
+
+    def report(self) -> str:
+        phases = ', '.join(f'{phase} {duration:.2f} s' for phase, duration in self.durations())
+        if self.first_frame_time is None:
+            return phases
+        return f'first frame after {self.first_frame_time - self.start:.2f} s ({phases})'
+
+    @contextmanager
+    def timed(self, what:str):
+        ''' Log how long the with block took, e.g. to build a panel on first use '''
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            logging.info('%s built in %.2f s', what, time.monotonic() - begin)
+
+
+timeline = StartupTimeline()
+mark = timeline.mark
+first_frame = timeline.first_frame
+timed = timeline.timed
@@ -0,0 +1,299 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import ctypes
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from typing import Callable
+
+from .utils import libc
+
+# USB storages are mounted as MEDIA_FOLDER/<user>/<label>
+MEDIA_FOLDER = '/media/'
+# The mount table signals its changes with POLLPRI
+MOUNTS = '/proc/self/mounts'
+DISKSTATS = '/proc/diskstats'
+SECTOR_SIZE = 512
+# Seconds between two samples of the free space and throughput
+SAMPLE_INTERVAL = 2.0
+# Seconds between two scans of MEDIA_FOLDER without inotify
+RESCAN_INTERVAL = 5.0
+
+# inotify(7)
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (followed by the name)
+
+if libc:
+    libc.inotify_init1.argtypes = (ctypes.c_int,)
+    libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+
+
+class Inotify:
+    """ Non-blocking inotify file descriptor, read when poll() reports it """
+    def __init__(self):
+        if not libc:
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"Error initialising inotify: {os.strerror(err)}")
+        self.watched:set = set()
+
+    def watch(self, path:str):
+        if path in self.watched:
+            return
+        if libc.inotify_add_watch(self.fd, path.encode(), WATCH_MASK) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"Error watching {path}: {os.strerror(err)}")
+        self.watched.add(path)
+
+    def read(self) -> list:
+        ''' Return the (mask, name) of the pending events '''
+        events = []
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            events.append((mask, data[offset:offset + length].rstrip(b'\0').decode(errors='replace')))
+            offset += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StorageInfo:
+    """ Free space and throughput of a storage (a USB device or the internal media folder) """
+    __slots__ = ('name', 'path', 'device', 'total', 'free', 'read_rate', 'write_rate')
+
+    def __init__(self, name:str, path:str):
+        self.name = name
+        self.path = path
+        self.device = block_device(path)
+        self.total = 0
+        self.free = 0
+        # bytes/s, None until two samples were taken
+        self.read_rate:float = None
+        self.write_rate:float = None
+
+    def __repr__(self):
+        return f"StorageInfo({self.name!r}, free={self.free}, device={self.device!r})"
+
+
+def block_device(path:str) -> str:
+    ''' Name of the block device (as in /proc/diskstats) holding path, None if unknown '''
+    try:
+        dev = os.stat(path).st_dev
+        return os.path.basename(os.path.realpath(f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'))
+    except OSError:
+        return None
+
+
+def list_storages(media_folder:str = MEDIA_FOLDER) -> list:
+    ''' Names (<user>/<label>) of the USB storages mounted in media_folder '''
+    storages = []
+    try:
+        users = os.listdir(media_folder)
+    except OSError:
+        return storages
+    for user in users:
+        abs_path = os.path.join(media_folder, user)
+        if not os.path.isdir(abs_path):
+            continue
+        try:
+            for usb in os.listdir(abs_path):
+                # Mount points not mounted yet belong to root
+                if os.lstat(os.path.join(abs_path, usb)).st_uid != 0:
+                    storages.append(os.path.join(user, usb))
+        except OSError:
+            logging.warning('Impossible to read %s', abs_path, exc_info=True)
+    return sorted(storages)
+
+
+class StorageMonitor:
+    """ Follow the USB storages and the free space of every target in the background.
+
+    Mounts and unmounts are detected as they happen: the mount table is
+    polled for changes and MEDIA_FOLDER is watched with inotify (mount
+    points created and removed). Without inotify, MEDIA_FOLDER is scanned
+    every RESCAN_INTERVAL seconds. Free space and read/write throughput of
+    the storages are sampled every SAMPLE_INTERVAL seconds. Subscribers are
+    called from the monitor thread with the storages and whether the list
+    of USB storages changed.
+    """
+    def __init__(self, internal:str, media_folder:str = MEDIA_FOLDER,
+                 interval:float = SAMPLE_INTERVAL):
+        self.media_folder = media_folder
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.internal = StorageInfo('internal', internal)
+        # USB storage name: StorageInfo
+        self._storages:dict = {}
+        self.subscribers:list = []
+        self.stop_event = threading.Event()
+        self.thread:threading.Thread = None
+        # Written to wake the monitor thread up (rescan, stop)
+        self._wake_r, self._wake_w = os.pipe()
+        self._rescan = threading.Event()
+        # Device: (read sectors, written sectors, monotonic time)
+        self._sectors:dict = {}
+        self.event_driven = False
+
+    def subscribe(self, callback:Callable[[list, bool], None]):
+        ''' callback(storages, changed) is called from the monitor thread '''
+        self.subscribers.append(callback)
+
+    def start(self):
+        if self.thread is not None or self.stop_event.is_set():
+            return
+        self.thread = threading.Thread(name='storageMonitor', target=self.run, args=(), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        os.write(self._wake_w, b'\0')
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+
+    def rescan(self):
+        ''' Scan MEDIA_FOLDER again as soon as possible (e.g. after an eject) '''
+        self._rescan.set()
+        os.write(self._wake_w, b'\0')
+
+    def storages(self) -> list:
+        ''' Mounted USB storages, sorted by name '''
+        with self.lock:
+            return [self._storages[name] for name in sorted(self._storages)]
+
+    def get(self, name:str) -> StorageInfo:
+        with self.lock:
+            return self._storages.get(name)
+
+    def run(self):
+        ''' @Threaded - Wait for mount events, sample the storages in between '''
+        poller = select.poll()
+        poller.register(self._wake_r, select.POLLIN)
+        inotify = mounts = None
+        try:
+            inotify = Inotify()
+            poller.register(inotify.fd, select.POLLIN)
+        except OSError:
+            logging.warning('inotify not available, %s scanned every %.0f s.',
+                            self.media_folder, RESCAN_INTERVAL, exc_info=True)
+        try:
+            mounts = os.open(MOUNTS, os.O_RDONLY)
+            os.read(mounts, 1 << 16)
+            poller.register(mounts, select.POLLPRI)
+        except OSError:
+            logging.warning('Impossible to follow the mount table.', exc_info=True)
+            mounts = None
+        self.event_driven = inotify is not None
+        next_sample = next_scan = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                if self._rescan.is_set() or now >= next_scan:
+                    self._rescan.clear()
+                    self._scan(inotify)
+                    next_scan = now + RESCAN_INTERVAL if inotify is None else float('inf')
+                if now >= next_sample:
+                    self._sample()
+                    next_sample = now + self.interval
+                timeout = max(0, min(next_sample, next_scan) - time.monotonic())
+                for fd, _ in poller.poll(timeout * 1000):
+                    if fd == self._wake_r:
+                        os.read(self._wake_r, 64)
+                    elif inotify is not None and fd == inotify.fd:
+                        if inotify.read():
+                            self._rescan.set()
+                    elif fd == mounts:
+                        # Read again to be notified of the next change
+                        os.lseek(mounts, 0, os.SEEK_SET)
+                        while os.read(mounts, 1 << 16):
+                            pass
+                        self._rescan.set()
+        finally:
+            if inotify is not None:
+                inotify.close()
+            if mounts is not None:
+                os.close(mounts)
+
+    def _scan(self, inotify:Inotify = None):
+        ''' Update the list of USB storages, notify the subscribers if it changed '''
+        if inotify is not None:
+            try:
+                inotify.watch(self.media_folder)
+                for user in os.listdir(self.media_folder):
+                    path = os.path.join(self.media_folder, user)
+                    if os.path.isdir(path):
+                        inotify.watch(path)
+            except OSError:
+                logging.warning('Impossible to watch %s', self.media_folder, exc_info=True)
+            # Removed directories are not watched anymore
+            inotify.watched = {p for p in inotify.watched if os.path.isdir(p)}
+        names = list_storages(self.media_folder)
+        with self.lock:
+            if names == sorted(self._storages):
+                return
+            previous = self._storages
+            self._storages = {name: previous.get(name)
+                              or StorageInfo(name, os.path.join(self.media_folder, name))
+                              for name in names}
+        added = set(names) - set(previous)
+        removed = set(previous) - set(names)
+        logging.info('USB storages: %s (added: %s, removed: %s)', names or 'none',
+                     sorted(added) or '-', sorted(removed) or '-')
+        self._sample(changed=True)
+
+    def _sample(self, changed:bool = False):
+        ''' Update the free space and throughput of every storage, notify the subscribers '''
+        storages = [self.internal] + self.storages()
+        sectors = self._read_diskstats()
+        now = time.monotonic()
+        for storage in storages:
+            try:
+                st = os.statvfs(storage.path)
+                storage.total = st.f_blocks * st.f_frsize
+                storage.free = st.f_bavail * st.f_frsize
+            except OSError:
+                storage.total = storage.free = 0
+            current = sectors.get(storage.device)
+            previous = self._sectors.get(storage.device)
+            if current is not None and previous is not None and now > previous[2]:
+                elapsed = now - previous[2]
+                storage.read_rate = max(0, current[0] - previous[0]) * SECTOR_SIZE / elapsed
+                storage.write_rate = max(0, current[1] - previous[1]) * SECTOR_SIZE / elapsed
+        self._sectors = {device: (r, w, now) for device, (r, w) in sectors.items()}
+        for callback in self.subscribers:
+            try:
+                callback(storages, changed)
+            except Exception:  # pylint: disable=broad-except
+                logging.error('Storage monitor subscriber error.', exc_info=True)
+
+    def _read_diskstats(self) -> dict:
+        ''' (read sectors, written sectors) of the devices of the storages '''
+        devices = {s.device for s in [self.internal] + self.storages() if s.device}
+        result = {}
+        try:
+            with open(DISKSTATS, 'rb') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 10 and parts[2].decode() in devices:
+                        result[parts[2].decode()] = (int(parts[5]), int(parts[9]))
+        except OSError:
+            pass
+        return result
@@ -0,0 +1,310 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import json as Json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from math import isnan, nan
+from typing import Callable
+
+# Seconds between two samples
+SAMPLE_INTERVAL = 1.0
+# Samples kept in memory for each field (10 min at 1 Hz)
+HISTORY_SIZE = 600
+TELEMETRY_LOG = './telemetry.bin'
+# The log is rotated (previous one kept as .1) above this size
+TELEMETRY_LOG_MAX_SIZE = 16 * 1024 * 1024
+# Seconds between two writes of the log to the SD card
+LOG_FLUSH_INTERVAL = 30
+
+THERMAL_FILE = '/sys/class/thermal/thermal_zone0/temp'
+THROTTLED_FILE = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+SD_DEVICE = re.compile(rb'mmcblk\d+$')
+USB_DEVICE = re.compile(rb'sd[a-z]+$')
+SECTOR_SIZE = 512
+# Bits of get_throttled
+THROTTLED_FLAGS = {0: 'under-voltage', 1: 'frequency capped', 2: 'throttled',
+                   3: 'soft temperature limit'}
+
+
+def throttled_str(flags:int) -> str:
+    ''' Describe the current throttling flags, e.g. "under-voltage, throttled" '''
+    if isnan(flags):
+        return '?'
+    flags = int(flags)
+    return ', '.join(v for k, v in THROTTLED_FLAGS.items() if flags & (1 << k)) or 'ok'
+
+
+class RingBuffer:
+    """ Fixed-size history of float values, backed by an array """
+    def __init__(self, capacity:int, typecode:str='f'):
+        self.data = array(typecode, [nan] * capacity)
+        self.capacity = capacity
+        self.index = 0
+        self.count = 0
+
+    def append(self, value:float):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def last(self) -> float:
+        return self.data[self.index - 1] if self.count else nan
+
+    def values(self) -> list:
+        ''' Values from the oldest to the latest '''
+        if self.count < self.capacity:
+            return self.data[:self.count].tolist()
+        return (self.data[self.index:] + self.data[:self.index]).tolist()
+
+    def __len__(self):
+        return self.count
+
+
+class _Source:
+    """ File opened once and read again from its beginning at each sample """
+    def __init__(self, path:str, size:int=8192):
+        self.path = path
+        self.size = size
+        self.fd = None
+        self.disabled = False
+
+    def read(self) -> bytes:
+        if self.disabled:
+            return None
+        try:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY)
+            return os.pread(self.fd, self.size, 0)
+        except OSError as e:
+            logging.warning('Telemetry: %s not available (%s).', self.path, e.strerror)
+            self.disabled = True
+            self.close()
+            return None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Telemetry:
+    """ Sample the state of the system at a fixed interval.
+
+    SoC temperature, CPU load (total and per core), memory, SD and USB I/O
+    throughput, free space of the media folder and throttling flags are kept
+    in ring buffers, passed to the subscribers and appended to a compact
+    binary log (see read_log) to correlate capture hiccups with the system.
+    """
+    def __init__(self, media_path:str, interval:float=SAMPLE_INTERVAL,
+                 history:int=HISTORY_SIZE, log_path:str=TELEMETRY_LOG):
+        self.media_path = media_path
+        self.interval = interval
+        self.log_path = log_path
+        self.n_cpu = os.cpu_count() or 1
+        self.fields = (['temperature', 'cpu'] + [f'cpu{i}' for i in range(self.n_cpu)]
+                       + ['mem_used', 'mem_available', 'sd_read', 'sd_write',
+                          'usb_read', 'usb_write', 'free_space', 'throttled'])
+        self.history = {f: RingBuffer(history) for f in self.fields}
+        self.timestamps = RingBuffer(history, 'd')
+        self.sources = {'temperature': _Source(THERMAL_FILE, 64),
+                        'stat': _Source('/proc/stat'),
+                        'meminfo': _Source('/proc/meminfo'),
+                        'diskstats': _Source('/proc/diskstats', 32768),
+                        'throttled': _Source(THROTTLED_FILE, 64)}
+        self.subscribers:list = []
+        self.stop_event = threading.Event()
+        self.thread:threading.Thread = None
+        self._record = struct.Struct(f'<d{len(self.fields)}f')
+        self._log = None
+        self._last_flush = 0
+        self._cpu_times:dict = {}
+        self._disk_sectors:tuple = None
+        self._last_sample:float = None
+
+    def subscribe(self, callback:Callable[[dict], None]):
+        ''' callback(sample) is called from the telemetry thread after each sample '''
+        self.subscribers.append(callback)
+
+    def start(self):
+        if self.stop_event.is_set():
+            # Closed before being started
+            return
+        self.thread = threading.Thread(name='telemetryThread', target=self.run, args=())
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2.0)
+
+    def latest(self, field:str) -> float:
+        return self.history[field].last()
+
+    def run(self):
+        ''' @Threaded - Sample, store and publish until stopped '''
+        logging.info('Starting telemetry...')
+        self.open_log()
+        next_sample = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                sample = self.sample()
+                self.store(sample)
+                for callback in self.subscribers:
+                    try:
+                        callback(sample)
+                    except Exception:  # pylint: disable=broad-except
+                        logging.error('Telemetry subscriber error.', exc_info=True)
+                next_sample += self.interval
+                self.stop_event.wait(max(0, next_sample - time.monotonic()))
+        finally:
+            for source in self.sources.values():
+                source.close()
+            self.close_log()
+
+    # SAMPLING
+    def sample(self) -> dict:
+        now = time.monotonic()
+        elapsed = now - self._last_sample if self._last_sample is not None else None
+        self._last_sample = now
+        sample = {'time': time.time()}
+        sample['temperature'] = self._temperature()
+        sample.update(self._cpu())
+        sample.update(self._memory())
+        sample.update(self._disks(elapsed))
+        try:
+            st = os.statvfs(self.media_path)
+            sample['free_space'] = st.f_bavail * st.f_frsize / 1024 / 1024  # MB
+        except OSError:
+            sample['free_space'] = nan
+        data = self.sources['throttled'].read()
+        sample['throttled'] = float(int(data.split(b'=')[-1], 16)) if data else nan
+        return sample
+
+    def _temperature(self) -> float:
+        data = self.sources['temperature'].read()
+        return int(data) / 1000 if data else nan
+
+    def _cpu(self) -> dict:
+        ''' Load (%) of all cores and of each core since the previous sample '''
+        result = {'cpu': nan}
+        result.update({f'cpu{i}': nan for i in range(self.n_cpu)})
+        data = self.sources['stat'].read()
+        if not data:
+            return result
+        for line in data.split(b'\n'):
+            if not line.startswith(b'cpu'):
+                break
+            parts = line.split()
+            name = parts[0].decode()
+            values = [int(v) for v in parts[1:]]
+            idle = values[3] + values[4]  # idle + iowait
+            total = sum(values[:8])
+            previous = self._cpu_times.get(name)
+            self._cpu_times[name] = (idle, total)
+            if previous is not None and total > previous[1] and name in result:
+                result[name] = 100 * (1 - (idle - previous[0]) / (total - previous[1]))
+        return result
+
+    def _memory(self) -> dict:
+        data = self.sources['meminfo'].read()
+        if not data:
+            return {'mem_used': nan, 'mem_available': nan}
+        info = {}
+        for line in data.split(b'\n'):
+            key, _, value = line.partition(b':')
+            if key in (b'MemTotal', b'MemAvailable'):
+                info[key] = int(value.split()[0])  # kB
+        total, available = info.get(b'MemTotal'), info.get(b'MemAvailable')
+        if not total or available is None:
+            return {'mem_used': nan, 'mem_available': nan}
+        return {'mem_used': 100 * (1 - available / total), 'mem_available': available / 1024}
+
+    def _disks(self, elapsed:float) -> dict:
+        ''' Read and write throughput (bytes/s) of the SD card and USB storages '''
+        result = {'sd_read': nan, 'sd_write': nan, 'usb_read': nan, 'usb_write': nan}
+        data = self.sources['diskstats'].read()
+        if not data:
+            return result
+        sectors = [0, 0, 0, 0]  # sd read/write, usb read/write
+        for line in data.split(b'\n'):
+            parts = line.split()
+            if len(parts) < 10:
+                continue
+            if SD_DEVICE.match(parts[2]):
+                sectors[0] += int(parts[5])
+                sectors[1] += int(parts[9])
+            elif USB_DEVICE.match(parts[2]):
+                sectors[2] += int(parts[5])
+                sectors[3] += int(parts[9])
+        previous, self._disk_sectors = self._disk_sectors, sectors
+        if previous is not None and elapsed:
+            for key, new, old in zip(result, sectors, previous):
+                # USB storages may have been removed since the last sample
+                result[key] = max(0, new - old) * SECTOR_SIZE / elapsed
+        return result
+
+    # HISTORY & LOG
+    def store(self, sample:dict):
+        self.timestamps.append(sample['time'])
+        for field in self.fields:
+            self.history[field].append(sample[field])
+        if self._log is not None:
+            try:
+                self._log.write(self._record.pack(sample['time'], *(sample[f] for f in self.fields)))
+                if time.monotonic() - self._last_flush > LOG_FLUSH_INTERVAL:
+                    self._log.flush()
+                    self._last_flush = time.monotonic()
+                    if self._log.tell() > TELEMETRY_LOG_MAX_SIZE:
+                        self.close_log()
+                        os.replace(self.log_path, self.log_path + '.1')
+                        self.open_log()
+            except OSError:
+                logging.error('Impossible to write telemetry log.', exc_info=True)
+                self.close_log()
+
+    def open_log(self):
+        ''' Append to the log, a header line with the fields is written in new logs '''
+        if not self.log_path:
+            return
+        try:
+            self._log = open(self.log_path, 'ab')
+            if self._log.tell() == 0:
+                header = {'fields': self.fields, 'format': self._record.format}
+                self._log.write(Json.dumps(header).encode() + b'\n')
+            elif read_log_header(self.log_path) != self.fields:
+                # Different fields (e.g. other CPU): start a new log
+                self._log.close()
+                os.replace(self.log_path, self.log_path + '.1')
+                self.open_log()
+        except (OSError, ValueError):
+            logging.error('Impossible to open telemetry log %s', self.log_path, exc_info=True)
+            self._log = None
+
+    def close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def read_log_header(path:str) -> list:
+    with open(path, 'rb') as f:
+        return Json.loads(f.readline())['fields']
+
+
+def read_log(path:str = TELEMETRY_LOG):
+    ''' Yield the samples ({'time': ..., field: value}) of a telemetry log '''
+    with open(path, 'rb') as f:
+        header = Json.loads(f.readline())
+        record = struct.Struct(header['format'])
+        fields = ['time'] + header['fields']
+        while True:
+            data = f.read(record.size)
+            if len(data) < record.size:
+                return
+            yield dict(zip(fields, record.unpack(data)))
@@ -0,0 +1,98 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import time
+from math import isnan
+
+from .microscope_camera import PREVIEW_WIDTH, Camera
+
+
+class PreviewLevel:
+    """ Live preview limits applied above a given SoC temperature """
+    def __init__(self, temperature:float, fps:float=None, width:int=PREVIEW_WIDTH,
+                 paused:bool=False):
+        self.temperature = temperature
+        self.fps = fps
+        self.width = width
+        self.paused = paused
+
+    def __repr__(self):
+        if self.paused:
+            return f"PreviewLevel({self.temperature}°C, paused)"
+        return f"PreviewLevel({self.temperature}°C, {self.fps or 'max'} fps, {self.width}px)"
+
+
+# The Pi firmware throttles the CPU at 80-85°C (soft limit at 60°C on some models)
+PREVIEW_LEVELS = [
+    PreviewLevel(0),
+    PreviewLevel(65, fps=10),
+    PreviewLevel(70, fps=5, width=160),
+    PreviewLevel(75, fps=2, width=120),
+    PreviewLevel(78, paused=True),
+]
+# A level is left when the temperature is this much below its threshold...
+HYSTERESIS = 5
+# ...for at least x seconds
+RESTORE_DELAY = 60
+# Minimum delay between two steps down, to let the temperature react
+STEP_INTERVAL = 10
+# get_throttled bits: frequency capped, throttled, soft temperature limit (currently)
+THROTTLED_MASK = 0b1110
+
+
+class ThermalGovernor:
+    """ Lower the live preview framerate and resolution as the SoC heats up.
+
+    Fed with telemetry samples: the preview is stepped down one level at a
+    time when the temperature reaches the threshold of the next level or when
+    the firmware reports throttling, and restored one level at a time once the
+    temperature stayed below the current threshold minus HYSTERESIS for
+    RESTORE_DELAY seconds. The capture path always keeps the CPU headroom.
+    """
+    def __init__(self, camera:Camera, levels:list=None):
+        self.camera = camera
+        self.levels = levels if levels is not None else PREVIEW_LEVELS
+        self.level = 0
+        self._last_step = 0
+        self._cool_since:float = None
+
+    def update(self, sample:dict):
+        ''' Telemetry subscriber '''
+        temperature = sample.get('temperature', float('nan'))
+        throttled = sample.get('throttled', float('nan'))
+        throttled = not isnan(throttled) and int(throttled) & THROTTLED_MASK
+        if isnan(temperature) and not throttled:
+            return
+        now = time.monotonic()
+        target = self.level
+        if not isnan(temperature):
+            while (target + 1 < len(self.levels)
+                   and temperature >= self.levels[target + 1].temperature):
+                target += 1
+        if throttled:
+            target = max(target, self.level + 1)
+        target = min(target, len(self.levels) - 1)
+
+        if target > self.level:
+            self._cool_since = None
+            if now - self._last_step >= STEP_INTERVAL:
+                self.set_level(self.level + 1, temperature, throttled)
+                self._last_step = now
+        elif (self.level > 0 and not throttled
+              and temperature < self.levels[self.level].temperature - HYSTERESIS):
+            if self._cool_since is None:
+                self._cool_since = now
+            elif now - self._cool_since >= RESTORE_DELAY:
+                self.set_level(self.level - 1, temperature, throttled)
+                self._cool_since = None
+        else:
+            self._cool_since = None
+
+    def set_level(self, level:int, temperature:float=None, throttled:bool=False):
+        previous, self.level = self.level, level
+        limits = self.levels[level]
+        log = logging.warning if level > previous else logging.info
+        log('Thermal governor: %.1f°C%s, preview level %d -> %d %s', temperature,
+            ' (throttled)' if throttled else '', previous, level, limits)
+        self.camera.set_preview_limits(limits.fps, limits.width, limits.paused)
@@ -0,0 +1,280 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import math
+import os
+from collections import OrderedDict
+from tkinter import Canvas, Frame, StringVar, ttk
+
+from PIL import Image, ImageTk
+
+from .memory_budget import PREFETCH, VISIBLE, image_bytes, register
+
+# Size (in screen pixels) of a displayed tile
+TILE_SIZE = 256
+# Pyramid levels: 1, 1/2, 1/4, 1/8. JPEG decoders can produce these scales
+# directly (DCT scaling) which makes decoding a reduced level cheap.
+PYRAMID_LEVELS = 4
+# Maximum number of rendered tiles kept in memory
+TILE_CACHE_SIZE = 48
+# Maximum number of decoded pyramid levels kept in memory
+LEVEL_CACHE_SIZE = 2
+# Maximum zoom, in screen pixels per picture pixel
+MAX_ZOOM = 2.0
+
+
+class LRUCache:
+    """ Least Recently Used cache with a fixed number of entries """
+    def __init__(self, capacity:int):
+        self.capacity = max(1, int(capacity))
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            # Entries can be popped by other threads (memory budget)
+            self._data.move_to_end(key)
+            return self._data[key]
+        except KeyError:
+            return default
+
+    def put(self, key, value) -> list:
+        ''' Add an entry, return the keys of the entries dropped to make room '''
+        self._data[key] = value
+        self._data.move_to_end(key)
+        dropped = []
+        while len(self._data) > self.capacity:
+            dropped.append(self._data.popitem(last=False)[0])
+        return dropped
+
+    def pop(self, key):
+        return self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+class TilePyramid:
+    """ Picture split in tiles over a few downscaled levels.
+
+    Levels are decoded on demand (reduced levels use the JPEG draft mode) and
+    only the requested tiles are cropped and rendered. Both decoded levels and
+    rendered tiles are kept in LRU caches so the memory usage stays bounded.
+    Both are accounted in the memory budget: the decoded levels and the tiles
+    out of view can be evicted, and are rendered again when needed.
+    """
+    def __init__(self, path:str, tile_size:int=TILE_SIZE, levels:int=PYRAMID_LEVELS,
+                 cache_size:int=TILE_CACHE_SIZE):
+        self.path = path
+        self.tile_size = tile_size
+        with Image.open(path) as img:
+            self.width, self.height = img.size
+        # Do not create levels smaller than a single tile
+        smallest = max(1, min(self.width, self.height))
+        self.levels = max(1, min(levels, int(math.log2(max(1, smallest / tile_size))) + 1))
+        self._levels = LRUCache(LEVEL_CACHE_SIZE)
+        self._tiles = LRUCache(cache_size)
+        # Keys of the tiles displayed
+        self.visible:set = set()
+        self.budget = register(f'picture {os.path.basename(path)}', self.evict)
+
+    def level_size(self, level:int) -> tuple:
+        return (max(1, math.ceil(self.width / 2 ** level)),
+                max(1, math.ceil(self.height / 2 ** level)))
+
+    def level_for_zoom(self, zoom:float) -> int:
+        ''' Return the smallest level having at least the resolution required by zoom '''
+        if zoom >= 1:
+            return 0
+        level = int(math.floor(math.log2(1 / zoom)))
+        return min(max(level, 0), self.levels - 1)
+
+    def _level_image(self, level:int) -> Image.Image:
+        img = self._levels.get(level)
+        if img is not None:
+            return img
+        size = self.level_size(level)
+        logging.debug('Decoding level %d (%dx%d) of %s', level, size[0], size[1], self.path)
+        with Image.open(self.path) as src:
+            # For JPEG pictures, decode at reduced scale instead of full resolution
+            src.draft('RGB', size)
+            img = src.convert('RGB')
+        if img.size != size:
+            img = img.resize(size, Image.BILINEAR)
+        for dropped in self._levels.put(level, img):
+            self.budget.remove(('level', dropped))
+        self.budget.add(('level', level), image_bytes(*size, channels=3), PREFETCH)
+        return img
+
+    def tile(self, zoom:float, col:int, row:int) -> ImageTk.PhotoImage:
+        ''' Return the displayed tile (col, row) of the picture scaled at zoom '''
+        key = (zoom, col, row)
+        photo = self._tiles.get(key)
+        if photo is not None:
+            return photo
+        level = self.level_for_zoom(zoom)
+        scale = zoom * 2 ** level  # Scale between level pixels and screen pixels
+        display_w, display_h = self.display_size(zoom)
+        x0, y0 = col * self.tile_size, row * self.tile_size
+        x1 = min(x0 + self.tile_size, display_w)
+        y1 = min(y0 + self.tile_size, display_h)
+        img = self._level_image(level)
+        box = (int(x0 / scale), int(y0 / scale),
+               min(img.width, math.ceil(x1 / scale)), min(img.height, math.ceil(y1 / scale)))
+        region = img.crop(box)
+        if region.size != (x1 - x0, y1 - y0):
+            resample = Image.BILINEAR if scale < 1 else Image.NEAREST
+            region = region.resize((x1 - x0, y1 - y0), resample)
+        photo = ImageTk.PhotoImage(region)
+        for dropped in self._tiles.put(key, photo):
+            self.budget.remove(('tile',) + dropped)
+        # About to be displayed
+        self.budget.add(('tile',) + key, image_bytes(*region.size), VISIBLE)
+        return photo
+
+    def set_visible(self, keys:set):
+        ''' Tiles displayed (zoom, col, row): the others can be evicted '''
+        for key in self.visible - keys:
+            self.budget.set_priority(('tile',) + key, PREFETCH)
+        for key in keys - self.visible:
+            self.budget.set_priority(('tile',) + key, VISIBLE)
+        self.visible = keys
+
+    def evict(self, key:tuple):
+        ''' Memory budget exceeded: drop a decoded level or a tile '''
+        if key[0] == 'level':
+            self._levels.pop(key[1])
+        else:
+            self._tiles.pop(key[1:])
+
+    def display_size(self, zoom:float) -> tuple:
+        return (max(1, round(self.width * zoom)), max(1, round(self.height * zoom)))
+
+    def tiles_in(self, zoom:float, box:tuple):
+        ''' Yield the (col, row) of tiles intersecting box (screen coordinates) '''
+        display_w, display_h = self.display_size(zoom)
+        x0, y0, x1, y1 = box
+        col0 = max(0, int(x0 // self.tile_size))
+        row0 = max(0, int(y0 // self.tile_size))
+        col1 = min(math.ceil(display_w / self.tile_size), math.ceil(x1 / self.tile_size))
+        row1 = min(math.ceil(display_h / self.tile_size), math.ceil(y1 / self.tile_size))
+        for row in range(row0, row1):
+            for col in range(col0, col1):
+                yield col, row
+
+    def clear(self):
+        self._tiles.clear()
+        self._levels.clear()
+        self.visible = set()
+        self.budget.clear()
+
+
+class TileViewer(Frame):
+    """ Zoom and pan viewer displaying only the visible tiles of a TilePyramid """
+    def __init__(self, master, path:str, width:int=700, height:int=350, **kwargs):
+        Frame.__init__(self, master, background='white', **kwargs)
+        self.pyramid = TilePyramid(path)
+        self.view_w, self.view_h = width, height
+        fit = min(width / self.pyramid.width, height / self.pyramid.height, MAX_ZOOM)
+        # Zoom steps: fit, then doubling until 100%, then MAX_ZOOM
+        self.zooms = [fit]
+        while self.zooms[-1] * 2 < 1:
+            self.zooms.append(self.zooms[-1] * 2)
+        for z in (1.0, MAX_ZOOM):
+            if z > self.zooms[-1]:
+                self.zooms.append(z)
+        self.zoom_index = 0
+        # Center of the view, in picture coordinates
+        self.center = [self.pyramid.width / 2, self.pyramid.height / 2]
+        self._drag = None
+        self.tk_zoom = StringVar()
+
+        self.canvas = Canvas(self, width=width, height=height, background='#FFFEFD',
+                             highlightthickness=0)
+        self.canvas.pack(side='top')
+        self.canvas.bind('<ButtonPress-1>', self.start_drag)
+        self.canvas.bind('<B1-Motion>', self.drag)
+        self.canvas.bind('<Double-Button-1>', self.zoom_at)
+        self.canvas.bind('<Button-4>', lambda e: self.zoom_at(e, 1))
+        self.canvas.bind('<Button-5>', lambda e: self.zoom_at(e, -1))
+
+        toolbar = Frame(self, background='white')
+        toolbar.place(relx=1, rely=0, anchor='ne')
+        ttk.Button(toolbar, text=' - ', style='config.TButton',
+                   command=lambda: self.set_zoom(self.zoom_index - 1)).pack(side='left')
+        ttk.Label(toolbar, textvariable=self.tk_zoom, width=5, anchor='c').pack(side='left')
+        ttk.Button(toolbar, text=' + ', style='config.TButton',
+                   command=lambda: self.set_zoom(self.zoom_index + 1)).pack(side='left')
+        self.set_zoom(0)
+
+    @property
+    def zoom(self) -> float:
+        return self.zooms[self.zoom_index]
+
+    def set_zoom(self, index:int, anchor:tuple=None):
+        ''' Change zoom step, keeping the picture point under anchor (screen coords) in place '''
+        index = min(max(index, 0), len(self.zooms) - 1)
+        if anchor is not None:
+            old = self.zoom
+            # Picture point under the anchor before zooming
+            px = self.center[0] + (anchor[0] - self.view_w / 2) / old
+            py = self.center[1] + (anchor[1] - self.view_h / 2) / old
+            new = self.zooms[index]
+            self.center = [px - (anchor[0] - self.view_w / 2) / new,
+                           py - (anchor[1] - self.view_h / 2) / new]
+        self.zoom_index = index
+        self.tk_zoom.set(f'{round(self.zoom * 100)}%')
+        self.render()
+
+    def zoom_at(self, event, step:int=1):
+        self.set_zoom(self.zoom_index + step, anchor=(event.x, event.y))
+
+    def start_drag(self, event):
+        self._drag = (event.x, event.y)
+
+    def drag(self, event):
+        if self._drag is None:
+            return
+        dx, dy = event.x - self._drag[0], event.y - self._drag[1]
+        self._drag = (event.x, event.y)
+        self.center[0] -= dx / self.zoom
+        self.center[1] -= dy / self.zoom
+        self.render()
+
+    def _clamp_center(self):
+        ''' Keep the picture inside the view, centered when smaller than the view '''
+        for axis, (size, view) in enumerate(((self.pyramid.width, self.view_w),
+                                             (self.pyramid.height, self.view_h))):
+            half = view / 2 / self.zoom
+            if size <= 2 * half:
+                self.center[axis] = size / 2
+            else:
+                self.center[axis] = min(max(self.center[axis], half), size - half)
+
+    def render(self):
+        ''' Composite the tiles visible in the viewport '''
+        self._clamp_center()
+        zoom = self.zoom
+        # Top left corner of the view, in displayed picture coordinates
+        left = self.center[0] * zoom - self.view_w / 2
+        top = self.center[1] * zoom - self.view_h / 2
+        box = (left, top, left + self.view_w, top + self.view_h)
+        self.canvas.delete('tile')
+        visible = set()
+        for col, row in self.pyramid.tiles_in(zoom, box):
+            photo = self.pyramid.tile(zoom, col, row)
+            x = col * self.pyramid.tile_size - left
+            y = row * self.pyramid.tile_size - top
+            self.canvas.create_image(round(x), round(y), image=photo, anchor='nw', tags='tile')
+            visible.add((zoom, col, row))
+        self.pyramid.set_visible(visible)
+
+    def destroy(self):
+        self.pyramid.clear()
+        Frame.destroy(self)
@@ -7,13 +7,17 @@ import threading
 from datetime import datetime, timedelta
 from functools import partial
 from queue import Queue
-from time import sleep
+from time import monotonic, sleep
 from tkinter import HORIZONTAL, IntVar, StringVar, ttk
 
 from picamera.exc import PiCameraRuntimeError
-from PIL import Image, ImageTk
+from PIL import Image
 
-from .utils import time_str
+from .encoding import TIMELAPSE
+from .media_catalog import entry_dir
+from .tracing import span
+from .ui_dispatcher import post
+from .utils import B_to_readable, create_popup, time_str
 from .microscope import Microscope
 
 # Switch Light on before x sec at each Timelapse picture
@@ -22,12 +26,32 @@ AUTOLIGHT_INTERVAL = 3
 # Minimum interval to automatically switch off the light
 MIN_INTERVAL_AUTOLIGHT = 15
 
+# Frames which must fit in the media folder when the timelapse has no auto stop
+MIN_FREE_FRAMES = 100
+
+
+def space_check(microscope:Microscope, frames:int) -> tuple:
+    ''' Return (free bytes, expected frame size, True if frames (0: no limit) fit) '''
+    camera = microscope.camera
+    frame = max(1, camera.encoder.frame_size(TIMELAPSE, camera.camera.resolution))
+    free = microscope.storage.internal.free
+    if not microscope.storage.internal.total:
+        # Not sampled yet
+        try:
+            st = os.statvfs(camera.get_image_path())
+            free = st.f_bavail * st.f_frsize
+        except OSError:
+            return 0, frame, True
+    return free, frame, free >= (frames or MIN_FREE_FRAMES) * frame
+
 
 class Timelapse:
     """ Allow user to capture a timelapse"""
     def __init__(self, microscope:Microscope, root_app):
         self.light = microscope.light
+        self.microscope = microscope
         self.camera = microscope.camera
+        self.staging = microscope.staging
         self.root_app = root_app
         self.time = {'s': 0, 'm': 0, 'h': 0}
         self.value = IntVar()
@@ -50,6 +74,10 @@ class Timelapse:
         self.container = None
         self.tab = None
         self.thread = None
+        # (last capture, next capture) monotonic times while running, else None
+        self.schedule:tuple = None
+        # Directory of the timelapse being captured
+        self.path:str = None
 
     def init_timelapse_tab(self, container):
         self.container = container
@@ -105,7 +133,7 @@ class Timelapse:
 
         # LINE 8
         self.btn['start'] = ttk.Button(tab, text="Start Timelapse",
-                                       command=self.start_timelapse)
+                                       command=self.confirm_start)
         self.btn['start'].grid(column=0, row=8, columnspan=3, padx=5, pady=5)
 
         # END
@@ -201,6 +229,16 @@ class Timelapse:
             self.light.set_brightness(self.light_brightness)
             self.light_status = 1
 
+    def confirm_start(self):
+        ''' Start the timelapse, after a confirmation if the media folder may run out of space '''
+        free, frame, enough = space_check(self.microscope, self.auto_stop)
+        if enough:
+            self.start_timelapse()
+            return
+        create_popup(close_btn='Cancel', accept_btn='Start', accept_callback=self.start_timelapse,
+                     text=f'Only {B_to_readable(free)} free: room for about {free // frame} frames '
+                          f'of {B_to_readable(frame)}.\nStart the timelapse anyway?')
+
     def start_timelapse(self):
         self.btn['start'].state(['disabled'])
         self.camera.stop_video()
@@ -221,13 +259,18 @@ class Timelapse:
         if self.light_status == 0:
             self.toggle_light()
 
+    def capture_schedule(self) -> tuple:
+        ''' Return (last capture, next capture) monotonic times, or None if not running '''
+        return self.schedule
+
     def timelapse_loop(self, name, q):
         logging.debug('timelapse loop : %s', name)
         begin = datetime.now()
         now = begin
-        path = self.camera.get_image_path()
+        path = entry_dir(self.camera.get_image_path(), begin)
         path = os.path.join(path, f"TL_{begin.strftime(r'%Y-%m-%d_%H-%M-%S')}")
         os.mkdir(path)
+        self.path = path
         remains = self.auto_stop
         last = None
         interval = self.total_seconds
@@ -236,41 +279,56 @@ class Timelapse:
         self.light_brightness = round(self.light.get_brightness() * 100)
         self.light_status = 1
         qt_photos = 0
+        stopping = False
+        begin_monotonic = monotonic()
+        self.schedule = (None, begin_monotonic)
         while (True):
-            if qt_photos >= self.auto_stop > 0:
-                self.stop_timelapse()
+            if qt_photos >= self.auto_stop > 0 and not stopping:
+                # Stopped from the UI thread, which sends back 'stop'
+                post(self.stop_timelapse)
+                stopping = True
             if (not q.empty()):
                 msg = q.get()
                 if msg == 'stop':
                     logging.info("Stopping Timelapse")
-                    self.btn['start'].state(['!disabled'])
+                    if self.staging is not None:
+                        self.staging.request_flush()
+                    self.schedule = None
+                    self.path = None
+                    post(self.btn['start'].state, ['!disabled'])
                     return
             now = datetime.now()
-            if (last is None or (now - begin).total_seconds() >= interval * qt_photos):
-                filename = f"{now.strftime(r'%Y-%m-%d_%H-%M-%S')}.jpg"
+            if not stopping and (last is None
+                                 or (now - begin).total_seconds() >= interval * qt_photos):
+                filename = now.strftime(r'%Y-%m-%d_%H-%M-%S')
                 p = os.path.join(path, filename)
+                if self.staging is not None:
+                    p = self.staging.stage(p)
                 ###
+                # Late: seconds behind the schedule of the frame
+                late = round((now - begin).total_seconds() - interval * qt_photos, 3)
                 try:
-                    self.camera.camera.capture(p, 'jpeg')
-                    logging.info("Picture '%s' saved.", filename)
-                    # Display the saved picture instead of Live video.
-                    photo = Image.open(p)
-                    photo = photo.resize((width, height), Image.LANCZOS)
-                    photo = ImageTk.PhotoImage(photo)
-                    self.camera.panel.configure(image=photo)
-                    self.camera.panel.image = photo
+                    with span('timelapse frame', frame=qt_photos, late=late):
+                        # Extension and encoding of the timelapse mode
+                        p = self.camera.capture(p, TIMELAPSE)
+                        if self.staging is not None:
+                            self.staging.commit(p)
+                        # Display the saved picture instead of Live video.
+                        photo = self.camera.encoder.preview(p)
+                        post(self.camera.show_frame, photo.resize((width, height), Image.LANCZOS))
                     last = now
-                    self.last_frame.set(str(datetime.strftime(last, r'%Y-%m-%d %H:%M:%S ')))
+                    post(self.last_frame, str(datetime.strftime(last, r'%Y-%m-%d %H:%M:%S ')))
                     # Photo Counter
                     qt_photos += 1
+                    self.schedule = (monotonic(), begin_monotonic + interval * qt_photos)
                 except PiCameraRuntimeError:
                     logging.error("Impossible to capture picture %s", filename, exc_info=True)
             # Refresh time before Next Frame
             n = int((timedelta(0, interval) - (now - last)).total_seconds())
             if interval < 3600:
-                self.next_frame.set(f'{n // 60} min {n % 60} sec')
+                post(self.next_frame, f'{n // 60} min {n % 60} sec')
             else:
-                self.next_frame.set(f'{n // 3600} h {n % 3600 // 60} m {n % 60} s')
+                post(self.next_frame, f'{n // 3600} h {n % 3600 // 60} m {n % 60} s')
 
             # AUTOLIGHT : Switch light on/off automatically before/after pictures
             if interval > MIN_INTERVAL_AUTOLIGHT:
@@ -282,9 +340,9 @@ class Timelapse:
 
             # Refresh time before End
             if remains == 0:
-                self.remaining.set('∞')
+                post(self.remaining, '∞')
             else:
                 n = max(0, int(interval * (remains - qt_photos) - (interval - n)))
                 r = time_str(n)
-                self.remaining.set(r)
+                post(self.remaining, r)
             sleep(0.200)  # Wait 200 ms
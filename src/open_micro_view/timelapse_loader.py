@@ -9,11 +9,18 @@ from tkinter import Frame, IntVar, Label, TclError
 
 from PIL import Image, ImageTk
 
-IMG_EXTENSIONS = ['jpg', 'jpeg', 'png']
+from .media_catalog import IMG_EXTENSIONS
+from .memory_budget import PLAYBACK, VISIBLE, image_bytes, register
+from .tracing import span
+from .ui_dispatcher import post
 
 
 class TimelapseLoader:
-    """ Load and play a timelapse """
+    """ Load and play a timelapse.
+
+    Frames are decoded to PIL images by the loader and player threads, and
+    only turned into Tk photo images on the Tk thread (show_frame, posted).
+    """
     def __init__(self, fullpath:str, callback:callable = None):
         self.max_w, self.max_h = 500, 280
         self.fullpath = fullpath
@@ -31,8 +38,21 @@ class TimelapseLoader:
         self.timelapse_fps = 4
         self.pause_event = threading.Event()
         self.timelapse_increment = 1
+        # Index of the player, mirrored to tk_player_index from the Tk thread
+        self.index = 0
         self.tk_player_index = IntVar(0)
         self.tk_n_frames_loaded = IntVar(0)
+        # Display size of the frames, index of the frame on screen
+        self.size:tuple = None
+        self.visible:int = None
+        self.photo:ImageTk.PhotoImage = None
+        # Frames dropped by the memory budget are decoded again when played
+        self.evicted = 0
+        # Crop box of each frame when the drift was estimated (see stabilization)
+        # pylint: disable=import-outside-toplevel
+        from .stabilization import stabilized_boxes
+        self.boxes:dict = stabilized_boxes(fullpath)
+        self.budget = register(f'timelapse {os.path.basename(fullpath)}', self.evict_frame)
 
     def __del__(self):
         self.quit()
@@ -42,9 +62,10 @@ class TimelapseLoader:
         if self.thread:
             self.thread.join(timeout=1)
         self.is_ready = False
+        self.budget.clear()
 
     def update_status(self):
-        self.tk_n_frames_loaded.set(self.frames_loaded)
+        post(self.tk_n_frames_loaded, self.frames_loaded)
 
     def check_stop_event(self):
         if self.stop_event.is_set():
@@ -52,28 +73,51 @@ class TimelapseLoader:
             self.frames = None
             raise StopAsyncIteration('Stop event received.')
 
+    def decode_frame(self, index:int) -> Image.Image:
+        ''' Decode frame index at the display size, accounted in the memory budget (any thread) '''
+        img = self.files[index]
+        with span('load frame', frame=index, file=img):
+            with Image.open(os.path.join(self.fullpath, img)) as photo:
+                if self.boxes is not None and img in self.boxes:
+                    photo = photo.crop(self.boxes[img])
+                if self.size is None:
+                    ratio = min(self.max_w / photo.width, self.max_h / photo.height)
+                    self.size = int(photo.width * ratio), int(photo.height * ratio)
+                photo = photo.resize(self.size, Image.LANCZOS)
+        frames = self.frames
+        if frames is not None:
+            frames[index] = photo
+            self.budget.add(index, image_bytes(*self.size), VISIBLE if index == self.visible else PLAYBACK)
+        return photo
+
+    def evict_frame(self, index:int):
+        ''' Memory budget exceeded: drop a frame '''
+        frames = self.frames
+        if frames is not None and index < len(frames):
+            frames[index] = None
+            self.evicted += 1
+
     def __load(self):
         ''' @Threaded - Load the timelapse frames'''
-        h = w = ratio = None
         try:
-            for img in self.files:
+            for index, img in enumerate(self.files):
                 self.check_stop_event()
+                if self.evicted or (self.size and not self.budget.fits(image_bytes(*self.size))):
+                    # Loading more would evict the first frames, needed first
+                    logging.info('Image budget reached after %d/%d frames, '
+                                 'the next ones are decoded while playing.',
+                                 self.frames_loaded, self.total_frames)
+                    break
                 logging.debug('[%d/%d] loading %s',
                               self.frames_loaded + 1, self.total_frames, img)
-                path = os.path.join(self.fullpath, img)
-                photo:Image = Image.open(path)
-                if ratio is None:
-                    ratio = min(self.max_w / photo.width, self.max_h / photo.height)
-                    h, w = int(photo.height * ratio), int(photo.width * ratio)
-                photo = ImageTk.PhotoImage(photo.resize((w, h), Image.LANCZOS))
-                self.check_stop_event()  # check if stopped before adding frame to list
-                self.frames.append(photo)
+                self.decode_frame(index)
+                self.check_stop_event()  # check if stopped before counting the frame
                 self.frames_loaded += 1
                 self.update_status()
             logging.info('Done')
             self.is_ready = True
             if self.callback is not None:
-                self.callback()
+                post(self.callback)
         except StopAsyncIteration:
             logging.warning("Quitting: stop signal received")
             return None
@@ -81,42 +125,68 @@ class TimelapseLoader:
     def __play(self):
         ''' @Threaded - Play the timelapse inside container Frame '''
         try:
-            frame = self.timelapse_frame
             last_frame = time.time_ns()
             minimum_step = 1_000_000_000 / self.timelapse_fps
             sleep_step = 1 / (self.timelapse_fps * 5)
             while not self.stop_event.is_set():
                 now = time.time_ns()
-                if self.tk_player_index.get() >= self.total_frames - 1:
+                if self.index >= self.total_frames - 1:
                     self.pause(False)
                 elif (not self.pause_event.is_set() and now - last_frame > minimum_step):
-                    img = self.get_current_frame(increment=1)
-                    frame.configure(image=img)
-                    # frame.image = img
+                    index = self.clamp(self.index + 1)
+                    frames = self.frames
+                    if frames is None:
+                        break
+                    if frames[index] is None:
+                        # Evicted: decoded here rather than on the Tk thread
+                        self.decode_frame(index)
+                    self.index = index
+                    post(self.show_frame, index)
                     last_frame = now
                 else:
                     coef = (1, self.timelapse_fps)[self.pause_event.is_set()]
                     time.sleep(sleep_step * coef)
-        except TclError:
-            logging.warning('Impossible to play timelapse: Container was destroyed.',
-                            exc_info=True)
         finally:
             logging.info('Exiting Thread.__play')
 
+    def clamp(self, index:int) -> int:
+        ''' Index limited to the frames loaded so far '''
+        available = self.total_frames if self.is_ready else self.frames_loaded
+        return min(max(index, 0), max(available - 1, 0))
+
     def pause(self, update:bool=False):
-        ''' Pause the video player'''
+        ''' Pause the video player, update (Tk thread) displays the current frame again '''
         self.pause_event.set()
         if update:
-            img = self.get_current_frame()
-            self.timelapse_frame.configure(image=img)
-
-    def get_current_frame(self, increment:int=0):
-        v = int(self.tk_player_index.get())
-        v2 = v + increment
-        v2 = min(max(v2, 0), len(self.frames) - 1)
-        if v2 != v:
-            self.tk_player_index.set(v2)
-        return self.frames[v2]
+            self.show_frame(self.index)
+
+    def seek(self, value:str):
+        ''' Scale moved (Tk thread): pause on the chosen frame '''
+        self.index = self.clamp(int(float(value)))
+        self.pause(True)
+
+    def show_frame(self, index:int):
+        ''' Display frame index (Tk thread), decoded again if it was evicted '''
+        frames = self.frames
+        if frames is None or self.timelapse_frame is None:
+            return
+        previous, self.visible = self.visible, index
+        image = frames[index]
+        if image is None:
+            image = self.decode_frame(index)
+        self.budget.set_priority(index, VISIBLE)
+        try:
+            self.photo = ImageTk.PhotoImage(image)
+            self.timelapse_frame.configure(image=self.photo)
+        except TclError:
+            logging.warning('Impossible to play timelapse: Container was destroyed.', exc_info=True)
+            self.stop_event.set()
+            return
+        # The previous frame stays visible until the new one is on screen
+        if previous is not None and previous != index:
+            self.budget.set_priority(previous, PLAYBACK)
+        if self.tk_player_index.get() != index:
+            self.tk_player_index.set(index)
 
     def play(self, container:Frame=None) -> bool:
         # Unpause if thread exists
@@ -128,9 +198,9 @@ class TimelapseLoader:
             if not container:
                 logging.error('Container cannot be none on first call')
                 return False
-            img = self.frames[self.tk_player_index.get()]
-            self.timelapse_frame = Label(container, image=img, background='white')
+            self.timelapse_frame = Label(container, background='white')
             self.timelapse_frame.pack(side='top', fill='both')
+            self.show_frame(self.index)
         # Start to play
         self.play_thread = threading.Thread(name='TimelapsePlayer', target=self.__play, args=[])
         self.play_thread.start()
@@ -144,8 +214,12 @@ class TimelapseLoader:
     def reset(self):
         self.stop_event.clear()
         self.frames_loaded = 0
-        self.frames = []
         self.total_frames = len(self.files)
+        self.frames = [None] * self.total_frames
         self.is_ready = False
+        self.visible = None
+        self.evicted = 0
+        self.budget.clear()
+        self.index = 0
         self.tk_player_index.set(0)
         self.tk_n_frames_loaded.set(0)
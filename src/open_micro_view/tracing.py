@@ -0,0 +1,112 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+# Timing spans, dumped as a Chrome trace (chrome://tracing, https://ui.perfetto.dev).
+# Tracing is enabled by the OMV_TRACE environment variable (the output file, or 1
+# for TRACE_FILE), e.g. `OMV_TRACE=/tmp/omv.json python3 start.py`. Spans are kept
+# in memory and written at exit, or on SIGUSR1. When disabled, span() returns a
+# shared no-op context manager.
+
+import atexit
+import json as Json
+import logging
+import os
+import signal
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+
+TRACE_ENV = 'OMV_TRACE'
+TRACE_FILE = './trace.json'
+# Events kept in memory, the oldest are dropped first
+TRACE_BUFFER = 200_000
+
+_NULL_SPAN = nullcontext()
+_events:deque = deque(maxlen=TRACE_BUFFER)
+# Thread id: thread name
+_threads:dict = {}
+_path:str = None
+
+
+class _Span:
+    __slots__ = ('name', 'args', 'begin')
+
+    def __init__(self, name:str, args:dict):
+        self.name = name
+        self.args = args
+        self.begin = 0
+
+    def __enter__(self):
+        self.begin = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        tid = threading.get_ident()
+        if tid not in _threads:
+            _threads[tid] = threading.current_thread().name
+        # deque.append is atomic: no lock needed between threads
+        _events.append((self.name, self.begin, end - self.begin, tid, self.args))
+        return False
+
+
+def enabled() -> bool:
+    return _path is not None
+
+
+def span(name:str, **args):
+    ''' with span('name', key=value): ... records the duration of the block '''
+    if _path is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def enable(path:str = TRACE_FILE):
+    ''' Start recording, the trace is written to path at exit and on SIGUSR1 '''
+    global _path  # pylint: disable=global-statement
+    if _path is None:
+        atexit.register(_dump_at_exit)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda *_: dump())
+    _path = path
+    logging.info('Tracing enabled, trace written to %s', path)
+
+
+def events() -> list:
+    ''' Recorded spans as Chrome trace events (complete events, in µs) '''
+    pid = os.getpid()
+    result = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+              for tid, name in list(_threads.items())]
+    for name, begin, duration, tid, args in list(_events):
+        event = {'name': name, 'ph': 'X', 'ts': begin / 1000, 'dur': duration / 1000,
+                 'pid': pid, 'tid': tid}
+        if args:
+            event['args'] = {k: str(v) for k, v in args.items()}
+        result.append(event)
+    return result
+
+
+def _dump_at_exit():
+    # Processes without spans (e.g. the capture process) keep the trace of the application
+    if _events:
+        dump()
+
+
+def dump(path:str = None) -> str:
+    ''' Write the trace (default: the enabled path), return the file written '''
+    path = path or _path or TRACE_FILE
+    try:
+        tmp = path + '.part'
+        with open(tmp, 'w') as f:
+            Json.dump({'traceEvents': events(), 'displayTimeUnit': 'ms'}, f)
+        os.replace(tmp, path)
+    except OSError:
+        logging.error('Impossible to write the trace %s', path, exc_info=True)
+        return None
+    logging.info('Trace written to %s (%d spans).', path, len(_events))
+    return path
+
+
+if os.environ.get(TRACE_ENV):
+    enable(TRACE_FILE if os.environ[TRACE_ENV] == '1' else os.environ[TRACE_ENV])
@@ -0,0 +1,108 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import threading
+from tkinter import TclError, Tk, Variable
+from typing import Any, Callable, Union
+
+from .observable import Value
+
+# Milliseconds between two UI updates
+UI_TICK = 50
+
+Target = Union[Variable, Value, Callable]
+
+
+def _key(target:Target):
+    ''' Updates of a same target are coalesced, bound methods included (e.g. widget.configure) '''
+    owner = getattr(target, '__self__', None)
+    if owner is not None and hasattr(target, '__func__'):
+        return (id(owner), target.__func__)
+    return id(target)
+
+
+def apply(target:Target, value:Any=None):
+    ''' Variable.set(value), or call target(value) (target() if value is None) '''
+    if isinstance(target, (Variable, Value)):
+        target.set(value)
+    elif value is None:
+        target()
+    else:
+        target(value)
+
+
+class UIDispatcher:
+    """ Apply the UI updates posted by worker threads from the Tk thread.
+
+    Workers `post()` (target, value) updates without touching Tk. A pump
+    scheduled with `after()` applies them every `tick` ms: only the latest
+    value posted for each target is applied, in the order of the last posts.
+    Updates posted from the Tk thread itself are applied immediately.
+    """
+    def __init__(self, root:Tk, tick:int=UI_TICK):
+        self.root = root
+        self.tick = tick
+        self.lock = threading.Lock()
+        # key: (target, value), ordered by last post
+        self.pending:dict = {}
+        self.tk_thread = threading.get_ident()
+        self.posted:int = 0
+        self.applied:int = 0
+        self._after_id = None
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self.root.after(self.tick, self.pump)
+
+    def stop(self):
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+
+    def post(self, target:Target, value:Any=None):
+        key = _key(target)
+        with self.lock:
+            self.posted += 1
+            self.pending.pop(key, None)
+            if threading.get_ident() != self.tk_thread:
+                self.pending[key] = (target, value)
+                return
+        self._apply(target, value)
+
+    def pump(self):
+        ''' Apply the pending updates, then schedule the next tick '''
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        for target, value in batch.values():
+            self._apply(target, value)
+        self._after_id = self.root.after(self.tick, self.pump)
+
+    def _apply(self, target:Target, value:Any):
+        try:
+            apply(target, value)
+            self.applied += 1
+        except TclError:
+            # Widget destroyed in the meantime (e.g. window closed)
+            logging.debug('UI update of %s dropped.', target, exc_info=True)
+        except Exception:  # pylint: disable=broad-except
+            logging.error('Error while updating %s', target, exc_info=True)
+
+
+_dispatcher:UIDispatcher = None
+
+
+def install(root:Tk, tick:int=UI_TICK) -> UIDispatcher:
+    ''' Route the updates of post() through a dispatcher pumped by root '''
+    global _dispatcher  # pylint: disable=global-statement
+    _dispatcher = UIDispatcher(root, tick)
+    _dispatcher.start()
+    return _dispatcher
+
+
+def post(target:Target, value:Any=None):
+    ''' Request a UI update from any thread, applied directly if no dispatcher is installed '''
+    if _dispatcher is None:
+        apply(target, value)
+    else:
+        _dispatcher.post(target, value)
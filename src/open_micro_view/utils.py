@@ -3,8 +3,12 @@
 
 import ctypes
 import ctypes.util
+import errno
+import json as Json
 import logging
 import os
+import platform
+from math import gcd
 from subprocess import PIPE, Popen, run
 from tkinter import FLAT, Frame, IntVar, StringVar, ttk
 from typing import Callable
@@ -12,6 +16,7 @@ from typing import Callable
 KB = 1024
 MB = KB * 1024
 GB = MB * 1024
+CONFIG_FILE = './config.json'
 
 B_to_KB:Callable[[int], float] = lambda x: x / 1024
 B_to_MB:Callable[[int], float] = lambda x: B_to_KB(x) / 1024
@@ -31,6 +36,18 @@ def seconds_to_readable(sec:int):
     return ' '.join(r)
 
 
+def resolution_ratio(r:tuple) -> str:
+    ''' return a string representing the resolution ratio (e.g. 16:9) '''
+    x, y = int(r[0]), int(r[1])
+    div = gcd(x, y)
+    return f'{int(x / div)}:{int(y / div)}'
+
+
+def resolution_str(r:tuple) -> str:
+    ''' e.g. "1920x1080 (16:9)" '''
+    return f"{r[0]}x{r[1]} ({resolution_ratio(r)})"
+
+
 def create_popup(close_btn:str=None, text:str=None, raise_over:Frame=None, cols:int=1,
                  accept_btn:str='Yes', accept_callback:Callable=None) -> Frame:
     ''' Create a popup in the middle of the scrren. '''
@@ -80,8 +97,27 @@ def umount2(target:str, options:int=0):
     if libc:
         ret = libc.umount2(target.encode(), options)
         if ret < 0:
-            errno = ctypes.get_errno()
-            raise OSError(errno, f"Error unmounting {target}: {os.strerror(errno)}")
+            err = ctypes.get_errno()
+            raise OSError(err, f"Error unmounting {target}: {os.strerror(err)}")
+
+
+# Define ioprio_set (no wrapper in libc, called through syscall())
+SYS_IOPRIO_SET = {'armv7l': 314, 'armv6l': 314, 'aarch64': 30, 'x86_64': 251, 'i686': 289}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def ioprio_set(klass:int=IOPRIO_CLASS_BE, level:int=7, tid:int=0):
+    """ set the I/O scheduling class and priority of a thread (0: calling thread). """
+    nr = SYS_IOPRIO_SET.get(platform.machine())
+    if nr is None or not libc:
+        raise OSError(errno.ENOSYS, 'ioprio_set is not available on this platform')
+    ret = libc.syscall(nr, IOPRIO_WHO_PROCESS, tid, (klass << IOPRIO_CLASS_SHIFT) | level)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, f"Error setting I/O priority: {os.strerror(err)}")
 
 
 def dir_size_bytes(_dir:str) -> int:
@@ -99,6 +135,25 @@ def dir_size_bytes(_dir:str) -> int:
     return int(size)
 
 
+def part_path(path:str) -> str:
+    ''' Temporary name of path while it is written: hidden, so that the media
+    catalog does not take it for a picture '''
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f'.{name}.part')
+
+
+def read_config() -> dict:
+    ''' Content of CONFIG_FILE, empty if it does not exist yet or is invalid '''
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            return Json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        logging.error('Invalid %s, default configuration used.', CONFIG_FILE, exc_info=True)
+        return {}
+
+
 def shutdown(reboot:bool=False) -> bool:
     logging.warning('System shutdown triggered.', exc_info=True)
     cmd = ['shutdown']
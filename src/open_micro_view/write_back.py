@@ -0,0 +1,234 @@
+# OpenMicroView: GUI for the open source, Raspberry Pi based namesake Microscope
+# Copyright (C) 2023 V. Salvadori
+
+import logging
+import os
+import shutil
+import threading
+from collections import deque
+from time import monotonic
+from typing import Callable
+
+from .tracing import span
+from .utils import MB, B_to_readable, part_path
+
+# RAM (tmpfs) directory where the frames are written first
+STAGING_DIR = '/dev/shm/openmicroview_staging'
+# A batch is committed when its oldest frame waited MAX_LATENCY seconds...
+MAX_LATENCY = 60.0
+# ...or when the staged frames reach MAX_BYTES
+MAX_BYTES = 32 * MB
+# Seconds between two checks of the staged frames by the flusher
+FLUSH_POLL = 1.0
+
+
+class WriteBack:
+    """ RAM staging area of the timelapse frames, committed to the media folder in batches.
+
+    Frames are captured to a tmpfs mirror of the media folder (stage()) and
+    queued (commit()). The flusher thread copies them to the media folder in
+    batches: all the files of a batch are written, synced once, renamed to
+    their final name and their directories synced. A sub-minute timelapse
+    thus causes one burst of writes per batch instead of one per frame.
+    Frames left in the staging area by a crash of the application are
+    committed at the next start (recover()). A power loss loses the frames
+    not yet committed, at most MAX_LATENCY seconds or MAX_BYTES of them.
+    """
+    def __init__(self, media:str, staging:str=STAGING_DIR, max_latency:float=MAX_LATENCY,
+                 max_bytes:int=MAX_BYTES, wait:Callable[[str], None]=None):
+        self.media = media
+        self.staging = staging
+        self.max_latency = max_latency
+        self.max_bytes = max_bytes
+        # Called with the staged path before copying a file (e.g. wait for its encoding)
+        self.wait = wait
+        self.cond = threading.Condition()
+        # (staged path, commit time) waiting for the next batch
+        self.pending:deque = deque()
+        self.flush_requested = False
+        self.stop_event = threading.Event()
+        self.thread:threading.Thread = None
+        # Batches committed, files committed, files which could not be committed
+        self.batches = 0
+        self.committed = 0
+        self.failed = 0
+
+    @classmethod
+    def from_config(cls, media:str, config:dict, wait:Callable[[str], None]=None) -> 'WriteBack':
+        ''' Staging configured by the 'write_back' section of the configuration, None if disabled:
+        {"enabled": true, "path": ..., "max_latency": seconds, "max_bytes": bytes} '''
+        if not config or not config.get('enabled'):
+            return None
+        staging = config.get('path', STAGING_DIR)
+        try:
+            os.makedirs(staging, exist_ok=True)
+        except OSError:
+            logging.error('Impossible to create the staging area %s, frames written directly.',
+                          staging, exc_info=True)
+            return None
+        return cls(media, staging, float(config.get('max_latency', MAX_LATENCY)),
+                   int(config.get('max_bytes', MAX_BYTES)), wait)
+
+    def stage(self, path:str) -> str:
+        ''' Path where to write a file meant for path, in the media folder '''
+        staged = os.path.join(self.staging, os.path.relpath(path, self.media))
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+        return staged
+
+    def target(self, staged:str) -> str:
+        ''' Final path of a staged file '''
+        return os.path.join(self.media, os.path.relpath(staged, self.staging))
+
+    def commit(self, staged:str):
+        ''' Queue a staged file (possibly still being written, see wait) for the next batch '''
+        with self.cond:
+            self.pending.append((staged, monotonic()))
+            self.cond.notify()
+
+    def request_flush(self):
+        ''' Commit the pending files now, e.g. at the end of a timelapse '''
+        with self.cond:
+            self.flush_requested = True
+            self.cond.notify()
+
+    def recover(self) -> int:
+        ''' Queue the files left in the staging area by a previous run, return their number '''
+        found = []
+        for folder, _, files in os.walk(self.staging):
+            for name in sorted(files):
+                path = os.path.join(folder, name)
+                if name.endswith('.part'):
+                    # Interrupted encoding
+                    os.remove(path)
+                else:
+                    found.append(path)
+        if found:
+            logging.warning('Recovering %d frames from the staging area.', len(found))
+            with self.cond:
+                self.pending.extend((path, 0) for path in found)
+                self.cond.notify()
+        return len(found)
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(name='writeBack', target=self.run, args=(), daemon=True)
+        self.thread.start()
+
+    def close(self):
+        ''' Stop the flusher and commit everything still staged '''
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush(prune=True)
+        logging.info('Write-back: %d frames committed in %d batches, %d failed.',
+                     self.committed, self.batches, self.failed)
+
+    def run(self):
+        ''' @Threaded - Commit a batch whenever one is due '''
+        while not self.stop_event.is_set():
+            with self.cond:
+                self.cond.wait(FLUSH_POLL)
+                due = self._due()
+            if due:
+                try:
+                    self.flush()
+                except Exception:  # pylint: disable=broad-except
+                    # Files not committed stay staged, recovered at next start
+                    logging.error('Write-back batch failed.', exc_info=True)
+
+    def _due(self) -> bool:
+        ''' True if the pending files must be committed (lock held) '''
+        if not self.pending:
+            return False
+        if self.flush_requested or monotonic() - self.pending[0][1] >= self.max_latency:
+            return True
+        size = 0
+        for staged, _ in self.pending:
+            try:
+                size += os.path.getsize(staged)
+            except OSError:
+                pass  # Still being encoded
+        return size >= self.max_bytes
+
+    def flush(self, prune:bool=False) -> int:
+        ''' Commit the pending files as one batch, return the number committed.
+        Staging directories left empty are removed if prune, or if the flush was
+        requested (end of a timelapse): while a timelapse runs, its next frame may
+        be staged at any time '''
+        with self.cond:
+            batch = [staged for staged, _ in self.pending]
+            self.pending.clear()
+            prune = prune or self.flush_requested
+            self.flush_requested = False
+        if not batch:
+            return 0
+        with span('write-back batch', files=len(batch)):
+            return self._commit(batch, prune)
+
+    def _commit(self, batch:list, prune:bool=False) -> int:
+        written = []
+        size = 0
+        for staged in batch:
+            if self.wait is not None:
+                self.wait(staged)
+            target = self.target(staged)
+            if not os.path.isdir(os.path.dirname(target)):
+                # Timelapse deleted meanwhile
+                logging.warning('Dropping %s: its directory does not exist anymore.', target)
+                self._discard(staged)
+                continue
+            try:
+                shutil.copyfile(staged, part_path(target))
+                size += os.path.getsize(staged)
+                written.append((staged, target))
+            except OSError:
+                # Left in the staging area, recovered at next start
+                logging.error('Impossible to commit %s', staged, exc_info=True)
+                self.failed += 1
+                self._discard(part_path(target))
+        # One sync for the whole batch, then the files appear under their final name
+        os.sync()
+        folders = set()
+        committed = []
+        for staged, target in written:
+            try:
+                os.replace(part_path(target), target)
+            except OSError:
+                # Timelapse deleted or moved during the batch: left in the staging area
+                logging.error('Impossible to commit %s', staged, exc_info=True)
+                self.failed += 1
+                self._discard(part_path(target))
+                continue
+            folders.add(os.path.dirname(target))
+            self._discard(staged)
+            committed.append(staged)
+        for folder in folders:
+            try:
+                fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                logging.warning('Impossible to sync %s', folder, exc_info=True)
+        # Staging directories of the ended timelapses
+        for folder in {os.path.dirname(staged) for staged in committed} if prune else ():
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass  # Still in use
+        self.batches += 1
+        self.committed += len(committed)
+        logging.debug('Write-back: %d frames (%s) committed.', len(committed), B_to_readable(size))
+        return len(committed)
+
+    def _discard(self, path:str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logging.warning('Impossible to remove %s', path, exc_info=True)